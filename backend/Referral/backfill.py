@@ -0,0 +1,97 @@
+"""Заполнение производных таблиц по уже существующим связям.
+
+Таблицы, добавленные позже самих связей, ведутся только для новых
+регистраций. Старые связи попадают в них после backfill, который нужно
+один раз выполнить при развёртывании для каждого сервиса:
+
+    python -m backend.Referral.backfill [<service_id> ...] [--step STEP]
+
+Без service_id обрабатываются все сервисы, у которых есть связи. Каждый
+шаг пересобирает таблицу сервиса целиком, так что повторный запуск
+безопасен. Выполненные шаги записываются в referral_backfills.
+"""
+
+import argparse
+import asyncio
+import json
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.Referral.models import (
+    BACKFILL_CLOSURE,
+    BACKFILL_DAILY_STATS,
+    BACKFILL_LEADERBOARD,
+)
+from backend.Referral.repository import ReferralRepository
+
+# Шаг → метод репозитория, пересобирающий таблицу сервиса
+STEPS = {
+    BACKFILL_CLOSURE: "rebuild_closure",
+    BACKFILL_DAILY_STATS: "rebuild_daily_stats",
+    BACKFILL_LEADERBOARD: "rebuild_referrer_counts",
+}
+
+
+async def backfill_service(
+    session: AsyncSession,
+    service_id: UUID,
+    steps=None,
+    repo: ReferralRepository | None = None,
+) -> list[str]:
+    """Выполняет шаги для сервиса и отмечает их выполненными."""
+    repo = repo or ReferralRepository()
+    done = []
+    for step in steps or STEPS:
+        await getattr(repo, STEPS[step])(session, service_id)
+        await repo.mark_backfilled(session, service_id, step)
+        done.append(step)
+    return done
+
+
+async def _main(service_ids: list[UUID], steps: list[str] | None):
+    # Все модели должны быть загружены до первого запроса
+    import backend.ExternalService.models  # noqa: F401
+    import backend.ReferralCode.models  # noqa: F401
+    import backend.User.models  # noqa: F401
+    from backend.config import db_settings
+    from backend.database.db import db
+
+    db.init(db_settings.url, echo=db_settings.echo)
+    repo = ReferralRepository()
+    report = {}
+    try:
+        if not service_ids:
+            async with db.get_session() as session:
+                service_ids = await repo.get_service_ids(session)
+
+        # Сервис — отдельная транзакция: упавший не откатывает остальные
+        for service_id in service_ids:
+            async with db.get_session() as session:
+                report[str(service_id)] = await backfill_service(
+                    session, service_id, steps, repo
+                )
+                await session.commit()
+    finally:
+        await db.dispose()
+
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Заполнение производных таблиц рефералов",
+    )
+    parser.add_argument("service_ids", type=UUID, nargs="*")
+    parser.add_argument(
+        "--step",
+        action="append",
+        choices=sorted(STEPS),
+        help="выполнить только этот шаг (можно повторять)",
+    )
+    args = parser.parse_args()
+    asyncio.run(_main(args.service_ids, args.step))
+
+
+if __name__ == "__main__":
+    main()
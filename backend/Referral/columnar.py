@@ -0,0 +1,217 @@
+"""Колоночная выгрузка рефералов.
+
+Строки из курсора репозитория собираются в куски по CHUNK_ROWS и
+кодируются по колонкам: UUID — 16 байт, уровень — int32, время —
+int64 (микросекунды от эпохи, UTC). Такой файл в разы меньше CSV и
+читается без разбора текста.
+
+Формат columnar (всегда доступен), все числа little-endian:
+
+    file    := header chunk* trailer
+    header  := b"RCOL" u8(1) service_id[16]
+    chunk   := u32(n) id[16 * n] referrer_id[16 * n] referred_id[16 * n]
+               level[int32 * n] registered_at[int64 * n]
+               code_mask[ceil(n / 8)] referral_code_id[16 * k]
+    trailer := u32(0)
+
+registered_at = INT64_MIN означает NULL. Бит i маски code_mask
+(младший бит первого байта — строка 0) выставлен, если у строки есть
+referral_code_id; k — число выставленных битов, коды идут подряд только
+для таких строк.
+
+Формат arrow доступен, если установлен pyarrow: поток Arrow IPC с теми
+же колонками, по record batch на кусок.
+"""
+
+import struct
+import sys
+from array import array
+from datetime import datetime, timezone
+from io import BytesIO
+from uuid import UUID
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # pragma: no cover - зависит от окружения
+    pyarrow = None
+
+MAGIC = b"RCOL"
+VERSION = 1
+
+# Строк в одном куске
+CHUNK_ROWS = 8192
+
+NULL_TIMESTAMP = -(2**63)
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_LITTLE = sys.byteorder == "little"
+
+
+def has_arrow() -> bool:
+    return pyarrow is not None
+
+
+def _to_micros(value: datetime | None) -> int:
+    if value is None:
+        return NULL_TIMESTAMP
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+
+def _from_micros(value: int) -> datetime | None:
+    if value == NULL_TIMESTAMP:
+        return None
+    return datetime.fromtimestamp(value // 10**6, timezone.utc).replace(
+        microsecond=value % 10**6
+    )
+
+
+def _le(values: array) -> bytes:
+    if not _LITTLE:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_le(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if not _LITTLE:
+        values.byteswap()
+    return values
+
+
+def columnar_header(service_id: UUID) -> bytes:
+    return MAGIC + bytes([VERSION]) + service_id.bytes
+
+
+def columnar_trailer() -> bytes:
+    return struct.pack("<I", 0)
+
+
+def encode_columnar_chunk(rows) -> bytes:
+    """Кодирует строки iter_edges в один кусок формата columnar."""
+    n = len(rows)
+    mask = bytearray((n + 7) // 8)
+    codes = []
+    for i, row in enumerate(rows):
+        if row.referral_code_id is not None:
+            mask[i // 8] |= 1 << (i % 8)
+            codes.append(row.referral_code_id.bytes)
+
+    return b"".join(
+        [
+            struct.pack("<I", n),
+            b"".join(row.id.bytes for row in rows),
+            b"".join(row.referrer_id.bytes for row in rows),
+            b"".join(row.referred_id.bytes for row in rows),
+            _le(array("i", (row.level for row in rows))),
+            _le(array("q", (_to_micros(row.registered_at) for row in rows))),
+            bytes(mask),
+            b"".join(codes),
+        ]
+    )
+
+
+def decode_columnar(data: bytes) -> tuple[UUID, list[dict]]:
+    """Читает выгрузку columnar целиком: (service_id, строки).
+
+    Эталонная реализация формата для проверки и небольших файлов.
+    """
+    if data[:4] != MAGIC or data[4] != VERSION:
+        raise ValueError("Invalid columnar export")
+
+    service_id = UUID(bytes=data[5:21])
+    pos = 21
+    rows = []
+
+    def take(size: int) -> bytes:
+        nonlocal pos
+        chunk = data[pos:pos + size]
+        if len(chunk) != size:
+            raise ValueError("Truncated columnar export")
+        pos += size
+        return chunk
+
+    while True:
+        (n,) = struct.unpack("<I", take(4))
+        if n == 0:
+            break
+
+        ids = take(16 * n)
+        referrers = take(16 * n)
+        referred = take(16 * n)
+        levels = _from_le("i", take(4 * n))
+        times = _from_le("q", take(8 * n))
+        mask = take((n + 7) // 8)
+
+        for i in range(n):
+            code = None
+            if mask[i // 8] >> (i % 8) & 1:
+                code = UUID(bytes=take(16))
+            rows.append(
+                {
+                    "id": UUID(bytes=ids[16 * i:16 * i + 16]),
+                    "referrer_id": UUID(bytes=referrers[16 * i:16 * i + 16]),
+                    "referred_id": UUID(bytes=referred[16 * i:16 * i + 16]),
+                    "service_id": service_id,
+                    "level": levels[i],
+                    "registered_at": _from_micros(times[i]),
+                    "referral_code_id": code,
+                }
+            )
+
+    return service_id, rows
+
+
+class ArrowStreamEncoder:
+    """Поток Arrow IPC: схема, затем по record batch на кусок."""
+
+    def __init__(self, service_id: UUID):
+        uuid_type = pyarrow.binary(16)
+        self.schema = pyarrow.schema(
+            [
+                pyarrow.field("id", uuid_type, nullable=False),
+                pyarrow.field("referrer_id", uuid_type, nullable=False),
+                pyarrow.field("referred_id", uuid_type, nullable=False),
+                pyarrow.field("level", pyarrow.int32(), nullable=False),
+                pyarrow.field("registered_at", pyarrow.timestamp("us", "UTC")),
+                pyarrow.field("referral_code_id", uuid_type),
+            ],
+            metadata={"service_id": str(service_id)},
+        )
+        self._sink = BytesIO()
+        self._writer = pyarrow.ipc.new_stream(self._sink, self.schema)
+
+    def _drain(self) -> bytes:
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
+
+    def header(self) -> bytes:
+        return self._drain()
+
+    def chunk(self, rows) -> bytes:
+        batch = pyarrow.record_batch(
+            [
+                [row.id.bytes for row in rows],
+                [row.referrer_id.bytes for row in rows],
+                [row.referred_id.bytes for row in rows],
+                [row.level for row in rows],
+                [row.registered_at for row in rows],
+                [
+                    code.bytes if code is not None else None
+                    for code in (row.referral_code_id for row in rows)
+                ],
+            ],
+            schema=self.schema,
+        )
+        self._writer.write_batch(batch)
+        return self._drain()
+
+    def trailer(self) -> bytes:
+        self._writer.close()
+        return self._drain()
@@ -0,0 +1,136 @@
+"""Рассылка событий о рефералах подписчикам внутри процесса.
+
+События копятся в сессии и уходят подписчикам только после коммита,
+поэтому откаченные регистрации никто не увидит. Каждое событие
+кодируется в формат Server-Sent Events один раз и раскладывается по
+очередям подписчиков сервиса.
+
+Очереди ограничены. Подписчик, который не успевает их разбирать, не
+тормозит остальных: его очередь очищается, он получает событие
+overflow и отключается. Пропущенное клиент дочитывает через
+/referrals/changes и подписывается заново.
+"""
+
+import asyncio
+import json
+from uuid import UUID
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Сколько событий может ждать в очереди одного подписчика
+QUEUE_SIZE = 256
+
+# Как часто слать комментарий-пинг, чтобы прокси не рвали соединение
+HEARTBEAT_INTERVAL = 15.0
+
+HEARTBEAT = b": ping\n\n"
+OVERFLOW = b"event: overflow\ndata: {}\n\n"
+
+
+def encode_event(name: str, data: dict) -> bytes:
+    payload = json.dumps(data, default=str, ensure_ascii=False)
+    return f"event: {name}\ndata: {payload}\n\n".encode()
+
+
+class Subscription:
+    def __init__(self, service_id: UUID, queue_size: int):
+        self.service_id = service_id
+        self.queue: asyncio.Queue[bytes] = asyncio.Queue(queue_size)
+        self.closed = False
+
+    def push(self, message: bytes) -> bool:
+        """Кладёт сообщение в очередь; False — подписчик отстал."""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def overflow(self):
+        """Отбрасывает накопленное и оставляет только overflow."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(OVERFLOW)
+        self.closed = True
+
+    async def messages(self, heartbeat: float = HEARTBEAT_INTERVAL):
+        """Сообщения в формате SSE, пока подписка не закрыта."""
+        while True:
+            try:
+                message = await asyncio.wait_for(self.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield HEARTBEAT
+                continue
+
+            yield message
+            if message is OVERFLOW:
+                return
+
+
+class ReferralEventBroker:
+    def __init__(self, queue_size: int = QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: dict[UUID, set[Subscription]] = {}
+        self._info_key = f"referral_events_{id(self)}"
+
+    def subscribe(self, service_id: UUID) -> Subscription:
+        subscription = Subscription(service_id, self.queue_size)
+        self._subscribers.setdefault(service_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.service_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self._subscribers[subscription.service_id]
+
+    def subscribers(self, service_id: UUID) -> int:
+        return len(self._subscribers.get(service_id, ()))
+
+    def publish(self, service_id: UUID, name: str, data: dict):
+        """Сразу рассылает событие подписчикам сервиса."""
+        subscribers = self._subscribers.get(service_id)
+        if not subscribers:
+            return
+
+        message = encode_event(name, data)
+        for subscription in list(subscribers):
+            if not subscription.push(message):
+                subscription.overflow()
+                self.unsubscribe(subscription)
+
+    def publish_after_commit(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        name: str,
+        data: dict,
+    ):
+        """Откладывает событие до коммита транзакции сессии."""
+        if service_id not in self._subscribers:
+            return
+        self._pending(session).append((service_id, name, data))
+
+    def _pending(self, session: AsyncSession) -> list:
+        sync_session = session.sync_session
+        pending = sync_session.info.get(self._info_key)
+        if pending is not None:
+            return pending
+
+        pending = sync_session.info[self._info_key] = []
+
+        @event.listens_for(sync_session, "after_commit")
+        def _committed(_session):
+            events, pending[:] = list(pending), []
+            for service_id, name, data in events:
+                self.publish(service_id, name, data)
+
+        @event.listens_for(sync_session, "after_transaction_end")
+        def _ended(_session, transaction):
+            if transaction.parent is None:
+                pending.clear()
+
+        return pending
@@ -0,0 +1,282 @@
+"""Фоновые выгрузки рефералов в файл.
+
+Задача выгрузки пишет тот же поток, что и /referrals/export, в
+gzip-файл в каталоге выгрузок; запрос, создавший задачу, сразу
+освобождается. Состояние задачи хранится в referral_export_jobs, готовый
+файл отдаётся с поддержкой Range и удаляется вместе с задачей через ttl
+секунд после завершения — фоновой очисткой раз в interval секунд.
+
+Задача выполняется в процессе, который её создал, и после перезапуска
+продолжить её некому. При старте процесса незавершённые задачи,
+созданные до него, помечаются failed и удаляются как обычные.
+
+Число обработанных строк во время работы известно только процессу,
+который выполняет задачу: писать его в базу параллельно с чтением
+курсора SQLite не даёт.
+"""
+
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
+
+import backend.database.db as db_module
+from backend.Referral.models import ReferralExportJob
+from backend.Referral.service import EXPORT_FORMATS, ReferralService
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Расширение файла выгрузки по формату (перед .gz)
+EXPORT_EXTENSIONS = {
+    "json": "json",
+    "csv": "csv",
+    "ndjson": "ndjson",
+    "columnar": "rcol",
+    "arrow": "arrows",
+}
+
+# Размер куска при чтении файла для скачивания
+READ_CHUNK = 64 * 1024
+
+# Ошибка задач, прерванных перезапуском процесса
+INTERRUPTED = "Interrupted by restart"
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """Разбирает заголовок Range: "bytes=start-end", "bytes=start-" или
+    "bytes=-suffix". Возвращает (start, end) включительно или None,
+    если нужен весь файл.
+
+    Несколько диапазонов не поддерживаются, для них тоже отдаётся весь
+    файл. Диапазон за пределами файла — ValueError.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+
+    start_raw, _, end_raw = header[len("bytes="):].strip().partition("-")
+    try:
+        if not start_raw:
+            suffix = int(end_raw)
+            if suffix <= 0:
+                raise ValueError("Invalid range")
+            return max(size - suffix, 0), size - 1
+
+        start = int(start_raw)
+        end = int(end_raw) if end_raw else size - 1
+    except ValueError:
+        raise ValueError("Invalid range")
+
+    if start >= size or end < start:
+        raise ValueError("Invalid range")
+    return start, min(end, size - 1)
+
+
+async def read_file_range(path: str, start: int, end: int):
+    """Отдаёт байты файла [start, end] кусками, чтение — в пуле потоков."""
+    file = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(file.seek, start)
+        left = end - start + 1
+        while left > 0:
+            data = await asyncio.to_thread(file.read, min(READ_CHUNK, left))
+            if not data:
+                break
+            left -= len(data)
+            yield data
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+class ExportJobManager:
+    """Запуск, состояние и хранение фоновых выгрузок.
+
+    Задачи выполняются в процессе, который их создал; одновременно — не
+    больше max_running, остальные ждут в статусе pending.
+    """
+
+    def __init__(
+        self,
+        service: ReferralService,
+        directory: str = "",
+        ttl: float = 3600.0,
+        max_running: int = 2,
+        interval: float = 300.0,
+    ):
+        self.service = service
+        self.repo = service.repo
+        self.directory = directory or os.path.join(
+            tempfile.gettempdir(), "referral-exports"
+        )
+        self.ttl = ttl
+        self.interval = interval
+        self._slots = asyncio.Semaphore(max_running)
+        self._progress: dict[UUID, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._cleanup_task: asyncio.Task | None = None
+
+    def path_for(self, job: ReferralExportJob) -> str:
+        return os.path.join(
+            self.directory,
+            f"{job.id}.{EXPORT_EXTENSIONS[job.format]}.gz",
+        )
+
+    def filename_for(self, job: ReferralExportJob) -> str:
+        return f"referrals-{job.service_id}.{EXPORT_EXTENSIONS[job.format]}.gz"
+
+    def progress(self, job: ReferralExportJob) -> int | None:
+        """Сколько строк записано: на ходу — по данным этого процесса."""
+        if job.status == JOB_RUNNING:
+            return self._progress.get(job.id)
+        return job.rows
+
+    async def start(self, service_id: UUID, format: str) -> ReferralExportJob:
+        """Создаёт задачу и запускает её в фоне."""
+        if format not in EXPORT_FORMATS:
+            raise ValueError("Invalid export format")
+
+        async with db_module.db.get_session() as session:
+            job = await self.repo.create_export_job(
+                session,
+                ReferralExportJob(service_id=service_id, format=format),
+            )
+            await session.commit()
+
+        task = asyncio.create_task(self.run(job.id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def get(self, job_id: UUID) -> ReferralExportJob | None:
+        async with db_module.db.get_session() as session:
+            return await self.repo.get_export_job(session, job_id)
+
+    async def run(self, job_id: UUID):
+        async with self._slots:
+            async with db_module.db.get_session() as session:
+                job = await self.repo.get_export_job(session, job_id)
+                if job is None or job.status != JOB_PENDING:
+                    return
+                job.status = JOB_RUNNING
+                job.total = await self.repo.count_referrals(
+                    session, job.service_id
+                )
+                await session.commit()
+
+            self._progress[job_id] = 0
+            path = self.path_for(job)
+            try:
+                rows = await self._write(job, path)
+            except Exception as e:
+                await self._finish(job_id, JOB_FAILED, error=str(e)[:255])
+                await asyncio.to_thread(_remove, path + ".part")
+            else:
+                size = await asyncio.to_thread(os.path.getsize, path)
+                await self._finish(job_id, JOB_DONE, rows=rows, size=size)
+            finally:
+                self._progress.pop(job_id, None)
+
+    async def _write(self, job: ReferralExportJob, path: str) -> int:
+        """Пишет выгрузку во временный файл и переименовывает его в path.
+
+        Сжатие и запись идут в пуле потоков, чтобы не блокировать цикл
+        событий.
+        """
+        await asyncio.to_thread(os.makedirs, self.directory, exist_ok=True)
+        partial = path + ".part"
+
+        def advance(n: int):
+            self._progress[job.id] += n
+
+        file = await asyncio.to_thread(gzip.open, partial, "wb")
+        try:
+            async with db_module.db.get_session() as session:
+                async for chunk in self.service.stream_export(
+                    session, job.service_id, job.format, advance
+                ):
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    await asyncio.to_thread(file.write, chunk)
+        finally:
+            await asyncio.to_thread(file.close)
+
+        await asyncio.to_thread(os.replace, partial, path)
+        return self._progress[job.id]
+
+    async def _finish(self, job_id: UUID, status: str, **values):
+        now = datetime.now(timezone.utc)
+        async with db_module.db.get_session() as session:
+            job = await self.repo.get_export_job(session, job_id)
+            if job is None:
+                return
+            job.status = status
+            job.finished_at = now
+            job.expires_at = now + timedelta(seconds=self.ttl)
+            for key, value in values.items():
+                setattr(job, key, value)
+            await session.commit()
+
+    async def cleanup(self):
+        """Удаляет задачи с истёкшим сроком хранения и их файлы."""
+        now = datetime.now(timezone.utc)
+        async with db_module.db.get_session() as session:
+            for job in await self.repo.get_expired_export_jobs(session, now):
+                path = self.path_for(job)
+                await asyncio.to_thread(_remove, path)
+                # Файл задачи, прерванной перезапуском
+                await asyncio.to_thread(_remove, path + ".part")
+                await self.repo.delete_export_job(session, job)
+            await session.commit()
+
+    async def fail_interrupted(self) -> int:
+        """Помечает failed задачи pending и running, созданные до старта
+        процесса: их никто не выполняет. Возвращает число задач."""
+        now = datetime.now(timezone.utc)
+        async with db_module.db.get_session() as session:
+            count = await self.repo.fail_unfinished_export_jobs(
+                session,
+                now=now,
+                error=INTERRUPTED,
+                expires_at=now + timedelta(seconds=self.ttl),
+            )
+            await session.commit()
+        return count
+
+    async def startup(self):
+        """Закрывает прерванные задачи и запускает периодическую
+        очистку."""
+        if self._cleanup_task is not None:
+            return
+        try:
+            await self.fail_interrupted()
+        except Exception:
+            logger.exception("Failed to mark interrupted export jobs")
+        self._cleanup_task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.cleanup()
+            except Exception:
+                # Задачи и файлы остаются до следующего прохода
+                logger.exception("Export jobs cleanup failed")
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
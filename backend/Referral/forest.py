@@ -0,0 +1,275 @@
+import asyncio
+import datetime as dt
+from collections import ChainMap
+from dataclasses import dataclass, replace
+from uuid import UUID
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from backend.Referral.repository import ReferralRepository
+
+_FLUSHED_KEY = "referral_forest_flushed"
+
+
+@event.listens_for(Session, "after_begin")
+def _reset_flushed(session, transaction, connection):
+    session.info.pop(_FLUSHED_KEY, None)
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_flushed(session, flush_context):
+    # Снимок, прочитанный после незакоммиченной записи, нельзя оставлять
+    session.info[_FLUSHED_KEY] = True
+
+
+@dataclass(slots=True)
+class ForestEdge:
+    """Связь «пригласивший → приглашённый» в памяти (поля ReferralRead)."""
+
+    id: UUID
+    referrer_id: UUID
+    referred_id: UUID
+    service_id: UUID
+    level: int
+    registered_at: dt.datetime | None
+    referral_code_id: UUID | None = None
+
+
+class _Overlay(ChainMap):
+    """Незакоммиченные связи сессии поверх общего леса."""
+
+    def __len__(self):
+        # Верхняя оценка без обхода ключей: нужна только как предел шагов
+        return sum(len(m) for m in self.maps)
+
+
+class ReferralForest:
+    """Лес рефералов одного сервиса: указатель на родителя для каждого узла."""
+
+    def __init__(self, service_id: UUID):
+        self.service_id = service_id
+        self.edges: dict[UUID, ForestEdge] = {}
+
+    def add(self, edge: ForestEdge):
+        self.edges[edge.referred_id] = edge
+
+    def set_level(self, referred_id: UUID, level: int):
+        edge = self.edges.get(referred_id)
+        if edge is not None:
+            # Связь заменяется, а не меняется на месте: её может разделять
+            # общий лес
+            self.edges[referred_id] = replace(edge, level=level)
+
+    def overlay(self, edges: dict[UUID, ForestEdge]) -> "ReferralForest":
+        """Вид леса с edges поверх; сам лес не меняется."""
+        view = ReferralForest(self.service_id)
+        view.edges = _Overlay(edges, self.edges)
+        return view
+
+    def parent(self, user_id: UUID) -> ForestEdge | None:
+        return self.edges.get(user_id)
+
+    def level(self, user_id: UUID) -> int | None:
+        edge = self.edges.get(user_id)
+        return edge.level if edge else None
+
+    def is_ancestor(self, ancestor_id: UUID, descendant_id: UUID) -> bool:
+        # Число шагов ограничено размером леса на случай битых данных
+        current = descendant_id
+        for _ in range(len(self.edges) + 1):
+            edge = self.edges.get(current)
+            if edge is None:
+                return False
+            if edge.referrer_id == ancestor_id:
+                return True
+            current = edge.referrer_id
+        return True
+
+    def chain(
+        self,
+        user_id: UUID,
+        max_depth: int | None = None,
+    ) -> list[ForestEdge]:
+        limit = min(max_depth or len(self.edges), len(self.edges))
+        result = []
+        current = user_id
+        while len(result) < limit:
+            edge = self.edges.get(current)
+            if edge is None:
+                break
+            result.append(edge)
+            current = edge.referrer_id
+        return result
+
+
+class ReferralForestCache:
+    """Ленивый кэш лесов рефералов по service_id.
+
+    Лес загружается из таблицы referrals при первом обращении. Изменения
+    сессии копятся в её буфере: сама сессия видит лес с буфером поверх,
+    а в общий лес они попадают только после commit. Без commit буфер
+    отбрасывается. Лес, прочитанный после незакоммиченной записи, тоже
+    остаётся в сессии. Кэш не видит записи других процессов, поэтому
+    включается явно (REFERRAL_FOREST_CACHE).
+    """
+
+    def __init__(self, repo: ReferralRepository | None = None):
+        self.repo = repo or ReferralRepository()
+        self._forests: dict[UUID, ReferralForest] = {}
+        self._generations: dict[UUID, int] = {}
+        self._locks: dict[UUID, asyncio.Lock] = {}
+        self._info_key = f"referral_forest_{id(self)}"
+
+    def peek(self, service_id: UUID) -> ReferralForest | None:
+        return self._forests.get(service_id)
+
+    async def get(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+    ) -> ReferralForest:
+        state = self._state(session)
+
+        forest, _ = state["loaded"].get(service_id, (None, None))
+        if forest is None and service_id not in state["stale"]:
+            forest = self._forests.get(service_id)
+        if forest is None:
+            forest = await self._load(session, state, service_id)
+
+        pending = state["pending"].get(service_id)
+        return forest.overlay(pending) if pending else forest
+
+    async def _load(
+        self,
+        session: AsyncSession,
+        state: dict,
+        service_id: UUID,
+    ) -> ReferralForest:
+        # Снимок с незакоммиченными записями сессии другим не показываем
+        private = (
+            service_id in state["stale"]
+            or session.sync_session.info.get(_FLUSHED_KEY, False)
+        )
+        lock = self._locks.setdefault(service_id, asyncio.Lock())
+        async with lock:
+            forest = None if private else self._forests.get(service_id)
+            if forest is not None:
+                return forest
+
+            generation = self._generations.get(service_id, 0)
+            forest = ReferralForest(service_id)
+            async for row in self.repo.iter_edges(session, service_id):
+                forest.add(
+                    ForestEdge(
+                        id=row.id,
+                        referrer_id=row.referrer_id,
+                        referred_id=row.referred_id,
+                        service_id=service_id,
+                        level=row.level,
+                        registered_at=row.registered_at,
+                        referral_code_id=row.referral_code_id,
+                    )
+                )
+
+            if private:
+                state["loaded"][service_id] = (forest, generation)
+            # Пока шла загрузка, лес могли изменить — такой снимок не годится
+            elif self._generations.get(service_id, 0) == generation:
+                self._forests[service_id] = forest
+            return forest
+
+    def on_register(self, session: AsyncSession, referral):
+        self._buffer(session, referral)
+
+    def on_level_update(self, session: AsyncSession, referral):
+        self._buffer(session, referral)
+
+    def on_bulk_change(self, session: AsyncSession, service_id: UUID):
+        """Массовые изменения проще перечитать, чем применять по одному.
+
+        До commit сессия читает лес заново сама, после commit общий лес
+        сбрасывается.
+        """
+        state = self._state(session)
+        state["stale"].add(service_id)
+        state["loaded"].pop(service_id, None)
+        state["pending"].pop(service_id, None)
+
+    def invalidate(self, service_id: UUID | None = None):
+        if service_id is None:
+            for key in list(self._forests):
+                self.invalidate(key)
+            return
+
+        self._bump(service_id)
+        self._forests.pop(service_id, None)
+
+    def _buffer(self, session: AsyncSession, referral):
+        state = self._state(session)
+        pending = state["pending"].setdefault(referral.service_id, {})
+        pending[referral.referred_id] = ForestEdge(
+            id=referral.id,
+            referrer_id=referral.referrer_id,
+            referred_id=referral.referred_id,
+            service_id=referral.service_id,
+            level=referral.level,
+            registered_at=referral.registered_at,
+            referral_code_id=referral.referral_code_id,
+        )
+
+    def _apply(self, state: dict):
+        for service_id in state["stale"]:
+            self.invalidate(service_id)
+
+        # После commit снимок сессии закоммичен и годится для всех, если
+        # лес за это время не меняли
+        for service_id, (forest, generation) in state["loaded"].items():
+            if self._generations.get(service_id, 0) == generation:
+                self._forests.setdefault(service_id, forest)
+
+        for service_id, edges in state["pending"].items():
+            if service_id in state["stale"]:
+                continue
+            # Загрузка, начатая до commit, этих связей не увидит
+            self._bump(service_id)
+            forest = self._forests.get(service_id)
+            if forest is not None:
+                for edge in edges.values():
+                    forest.add(edge)
+
+    def _bump(self, service_id: UUID):
+        self._generations[service_id] = (
+            self._generations.get(service_id, 0) + 1
+        )
+
+    def _state(self, session: AsyncSession) -> dict:
+        sync_session = session.sync_session
+        state = sync_session.info.get(self._info_key)
+
+        if state is None:
+            state = sync_session.info[self._info_key] = {
+                "pending": {},
+                "loaded": {},
+                "stale": set(),
+            }
+
+            def _clear():
+                state["pending"].clear()
+                state["loaded"].clear()
+                state["stale"].clear()
+
+            @event.listens_for(sync_session, "after_commit")
+            def _committed(_session):
+                self._apply(state)
+                _clear()
+
+            @event.listens_for(sync_session, "after_transaction_end")
+            def _ended(_session, transaction):
+                # После rollback буфер просто отбрасывается: общий лес
+                # незакоммиченных связей не видел
+                if transaction.parent is None:
+                    _clear()
+
+        return state
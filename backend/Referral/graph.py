@@ -0,0 +1,234 @@
+"""Компактное представление дерева рефералов сервиса.
+
+UUID пользователей заменяются плотными индексами int32, указатели на
+родителя, уровни и списки детей (CSR) хранятся в array("i").
+
+Это реализация на чистом Python, NumPy в зависимостях нет. Сборка CSR,
+обход в ширину и поиск циклов — поэлементные циклы интерпретатора,
+без векторизации. Компактны только массивы int32: словарь
+index (dict[UUID, int]) и списки users и referrals держат по объекту
+UUID на узел, и на больших сервисах память занимают в основном они, а
+не массивы. Граф меньше набора ORM-объектов, но его сборка — O(n)
+шагов интерпретатора, поэтому он строится редко: relevel раз на
+пересчёт, AncestorTableCache раз на сервис с последующим кэшированием.
+"""
+
+from array import array
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.Referral.repository import ReferralRepository
+
+
+def _zeros(size: int) -> array:
+    return array("i", bytes(4 * size))
+
+
+def compute_levels(parent: array, offsets: array, children: array) -> array:
+    """Уровни узлов обходом в ширину от корней.
+
+    Корни (parent[v] == -1) получают уровень 0, узлы, недостижимые от
+    корней (циклы и всё, что под ними), — -1.
+    """
+    levels = array("i", [-1]) * len(parent)
+    queue = array("i")
+    for v, p in enumerate(parent):
+        if p < 0:
+            levels[v] = 0
+            queue.append(v)
+
+    head = 0
+    while head < len(queue):
+        v = queue[head]
+        head += 1
+        child_level = levels[v] + 1
+        for i in range(offsets[v], offsets[v + 1]):
+            child = children[i]
+            levels[child] = child_level
+            queue.append(child)
+
+    return levels
+
+
+def find_cycles(parent: array, levels: array) -> array:
+    """on_cycle[v] == 1 для узлов, лежащих на цикле.
+
+    Узел с уровнем -1 либо лежит на цикле, либо висит под ним: подъём по
+    родителям от него всегда упирается в цикл. Цикл замыкается на узле,
+    который повторился в текущем подъёме. Каждый узел посещается один
+    раз.
+    """
+    on_cycle = _zeros(len(parent))
+    # Номер подъёма (стартовый узел), в котором узел уже пройден
+    walk = array("i", [-1]) * len(parent)
+    for start in range(len(parent)):
+        if levels[start] >= 0 or walk[start] >= 0:
+            continue
+
+        v = start
+        while walk[v] < 0:
+            walk[v] = start
+            v = parent[v]
+        if walk[v] != start:
+            continue
+
+        first = v
+        while True:
+            on_cycle[v] = 1
+            v = parent[v]
+            if v == first:
+                break
+
+    return on_cycle
+
+
+class ReferralGraph:
+    """Лес рефералов одного сервиса на плотных индексах.
+
+    users[v] — UUID узла v, parent[v] — индекс родителя или -1,
+    stored[v] — уровень входящей связи из базы (0 у корней),
+    referrals[v] — ID входящей связи (None у корней). Дети узла
+    v — children[offsets[v]:offsets[v + 1]].
+    """
+
+    def __init__(self, service_id: UUID):
+        self.service_id = service_id
+        self.index: dict[UUID, int] = {}
+        self.users: list[UUID] = []
+        self.referrals: list[UUID | None] = []
+        self.parent = array("i")
+        self.stored = array("i")
+        self.offsets = array("i", [0])
+        self.children = array("i")
+        self.edges = 0
+        self.duplicates = 0
+        self._levels: array | None = None
+        self._on_cycle: array | None = None
+
+    @classmethod
+    async def load(
+        cls,
+        session: AsyncSession,
+        service_id: UUID,
+        repo: ReferralRepository | None = None,
+    ) -> "ReferralGraph":
+        """Строит граф по потоку рёбер из таблицы referrals.
+
+        Повторные связи одного приглашённого (кроме первой) не
+        учитываются и считаются в duplicates.
+        """
+        repo = repo or ReferralRepository()
+        graph = cls(service_id)
+        async for row in repo.iter_edges(session, service_id):
+            graph.add_edge(
+                row.referrer_id, row.referred_id, row.level, row.id
+            )
+        graph.build()
+        return graph
+
+    def __len__(self):
+        return len(self.users)
+
+    def intern(self, user_id: UUID) -> int:
+        node = self.index.get(user_id)
+        if node is None:
+            node = self.index[user_id] = len(self.users)
+            self.users.append(user_id)
+            self.referrals.append(None)
+            self.parent.append(-1)
+            self.stored.append(0)
+        return node
+
+    def node(self, user_id: UUID) -> int | None:
+        return self.index.get(user_id)
+
+    def add_edge(
+        self,
+        referrer_id: UUID,
+        referred_id: UUID,
+        level: int,
+        referral_id: UUID | None = None,
+    ):
+        self.edges += 1
+        referrer = self.intern(referrer_id)
+        referred = self.intern(referred_id)
+        if self.parent[referred] != -1:
+            self.duplicates += 1
+            return
+        self.parent[referred] = referrer
+        self.stored[referred] = level
+        self.referrals[referred] = referral_id
+
+    def build(self):
+        """Собирает списки детей в формате CSR; вызывается после
+        добавления всех рёбер."""
+        size = len(self.parent)
+
+        offsets = _zeros(size + 1)
+        for p in self.parent:
+            if p >= 0:
+                offsets[p + 1] += 1
+        for v in range(size):
+            offsets[v + 1] += offsets[v]
+
+        children = _zeros(offsets[size])
+        fill = array("i", offsets)
+        for v, p in enumerate(self.parent):
+            if p >= 0:
+                children[fill[p]] = v
+                fill[p] += 1
+
+        self.offsets = offsets
+        self.children = children
+        self._levels = None
+        self._on_cycle = None
+
+    @property
+    def levels(self) -> array:
+        """Глубина узлов от корня (-1 для узлов в циклах)."""
+        if self._levels is None:
+            self._levels = compute_levels(
+                self.parent, self.offsets, self.children
+            )
+        return self._levels
+
+    @property
+    def on_cycle(self) -> array:
+        """1 для узлов на цикле; остальные узлы с уровнем -1 висят под
+        циклом."""
+        if self._on_cycle is None:
+            self._on_cycle = find_cycles(self.parent, self.levels)
+        return self._on_cycle
+
+    def children_of(self, v: int) -> array:
+        return self.children[self.offsets[v]:self.offsets[v + 1]]
+
+    def chain(self, v: int, max_depth: int | None = None) -> list[int]:
+        """Узлы-предки v от прямого родителя к корню."""
+        limit = min(max_depth or len(self.parent), len(self.parent))
+        result = []
+        current = self.parent[v]
+        while current >= 0 and len(result) < limit:
+            result.append(current)
+            current = self.parent[current]
+        return result
+
+    def downline_counts(
+        self,
+        v: int,
+        max_depth: int | None = None,
+    ) -> list[int]:
+        """counts[d - 1] — число нижестоящих v на глубине d."""
+        limit = min(max_depth or len(self.parent), len(self.parent))
+        counts = []
+        frontier = array("i", [v])
+        while len(counts) < limit:
+            next_frontier = array("i")
+            for node in frontier:
+                next_frontier.extend(self.children_of(node))
+            if not next_frontier:
+                break
+            counts.append(len(next_frontier))
+            frontier = next_frontier
+        return counts
@@ -0,0 +1,248 @@
+"""Общий предок и путь между пользователями дерева рефералов.
+
+Таблица двоичного подъёма (binary lifting) строится по ReferralGraph:
+up[k][v] — предок узла v на 2**k уровней выше. Наименьший общий
+предок находится за O(log глубины) без запросов к базе.
+"""
+
+import asyncio
+import time
+from array import array
+from uuid import UUID
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.Referral.graph import ReferralGraph
+from backend.Referral.repository import ReferralRepository
+
+
+class AncestorTable:
+    """Таблица двоичного подъёма для леса одного сервиса.
+
+    Узлы в циклах (уровень -1) в таблицу не попадают и ни с кем не
+    связаны.
+    """
+
+    def __init__(self, graph: ReferralGraph):
+        self.graph = graph
+        self.depth = graph.levels
+
+        first = array("i", graph.parent)
+        for v, depth in enumerate(self.depth):
+            if depth < 0:
+                first[v] = -1
+
+        self.up = [first]
+        max_depth = max(self.depth, default=0)
+        while (1 << len(self.up)) <= max_depth:
+            prev = self.up[-1]
+            self.up.append(
+                array("i", (prev[p] if p >= 0 else -1 for p in prev))
+            )
+
+    def add_leaf(self, referrer_id: UUID, referred_id: UUID) -> bool:
+        """Достраивает таблицу новой связью за O(log глубины).
+
+        Так можно добавить только лист: приглашённый ещё не встречался в
+        дереве. Иначе меняется глубина целого поддерева, таблицу нужно
+        строить заново — тогда возвращается False. Списки детей графа
+        (CSR) не обновляются: таблице они не нужны.
+        """
+        graph, depth, up = self.graph, self.depth, self.up
+        if graph.node(referred_id) is not None:
+            return False
+
+        parent = graph.node(referrer_id)
+        if parent is None:
+            parent = graph.intern(referrer_id)
+            depth.append(0)
+            for level in up:
+                level.append(-1)
+        elif depth[parent] < 0:
+            return False
+
+        node = graph.intern(referred_id)
+        graph.parent[node] = parent
+        graph.edges += 1
+        depth.append(depth[parent] + 1)
+
+        up[0].append(parent)
+        for k in range(1, len(up)):
+            half = up[k - 1][node]
+            up[k].append(up[k - 1][half] if half >= 0 else -1)
+
+        if (1 << len(up)) <= depth[node]:
+            prev = up[-1]
+            up.append(array("i", (prev[p] if p >= 0 else -1 for p in prev)))
+        return True
+
+    def lca(self, u: int, v: int) -> int:
+        """Индекс наименьшего общего предка или -1, если его нет."""
+        depth, up = self.depth, self.up
+        if depth[u] < 0 or depth[v] < 0:
+            return -1
+
+        if depth[u] < depth[v]:
+            u, v = v, u
+
+        diff, k = depth[u] - depth[v], 0
+        while diff:
+            if diff & 1:
+                u = up[k][u]
+            diff >>= 1
+            k += 1
+
+        if u == v:
+            return u
+
+        for level in reversed(up):
+            if level[u] != level[v]:
+                u, v = level[u], level[v]
+
+        return up[0][u]
+
+    def path(self, user_a: UUID, user_b: UUID) -> dict:
+        """Путь user_a → общий предок → user_b по UUID пользователей."""
+        graph = self.graph
+        u, v = graph.node(user_a), graph.node(user_b)
+        common = -1 if u is None or v is None else self.lca(u, v)
+
+        if common < 0:
+            return {
+                "user_a": user_a,
+                "user_b": user_b,
+                "connected": False,
+                "common_ancestor": None,
+                "distance": None,
+                "path": [],
+            }
+
+        up_path = [u]
+        while up_path[-1] != common:
+            up_path.append(graph.parent[up_path[-1]])
+
+        down_path = [v]
+        while down_path[-1] != common:
+            down_path.append(graph.parent[down_path[-1]])
+
+        nodes = up_path + down_path[-2::-1]
+        return {
+            "user_a": user_a,
+            "user_b": user_b,
+            "connected": True,
+            "common_ancestor": graph.users[common],
+            "distance": len(nodes) - 1,
+            "path": [graph.users[node] for node in nodes],
+        }
+
+
+class AncestorTableCache:
+    """Таблицы двоичного подъёма по service_id.
+
+    Таблица строится при первом обращении и живёт ttl секунд. Связи,
+    зарегистрированные этим процессом, после commit дописываются в неё
+    листьями (add_leaf); если так нельзя, таблица сбрасывается — тоже
+    после commit, чтобы параллельная загрузка не закэшировала снимок без
+    них. Записи других процессов становятся видны не позже чем через ttl.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60.0,
+        repo: ReferralRepository | None = None,
+    ):
+        self.ttl = ttl
+        self.repo = repo or ReferralRepository()
+        self._tables: dict[UUID, tuple[float, AncestorTable]] = {}
+        self._generations: dict[UUID, int] = {}
+        self._locks: dict[UUID, asyncio.Lock] = {}
+        self._info_key = f"referral_ancestors_{id(self)}"
+
+    async def get(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+    ) -> AncestorTable:
+        # Сессия со своими незакоммиченными связями видит их в отдельной
+        # таблице, общая получит их только после commit
+        if service_id in session.sync_session.info.get(self._info_key, {}):
+            graph = await ReferralGraph.load(session, service_id, self.repo)
+            return AncestorTable(graph)
+
+        cached = self._tables.get(service_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        lock = self._locks.setdefault(service_id, asyncio.Lock())
+        async with lock:
+            cached = self._tables.get(service_id)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+
+            generation = self._generations.get(service_id, 0)
+            graph = await ReferralGraph.load(session, service_id, self.repo)
+            table = AncestorTable(graph)
+
+            # Пока шла загрузка, дерево могли изменить — такой снимок
+            # отдаём только текущему запросу
+            if self._generations.get(service_id, 0) == generation:
+                self._tables[service_id] = (
+                    time.monotonic() + self.ttl,
+                    table,
+                )
+            return table
+
+    def invalidate(self, service_id: UUID | None = None):
+        if service_id is None:
+            for key in list(self._tables):
+                self.invalidate(key)
+            return
+
+        self._generations[service_id] = (
+            self._generations.get(service_id, 0) + 1
+        )
+        self._tables.pop(service_id, None)
+
+    def add_after_commit(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        edges: list[tuple[UUID, UUID]],
+    ):
+        """Дописывает связи (referrer_id, referred_id) после commit."""
+        self._pending(session).setdefault(service_id, []).extend(edges)
+
+    def _apply(self, service_id: UUID, edges: list[tuple[UUID, UUID]]):
+        # Загрузка, начатая до commit, этих связей может не увидеть
+        self._generations[service_id] = (
+            self._generations.get(service_id, 0) + 1
+        )
+        cached = self._tables.get(service_id)
+        if cached is None:
+            return
+        if not all(
+            cached[1].add_leaf(referrer_id, referred_id)
+            for referrer_id, referred_id in edges
+        ):
+            self._tables.pop(service_id, None)
+
+    def _pending(self, session: AsyncSession) -> dict:
+        sync_session = session.sync_session
+        pending = sync_session.info.get(self._info_key)
+        if pending is not None:
+            return pending
+
+        pending = sync_session.info[self._info_key] = {}
+
+        @event.listens_for(sync_session, "after_commit")
+        def _committed(_session):
+            for service_id, edges in pending.items():
+                self._apply(service_id, edges)
+
+        @event.listens_for(sync_session, "after_transaction_end")
+        def _ended(_session, transaction):
+            if transaction.parent is None:
+                pending.clear()
+
+        return pending
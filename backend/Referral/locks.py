@@ -0,0 +1,183 @@
+"""Блокировки деревьев рефералов на время транзакции.
+
+Новая связь соединяет два дерева: дерево пригласившего и дерево
+приглашённого. Регистрация блокирует корни обоих деревьев, поэтому две
+регистрации, которые вместе могли бы замкнуть цикл, выполняются по
+очереди, а регистрации в несвязанных деревьях — параллельно.
+
+В PostgreSQL используется pg_advisory_xact_lock, блокировка снимается
+вместе с транзакцией. Для остальных СУБД (SQLite в тестах и локальной
+разработке) — asyncio.Lock внутри процесса, который снимается по
+событию окончания транзакции сессии.
+"""
+
+import asyncio
+import hashlib
+from contextlib import contextmanager
+from uuid import UUID
+
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.Referral.repository import ReferralRepository
+
+# Сколько раз перечитывать корни, если деревья успели объединиться
+# между чтением корней и взятием блокировок
+MAX_LOCK_ROUNDS = 10
+
+# Сколько секунд ждать блокировку внутри процесса. Транзакция, которая
+# уже держит деревья от прошлых регистраций, может взять новые не по
+# порядку; таймаут разрывает такую взаимную блокировку, как это делает
+# PostgreSQL для advisory-блокировок.
+LOCK_TIMEOUT = 10.0
+
+# SQLSTATE, с которым PostgreSQL откатывает жертву взаимной блокировки
+DEADLOCK_DETECTED = "40P01"
+
+TREE_BUSY = "Referral tree is busy, retry later"
+
+
+def tree_lock_key(service_id: UUID, root_id: UUID) -> int:
+    """Ключ блокировки дерева — знаковое 64-битное число."""
+    digest = hashlib.blake2b(
+        service_id.bytes + root_id.bytes, digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+@contextmanager
+def deadlock_as_busy():
+    """Взаимная блокировка в PostgreSQL — ValueError(TREE_BUSY), как и
+    таймаут блокировки внутри процесса.
+
+    Повторить внутри транзакции нельзя: СУБД её уже откатила. Повторяет
+    клиент, получив 400.
+    """
+    try:
+        yield
+    except DBAPIError as e:
+        if getattr(e.orig, "pgcode", None) != DEADLOCK_DETECTED:
+            raise
+        raise ValueError(TREE_BUSY) from e
+
+
+class TreeLocks:
+    def __init__(
+        self,
+        repo: ReferralRepository | None = None,
+        timeout: float = LOCK_TIMEOUT,
+    ):
+        self.repo = repo or ReferralRepository()
+        self.timeout = timeout
+        # ключ → [блокировка, число владельцев и ожидающих]
+        self._locks: dict[int, list] = {}
+        self._info_key = f"referral_tree_locks_{id(self)}"
+
+    async def lock_trees(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids,
+        by_walk: bool = False,
+    ):
+        """Блокирует до конца транзакции деревья, в которые входят
+        user_ids.
+
+        Корни читаются до взятия блокировок, поэтому после них корни
+        перечитываются: если дерево успело прицепиться к другому,
+        блокируется и новый корень. by_walk — искать корни по referrals,
+        пока замыкание сервиса не заполнено backfill.
+        """
+        held = self._held(session)
+        local = self._is_local(session)
+        taken = []
+        for _ in range(MAX_LOCK_ROUNDS):
+            roots = await self.repo.get_roots_for(
+                session, service_id, user_ids, by_walk=by_walk
+            )
+            keys = {tree_lock_key(service_id, r) for r in roots.values()}
+
+            # Порядок взятия одинаков для всех — без взаимных блокировок
+            missing = sorted(keys - held)
+            if not missing:
+                return
+
+            # Новый корень меньше уже взятых в этом вызове: чтобы не
+            # нарушить порядок, отпускаем их и берём всё заново. Данные
+            # до этого момента не менялись, так что отпускать безопасно.
+            # Advisory-блокировки PostgreSQL до конца транзакции не
+            # отпускаются, взаимную блокировку там разрешит сама СУБД
+            # (см. deadlock_as_busy).
+            if local and taken and missing[0] < max(taken):
+                for key in taken:
+                    self._unlock(session, key)
+                    held.discard(key)
+                taken = []
+                missing = sorted(keys - held)
+
+            for key in missing:
+                await self._acquire(session, key)
+                held.add(key)
+                taken.append(key)
+
+        raise ValueError(TREE_BUSY)
+
+    def _is_local(self, session: AsyncSession) -> bool:
+        return session.get_bind().dialect.name != "postgresql"
+
+    async def _acquire(self, session: AsyncSession, key: int):
+        if not self._is_local(session):
+            await session.execute(select(func.pg_advisory_xact_lock(key)))
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await asyncio.wait_for(entry[0].acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._forget(key)
+            raise ValueError(TREE_BUSY)
+        except BaseException:
+            self._forget(key)
+            raise
+        self._state(session)["acquired"].append(key)
+
+    def _unlock(self, session: AsyncSession, key: int):
+        self._state(session)["acquired"].remove(key)
+        self._release(key)
+
+    def _release(self, key: int):
+        self._locks[key][0].release()
+        self._forget(key)
+
+    def _forget(self, key: int):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[key]
+
+    def _held(self, session: AsyncSession) -> set[int]:
+        return self._state(session)["held"]
+
+    def _state(self, session: AsyncSession) -> dict:
+        sync_session = session.sync_session
+        state = sync_session.info.get(self._info_key)
+        if state is not None:
+            return state
+
+        state = sync_session.info[self._info_key] = {
+            "held": set(),
+            "acquired": [],
+        }
+
+        @event.listens_for(sync_session, "after_transaction_end")
+        def _ended(_session, transaction):
+            if transaction.parent is not None:
+                return
+            for key in state["acquired"]:
+                self._release(key)
+            state["acquired"].clear()
+            state["held"].clear()
+
+        return state
@@ -1,7 +1,20 @@
+import random
 import uuid
 import datetime as dt
+from collections import Counter
 from sqlalchemy.sql import func
-from sqlalchemy import DateTime, ForeignKey, Integer
+from sqlalchemy import (
+    BigInteger,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    event,
+    insert,
+    inspect,
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import (
@@ -11,12 +24,14 @@ from sqlalchemy.orm import (
 )
 
 from backend.database.db import Base
+from backend.database.dialect import current_txid, upsert_insert
 
 
 class Referral(AsyncAttrs, Base):
     """ORM-модель реферальной связи."""
 
     __tablename__ = "referrals"
+    __mapper_args__ = {"eager_defaults": True}
 
     # Поля таблицы
     id: Mapped[uuid.UUID] = mapped_column(
@@ -60,11 +75,34 @@ class Referral(AsyncAttrs, Base):
         doc="Уровень реферала: 1 — прямой, 2 — реферал реферала и т.д.",
     )
 
-    registered_at: Mapped[dt.datetime | None] = mapped_column(
+    registered_at: Mapped[dt.datetime] = mapped_column(
         DateTime(timezone=True),
+        nullable=False,
         server_default=func.now(),
     )
 
+    __table_args__ = (
+        # У пользователя не больше одного пригласившего в сервисе; в
+        # существующих базах создаётся миграцией 3b1f0c9d2e47 вместе с
+        # удалением повторов
+        Index(
+            "ux_referrals_service_referred",
+            "service_id",
+            "referred_id",
+            unique=True,
+        ),
+        # Keyset-пагинация рефералов пользователя; покрывает и поиск
+        # по (service_id, referrer_id). ORDER BY страницы идёт по самим
+        # колонкам, поэтому registered_at NOT NULL (миграция 8077e29e071e)
+        Index(
+            "ix_referrals_referrer_keyset",
+            "service_id",
+            "referrer_id",
+            "registered_at",
+            "id",
+        ),
+    )
+
     # ORM-связи
     referrer = relationship(
         "User",
@@ -91,3 +129,550 @@ class Referral(AsyncAttrs, Base):
         back_populates="referrals",
         doc="Реферальный код, использованный при регистрации (если был).",
     )
+
+
+class ReferralClosure(Base):
+    """Таблица замыкания дерева рефералов: все пары предок — потомок."""
+
+    __tablename__ = "referral_closure"
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        primary_key=True,
+        doc="ID сервиса, в рамках которого построено дерево.",
+    )
+
+    ancestor_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id"),
+        primary_key=True,
+        doc="ID пользователя-предка.",
+    )
+
+    descendant_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id"),
+        primary_key=True,
+        doc="ID пользователя-потомка.",
+    )
+
+    depth: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        doc="Расстояние между предком и потомком: 1 — прямой реферал.",
+    )
+
+    __table_args__ = (
+        Index(
+            "ix_referral_closure_descendant",
+            "service_id",
+            "descendant_id",
+        ),
+        # Счётчики и keyset-пагинация нижестоящих по глубине
+        Index(
+            "ix_referral_closure_ancestor_depth",
+            "service_id",
+            "ancestor_id",
+            "depth",
+            "descendant_id",
+        ),
+    )
+
+
+# Шаги заполнения производных таблиц по уже существующим связям
+BACKFILL_CLOSURE = "closure"
+BACKFILL_DAILY_STATS = "daily_stats"
+BACKFILL_LEADERBOARD = "leaderboard"
+
+
+class ReferralBackfill(Base):
+    """Завершённые шаги заполнения производных таблиц сервиса.
+
+    Связи, записанные до появления таблицы, в неё не попадают, пока не
+    выполнен соответствующий шаг (python -m backend.Referral.backfill).
+    """
+
+    __tablename__ = "referral_backfills"
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        primary_key=True,
+        doc="ID сервиса.",
+    )
+
+    step: Mapped[str] = mapped_column(
+        String(32),
+        primary_key=True,
+        doc="Шаг заполнения, например closure.",
+    )
+
+    finished_at: Mapped[dt.datetime | None] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+    )
+
+
+# Строк-слотов на один счётчик referral_daily_stats
+DAILY_STATS_SLOTS = 8
+
+
+class ReferralDailyStats(Base):
+    """Накопительные счётчики рефералов по уровню и дню регистрации.
+
+    Все регистрации сервиса за день попадают в один счётчик уровня, а
+    его строка заблокирована до commit. Чтобы регистрации не ждали друг
+    друга, счётчик разложен на DAILY_STATS_SLOTS строк: запись идёт в
+    случайный слот, при чтении слоты суммируются.
+    """
+
+    __tablename__ = "referral_daily_stats"
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        primary_key=True,
+        doc="ID сервиса.",
+    )
+
+    level: Mapped[int] = mapped_column(
+        Integer,
+        primary_key=True,
+        doc="Уровень реферала.",
+    )
+
+    day: Mapped[dt.date] = mapped_column(
+        Date,
+        primary_key=True,
+        doc="День регистрации (UTC).",
+    )
+
+    slot: Mapped[int] = mapped_column(
+        Integer,
+        primary_key=True,
+        default=0,
+        doc="Слот счётчика, от 0 до DAILY_STATS_SLOTS - 1.",
+    )
+
+    count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        doc="Число рефералов с этим уровнем, зарегистрированных в этот день.",
+    )
+
+
+class ReferrerDailyCount(Base):
+    """Число приглашённых пользователем за день — основа окон рейтинга."""
+
+    __tablename__ = "referrer_daily_counts"
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        primary_key=True,
+        doc="ID сервиса.",
+    )
+
+    referrer_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id"),
+        primary_key=True,
+        doc="ID пригласившего пользователя.",
+    )
+
+    day: Mapped[dt.date] = mapped_column(
+        Date,
+        primary_key=True,
+        doc="День регистрации (UTC).",
+    )
+
+    count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        doc="Число приглашённых за этот день.",
+    )
+
+
+class ReferrerLeaderboard(Base):
+    """Рейтинг пригласивших: готовые счётчики для каждого окна."""
+
+    __tablename__ = "referrer_leaderboard"
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        primary_key=True,
+        doc="ID сервиса.",
+    )
+
+    period: Mapped[str] = mapped_column(
+        String(8),
+        primary_key=True,
+        doc="Окно рейтинга: all, 30d или 7d.",
+    )
+
+    referrer_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("users.id"),
+        primary_key=True,
+        doc="ID пригласившего пользователя.",
+    )
+
+    count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        doc="Число приглашённых в пределах окна.",
+    )
+
+    __table_args__ = (
+        # Первые N строк рейтинга читаются по индексу без сортировки
+        Index(
+            "ix_referrer_leaderboard_rank",
+            "service_id",
+            "period",
+            "count",
+            "referrer_id",
+        ),
+    )
+
+
+class ReferrerLeaderboardWindow(Base):
+    """День, на который пересчитано скользящее окно рейтинга."""
+
+    __tablename__ = "referrer_leaderboard_windows"
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        primary_key=True,
+        doc="ID сервиса.",
+    )
+
+    period: Mapped[str] = mapped_column(
+        String(8),
+        primary_key=True,
+        doc="Окно рейтинга: 30d или 7d.",
+    )
+
+    as_of: Mapped[dt.date] = mapped_column(
+        Date,
+        nullable=False,
+        doc="День (UTC), на который пересчитано окно.",
+    )
+
+
+class ReferralChange(Base):
+    """Журнал изменений связей сервиса для инкрементальной выгрузки.
+
+    Номер seq выдаёт последовательность, без общей строки-счётчика, так
+    что транзакции не ждут друг друга. Номера выдаются до commit, и
+    изменение с меньшим номером может закоммититься позже. Поэтому
+    журнал читается по (txid, seq) и только до visible_txid_limit: все
+    транзакции левее этой границы завершены, а новые записи окажутся
+    правее.
+    """
+
+    __tablename__ = "referral_changes"
+
+    seq: Mapped[int] = mapped_column(
+        BigInteger().with_variant(Integer, "sqlite"),
+        primary_key=True,
+        autoincrement=True,
+        doc="Номер изменения, возрастает в пределах всего журнала.",
+    )
+
+    txid: Mapped[int] = mapped_column(
+        BigInteger,
+        nullable=False,
+        default=current_txid(),
+        doc="ID транзакции, записавшей изменение.",
+    )
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        nullable=False,
+        doc="ID сервиса.",
+    )
+
+    referral_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("referrals.id"),
+        nullable=False,
+        doc="ID изменённой связи.",
+    )
+
+    kind: Mapped[str] = mapped_column(
+        String(16),
+        nullable=False,
+        doc="Что произошло: created или level.",
+    )
+
+    changed_at: Mapped[dt.datetime | None] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+    )
+
+    __table_args__ = (
+        # Чтение журнала сервиса по токену (txid, seq)
+        Index(
+            "ix_referral_changes_feed",
+            "service_id",
+            "txid",
+            "seq",
+        ),
+    )
+
+
+class ReferralExportJob(Base):
+    """Фоновая выгрузка рефералов сервиса в файл."""
+
+    __tablename__ = "referral_export_jobs"
+
+    id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        primary_key=True,
+        default=uuid.uuid4,
+        doc="UUID задачи.",
+    )
+
+    service_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("external_services.id"),
+        nullable=False,
+        doc="ID сервиса, связи которого выгружаются.",
+    )
+
+    format: Mapped[str] = mapped_column(
+        String(16),
+        nullable=False,
+        doc="Формат выгрузки (см. EXPORT_FORMATS).",
+    )
+
+    status: Mapped[str] = mapped_column(
+        String(16),
+        nullable=False,
+        default="pending",
+        doc="pending, running, done или failed.",
+    )
+
+    rows: Mapped[int | None] = mapped_column(
+        Integer,
+        nullable=True,
+        doc="Сколько строк выгружено (после завершения).",
+    )
+
+    total: Mapped[int | None] = mapped_column(
+        Integer,
+        nullable=True,
+        doc="Ожидаемое число строк по счётчикам статистики.",
+    )
+
+    size: Mapped[int | None] = mapped_column(
+        BigInteger,
+        nullable=True,
+        doc="Размер готового файла в байтах.",
+    )
+
+    error: Mapped[str | None] = mapped_column(
+        String(255),
+        nullable=True,
+        doc="Причина ошибки для status = failed.",
+    )
+
+    created_at: Mapped[dt.datetime | None] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+    )
+
+    finished_at: Mapped[dt.datetime | None] = mapped_column(
+        DateTime(timezone=True),
+        nullable=True,
+    )
+
+    expires_at: Mapped[dt.datetime | None] = mapped_column(
+        DateTime(timezone=True),
+        nullable=True,
+        doc="Когда задача и её файл будут удалены.",
+    )
+
+
+# Виды изменений в журнале referral_changes
+CHANGE_CREATED = "created"
+CHANGE_LEVEL = "level"
+
+
+# Окна рейтинга пригласивших: название → длина в днях (None — всё время)
+LEADERBOARD_WINDOWS = {"all": None, "30d": 30, "7d": 7}
+
+
+def stats_day(registered_at: dt.datetime | None) -> dt.date:
+    """День регистрации в UTC — ключ таблиц со счётчиками."""
+    if registered_at is None:
+        return dt.datetime.now(dt.timezone.utc).date()
+    if registered_at.tzinfo is not None:
+        registered_at = registered_at.astimezone(dt.timezone.utc)
+    return registered_at.date()
+
+
+def leaderboard_windows_for(day: dt.date, today: dt.date) -> list[str]:
+    """Окна рейтинга, в которые попадает регистрация за день day."""
+    return [
+        name
+        for name, days in LEADERBOARD_WINDOWS.items()
+        if days is None or day > today - dt.timedelta(days=days)
+    ]
+
+
+def counter_upsert(dialect_name: str, table, keys: list[str], rows):
+    """Прибавляет rows[i]["count"] к счётчикам table одним запросом.
+
+    keys — первичный ключ таблицы. Возвращает None, если прибавлять
+    нечего.
+    """
+    rows = [row for row in rows if row["count"]]
+    if not rows:
+        return None
+
+    stmt = upsert_insert(dialect_name, table).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c[key] for key in keys],
+        set_={"count": table.c.count + stmt.excluded.count},
+    )
+
+
+def daily_stats_upsert(
+    dialect_name: str,
+    service_id: uuid.UUID,
+    deltas: dict[tuple[int, dt.date], int],
+):
+    """Прибавляет deltas[(level, day)] к счётчикам referral_daily_stats.
+
+    Весь запрос пишет в один случайный слот.
+    """
+    slot = random.randrange(DAILY_STATS_SLOTS)
+    return counter_upsert(
+        dialect_name,
+        ReferralDailyStats.__table__,
+        ["service_id", "level", "day", "slot"],
+        [
+            {
+                "service_id": service_id,
+                "level": lvl,
+                "day": day,
+                "slot": slot,
+                "count": n,
+            }
+            for (lvl, day), n in deltas.items()
+        ],
+    )
+
+
+def referrer_counts_upserts(
+    dialect_name: str,
+    service_id: uuid.UUID,
+    deltas: dict[tuple[uuid.UUID, dt.date], int],
+):
+    """Запросы, прибавляющие deltas[(referrer_id, day)] к дневным
+    счётчикам пригласивших и к подходящим окнам рейтинга."""
+    today = stats_day(None)
+
+    leaderboard = Counter()
+    for (referrer_id, day), n in deltas.items():
+        for period in leaderboard_windows_for(day, today):
+            leaderboard[(period, referrer_id)] += n
+
+    stmts = [
+        counter_upsert(
+            dialect_name,
+            ReferrerDailyCount.__table__,
+            ["service_id", "referrer_id", "day"],
+            [
+                {
+                    "service_id": service_id,
+                    "referrer_id": referrer_id,
+                    "day": day,
+                    "count": n,
+                }
+                for (referrer_id, day), n in deltas.items()
+            ],
+        ),
+        counter_upsert(
+            dialect_name,
+            ReferrerLeaderboard.__table__,
+            ["service_id", "period", "referrer_id"],
+            [
+                {
+                    "service_id": service_id,
+                    "period": period,
+                    "referrer_id": referrer_id,
+                    "count": n,
+                }
+                for (period, referrer_id), n in leaderboard.items()
+            ],
+        ),
+    ]
+    return [stmt for stmt in stmts if stmt is not None]
+
+
+def change_rows(
+    service_id: uuid.UUID,
+    referral_ids: list[uuid.UUID],
+    kind: str,
+) -> list[dict]:
+    """Строки журнала; seq и txid заполняет база."""
+    return [
+        {"service_id": service_id, "referral_id": referral_id, "kind": kind}
+        for referral_id in referral_ids
+    ]
+
+
+def _log_change(connection, target, kind: str):
+    connection.execute(
+        insert(ReferralChange),
+        change_rows(target.service_id, [target.id], kind),
+    )
+
+
+# Счётчики и журнал изменений ведутся в той же транзакции, что и сами
+# связи, поэтому их учитывает любая вставка или смена уровня через ORM.
+# Запросы в обход ORM обновляют их сами (см. ReferralRepository).
+@event.listens_for(Referral, "after_insert")
+def _count_inserted(mapper, connection, target):
+    dialect_name = connection.dialect.name
+    day = stats_day(target.registered_at)
+
+    stmts = [
+        daily_stats_upsert(
+            dialect_name, target.service_id, {(target.level, day): 1}
+        ),
+        *referrer_counts_upserts(
+            dialect_name, target.service_id, {(target.referrer_id, day): 1}
+        ),
+    ]
+    for stmt in stmts:
+        connection.execute(stmt)
+    _log_change(connection, target, CHANGE_CREATED)
+
+
+@event.listens_for(Referral, "after_update")
+def _count_level_change(mapper, connection, target):
+    history = inspect(target).attrs.level.history
+    if not history.deleted or not history.added:
+        return
+
+    day = stats_day(target.registered_at)
+    deltas = Counter()
+    deltas[(history.deleted[0], day)] -= 1
+    deltas[(history.added[0], day)] += 1
+
+    stmt = daily_stats_upsert(
+        connection.dialect.name, target.service_id, deltas
+    )
+    if stmt is not None:
+        connection.execute(stmt)
+    _log_change(connection, target, CHANGE_LEVEL)
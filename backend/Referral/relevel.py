@@ -0,0 +1,140 @@
+"""Пересчёт уровней всех связей сервиса.
+
+Уровни считаются по тем же правилам, что и при регистрации
+(ReferralService._calculate_level): связь с корнем дерева — 1, дальше
+уровень родителя + 1. Связи читаются потоком в ReferralGraph, в базу
+пишутся только изменившиеся уровни.
+
+Запуск из командной строки:
+
+    python -m backend.Referral.relevel <service_id> [--dry-run]
+"""
+
+import argparse
+import asyncio
+import json
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.Referral.graph import ReferralGraph
+from backend.Referral.repository import BATCH_SIZE, ReferralRepository
+
+# Сколько примеров циклов, узлов под циклами и «висящих» связей
+# попадает в отчёт
+REPORT_SAMPLE = 100
+
+
+async def relevel_service(
+    session: AsyncSession,
+    service_id: UUID,
+    repo: ReferralRepository | None = None,
+    dry_run: bool = False,
+) -> dict:
+    """Пересчитывает уровни связей сервиса и возвращает отчёт.
+
+    Связи, недостижимые от корней, не меняются и перечисляются в отчёте
+    (по ID приглашённого) двумя списками: узлы самих циклов и узлы,
+    висящие под циклом. Повторные связи одного приглашённого (кроме
+    первой) не участвуют в расчёте. При dry_run база не меняется.
+    """
+    repo = repo or ReferralRepository()
+    graph = await ReferralGraph.load(session, service_id, repo)
+    users, parent, stored = graph.users, graph.parent, graph.stored
+    levels, on_cycle = graph.levels, graph.on_cycle
+
+    cycles = 0
+    cycle_users = []
+    below_cycles = 0
+    below_cycle_users = []
+    updated = 0
+    batch = []
+    for v, p in enumerate(parent):
+        if p < 0:
+            continue
+        if levels[v] < 0:
+            if on_cycle[v]:
+                cycles += 1
+                if len(cycle_users) < REPORT_SAMPLE:
+                    cycle_users.append(users[v])
+            else:
+                below_cycles += 1
+                if len(below_cycle_users) < REPORT_SAMPLE:
+                    below_cycle_users.append(users[v])
+            continue
+        if levels[v] == stored[v]:
+            continue
+
+        updated += 1
+        batch.append((graph.referrals[v], levels[v]))
+        if len(batch) >= BATCH_SIZE:
+            if not dry_run:
+                await repo.bulk_update_levels(session, service_id, batch)
+            batch = []
+
+    if batch and not dry_run:
+        await repo.bulk_update_levels(session, service_id, batch)
+
+    orphans = 0
+    orphan_referrals = []
+    async for referral_id in repo.iter_orphan_edges(session, service_id):
+        orphans += 1
+        if len(orphan_referrals) < REPORT_SAMPLE:
+            orphan_referrals.append(referral_id)
+
+    if updated and not dry_run:
+        await repo.rebuild_daily_stats(session, service_id)
+        await repo.refresh_loaded(session)
+
+    return {
+        "service_id": service_id,
+        "edges": graph.edges,
+        "updated": updated,
+        "cycles": cycles,
+        "below_cycles": below_cycles,
+        "duplicates": graph.duplicates,
+        "orphans": orphans,
+        "cycle_users": cycle_users,
+        "below_cycle_users": below_cycle_users,
+        "orphan_referrals": orphan_referrals,
+        "dry_run": dry_run,
+    }
+
+
+async def _main(service_id: UUID, dry_run: bool):
+    # Все модели должны быть загружены до первого запроса
+    import backend.ExternalService.models  # noqa: F401
+    import backend.ReferralCode.models  # noqa: F401
+    import backend.User.models  # noqa: F401
+    from backend.config import db_settings
+    from backend.database.db import db
+
+    db.init(db_settings.url, echo=db_settings.echo)
+    try:
+        async with db.get_session() as session:
+            report = await relevel_service(
+                session, service_id, dry_run=dry_run
+            )
+            await session.commit()
+    finally:
+        await db.dispose()
+
+    print(json.dumps(report, default=str, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Пересчёт уровней рефералов сервиса",
+    )
+    parser.add_argument("service_id", type=UUID)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="только отчёт, без записи в базу",
+    )
+    args = parser.parse_args()
+    asyncio.run(_main(args.service_id, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,61 @@
+from collections import Counter
+from datetime import date, datetime, timedelta
 from uuid import UUID
 
-from sqlalchemy import func, select
+from sqlalchemy import (
+    bindparam,
+    delete,
+    func,
+    insert,
+    literal,
+    literal_column,
+    or_,
+    select,
+    true,
+    tuple_,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
-from backend.Referral.models import Referral
+from backend.database.dialect import upsert_insert, visible_txid_limit
+from backend.database.pagination import (
+    decode_cursor,
+    encode_cursor,
+    paginate,
+)
+from backend.Referral.models import (
+    CHANGE_CREATED,
+    CHANGE_LEVEL,
+    LEADERBOARD_WINDOWS,
+    Referral,
+    ReferralBackfill,
+    ReferralChange,
+    ReferralClosure,
+    ReferralDailyStats,
+    ReferralExportJob,
+    ReferrerDailyCount,
+    ReferrerLeaderboard,
+    ReferrerLeaderboardWindow,
+    change_rows,
+    daily_stats_upsert,
+    referrer_counts_upserts,
+    stats_day,
+)
+
+# Защита рекурсивных запросов от зацикливания на повреждённых данных.
+MAX_TREE_DEPTH = 10_000
+
+# Размер пачки для IN (...) и многострочных INSERT.
+BATCH_SIZE = 1000
+
+
+def _chunks(items, size=BATCH_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 
 class ReferralRepository:
@@ -12,6 +64,565 @@ class ReferralRepository:
         await session.flush()
         return referral
 
+    async def create_if_absent(
+        self,
+        session: AsyncSession,
+        values: dict,
+    ) -> Referral | None:
+        """Вставляет связь одним INSERT ... ON CONFLICT DO NOTHING RETURNING.
+
+        Возвращает None, если у приглашённого уже есть пригласивший в
+        этом сервисе. Обработчики ORM при такой вставке не срабатывают,
+        поэтому счётчики обновляются здесь же.
+        """
+        stmt = (
+            upsert_insert(session.get_bind().dialect.name, Referral)
+            .values(**values)
+            .on_conflict_do_nothing(
+                index_elements=[Referral.service_id, Referral.referred_id],
+            )
+            .returning(Referral)
+        )
+        referral = (await session.execute(stmt)).scalar_one_or_none()
+        if referral is None:
+            return None
+
+        day = stats_day(referral.registered_at)
+        await self.add_daily_stats(
+            session, referral.service_id, {(referral.level, day): 1}
+        )
+        await self.add_referrer_counts(
+            session, referral.service_id, {(referral.referrer_id, day): 1}
+        )
+        await self.add_changes(
+            session, referral.service_id, [referral.id], CHANGE_CREATED
+        )
+        return referral
+
+    async def add_closure(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        referrer_id: UUID,
+        referred_id: UUID,
+    ):
+        """Добавляет в замыкание все пары для новой связи одним запросом.
+
+        Каждый предок пригласившего (и он сам) становится предком
+        приглашённого и всего его уже существующего поддерева.
+        """
+        ancestors = union_all(
+            select(
+                ReferralClosure.ancestor_id.label("node_id"),
+                ReferralClosure.depth.label("depth"),
+            ).where(
+                ReferralClosure.service_id == service_id,
+                ReferralClosure.descendant_id == referrer_id,
+            ),
+            select(
+                literal(referrer_id, PG_UUID(as_uuid=True)),
+                literal_column("0"),
+            ),
+        ).subquery("ancestors")
+
+        descendants = union_all(
+            select(
+                ReferralClosure.descendant_id.label("node_id"),
+                ReferralClosure.depth.label("depth"),
+            ).where(
+                ReferralClosure.service_id == service_id,
+                ReferralClosure.ancestor_id == referred_id,
+            ),
+            select(
+                literal(referred_id, PG_UUID(as_uuid=True)),
+                literal_column("0"),
+            ),
+        ).subquery("descendants")
+
+        stmt = insert(ReferralClosure).from_select(
+            ["service_id", "ancestor_id", "descendant_id", "depth"],
+            select(
+                literal(service_id, PG_UUID(as_uuid=True)),
+                ancestors.c.node_id,
+                descendants.c.node_id,
+                ancestors.c.depth + descendants.c.depth + 1,
+            ).select_from(ancestors.join(descendants, true())),
+        )
+        await session.execute(stmt)
+
+    async def is_ancestor(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        ancestor_id: UUID,
+        descendant_id: UUID,
+    ) -> bool:
+        stmt = select(
+            select(ReferralClosure.depth)
+            .where(
+                ReferralClosure.service_id == service_id,
+                ReferralClosure.ancestor_id == ancestor_id,
+                ReferralClosure.descendant_id == descendant_id,
+            )
+            .exists()
+        )
+        return bool(await session.scalar(stmt))
+
+    async def rebuild_closure(self, session: AsyncSession, service_id: UUID):
+        """Пересобирает замыкание сервиса по таблице referrals.
+
+        Нужна для данных, записанных до появления таблицы замыкания.
+        """
+        tree = (
+            select(
+                Referral.referrer_id.label("ancestor_id"),
+                Referral.referred_id.label("descendant_id"),
+                literal_column("1").label("depth"),
+            )
+            .where(Referral.service_id == service_id)
+            .cte("tree", recursive=True)
+        )
+        tree = tree.union_all(
+            select(
+                tree.c.ancestor_id,
+                Referral.referred_id,
+                tree.c.depth + 1,
+            )
+            .join(Referral, Referral.referrer_id == tree.c.descendant_id)
+            .where(
+                Referral.service_id == service_id,
+                tree.c.depth < MAX_TREE_DEPTH,
+            )
+        )
+
+        await session.execute(
+            delete(ReferralClosure).where(
+                ReferralClosure.service_id == service_id,
+            )
+        )
+        # Пары, которые успела добавить параллельная регистрация, уже
+        # верны — конфликт с ними не ошибка
+        dialect = session.get_bind().dialect.name
+        await session.execute(
+            upsert_insert(dialect, ReferralClosure)
+            .from_select(
+                ["service_id", "ancestor_id", "descendant_id", "depth"],
+                select(
+                    literal(service_id, PG_UUID(as_uuid=True)),
+                    tree.c.ancestor_id,
+                    tree.c.descendant_id,
+                    func.min(tree.c.depth),
+                )
+                .where(true())
+                .group_by(tree.c.ancestor_id, tree.c.descendant_id),
+            )
+            .on_conflict_do_nothing()
+        )
+
+    async def is_ancestor_by_walk(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        ancestor_id: UUID,
+        descendant_id: UUID,
+    ) -> bool:
+        """is_ancestor подъёмом по referrals, без таблицы замыкания.
+
+        UNION (а не UNION ALL) отбрасывает повторы, поэтому запрос
+        завершается и на циклах в старых данных.
+        """
+        up = (
+            select(Referral.referrer_id.label("user_id"))
+            .where(
+                Referral.service_id == service_id,
+                Referral.referred_id == descendant_id,
+            )
+            .cte("up", recursive=True)
+        )
+        up = up.union(
+            select(Referral.referrer_id)
+            .join(up, Referral.referred_id == up.c.user_id)
+            .where(Referral.service_id == service_id)
+        )
+        stmt = select(
+            select(up.c.user_id).where(up.c.user_id == ancestor_id).exists()
+        )
+        return bool(await session.scalar(stmt))
+
+    async def get_ancestors_by_walk(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids,
+    ) -> list[tuple[UUID, UUID, int]]:
+        """get_ancestors_for подъёмом по referrals, без таблицы замыкания."""
+        parent = {}
+        for edge in await self.get_chains_for(session, service_id, user_ids):
+            parent.setdefault(edge.referred_id, edge.referrer_id)
+
+        rows = []
+        for user_id in set(user_ids):
+            seen = {user_id}
+            node, depth = parent.get(user_id), 1
+            while node is not None and node not in seen:
+                rows.append((user_id, node, depth))
+                seen.add(node)
+                node, depth = parent.get(node), depth + 1
+        return rows
+
+    async def has_referrals(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+    ) -> bool:
+        stmt = select(
+            select(Referral.id)
+            .where(Referral.service_id == service_id)
+            .exists()
+        )
+        return bool(await session.scalar(stmt))
+
+    async def is_backfilled(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        step: str,
+    ) -> bool:
+        return (
+            await session.get(ReferralBackfill, (service_id, step))
+        ) is not None
+
+    async def mark_backfilled(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        step: str,
+    ):
+        dialect = session.get_bind().dialect.name
+        await session.execute(
+            upsert_insert(dialect, ReferralBackfill)
+            .values(service_id=service_id, step=step)
+            .on_conflict_do_nothing()
+        )
+
+    async def get_service_ids(self, session: AsyncSession) -> list[UUID]:
+        """Сервисы, у которых есть хотя бы одна связь."""
+        stmt = select(Referral.service_id).distinct()
+        return list((await session.execute(stmt)).scalars())
+
+    def _downline_walk(
+        self,
+        service_id: UUID,
+        user_id: UUID,
+        max_depth: int | None = None,
+    ):
+        """Нижестоящие (descendant_id, depth) спуском по referrals, без
+        таблицы замыкания. Строки совпадают с выборкой из замыкания по
+        ancestor_id == user_id."""
+        down = (
+            select(
+                Referral.referred_id.label("descendant_id"),
+                literal_column("1").label("depth"),
+            )
+            .where(
+                Referral.service_id == service_id,
+                Referral.referrer_id == user_id,
+            )
+            .cte("down", recursive=True)
+        )
+        limit = MAX_TREE_DEPTH
+        if max_depth is not None:
+            limit = min(limit, max_depth)
+        down = down.union_all(
+            select(Referral.referred_id, down.c.depth + 1)
+            .join(down, Referral.referrer_id == down.c.descendant_id)
+            .where(
+                Referral.service_id == service_id,
+                down.c.depth < limit,
+            )
+        )
+        # На цикле в старых данных узел встречается многократно — берётся
+        # кратчайшая глубина, как в rebuild_closure
+        return (
+            select(
+                down.c.descendant_id,
+                func.min(down.c.depth).label("depth"),
+            )
+            .where(down.c.descendant_id != user_id)
+            .group_by(down.c.descendant_id)
+            .subquery("downline")
+        )
+
+    async def get_downline_counts(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_id: UUID,
+        max_depth: int | None = None,
+        by_walk: bool = False,
+    ):
+        """Число нижестоящих пользователя по глубине: (depth, count).
+
+        by_walk — считать спуском по referrals, пока замыкание сервиса не
+        заполнено backfill.
+        """
+        if by_walk:
+            down = self._downline_walk(service_id, user_id, max_depth)
+            stmt = (
+                select(down.c.depth, func.count().label("count"))
+                .group_by(down.c.depth)
+                .order_by(down.c.depth)
+            )
+            res = await session.execute(stmt)
+            return res.all()
+
+        stmt = select(
+            ReferralClosure.depth,
+            func.count().label("count"),
+        ).where(
+            ReferralClosure.service_id == service_id,
+            ReferralClosure.ancestor_id == user_id,
+        )
+        if max_depth is not None:
+            stmt = stmt.where(ReferralClosure.depth <= max_depth)
+
+        stmt = stmt.group_by(ReferralClosure.depth).order_by(
+            ReferralClosure.depth
+        )
+        res = await session.execute(stmt)
+        return res.all()
+
+    async def get_downline_page(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_id: UUID,
+        limit: int,
+        cursor: str | None = None,
+        max_depth: int | None = None,
+        by_walk: bool = False,
+    ):
+        """Страница нижестоящих, упорядоченных по (depth, descendant_id).
+
+        by_walk — как в get_downline_counts; курсоры обоих путей
+        совместимы.
+        """
+        columns = [ReferralClosure.depth, ReferralClosure.descendant_id]
+        if by_walk:
+            down = self._downline_walk(service_id, user_id, max_depth)
+            keys = [down.c.depth, down.c.descendant_id]
+            stmt = select(down.c.descendant_id, down.c.depth)
+            if cursor:
+                values = decode_cursor(cursor, columns)
+                stmt = stmt.where(tuple_(*keys) > tuple_(*values))
+            res = await session.execute(
+                stmt.order_by(*keys).limit(limit + 1)
+            )
+            items = res.all()
+            if len(items) <= limit:
+                return items, None
+            items = items[:limit]
+            return items, encode_cursor(
+                [items[-1].depth, items[-1].descendant_id]
+            )
+
+        stmt = select(ReferralClosure).where(
+            ReferralClosure.service_id == service_id,
+            ReferralClosure.ancestor_id == user_id,
+        )
+        if max_depth is not None:
+            stmt = stmt.where(ReferralClosure.depth <= max_depth)
+
+        return await paginate(session, stmt, columns, limit, cursor)
+
+    async def get_roots_for(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids,
+        by_walk: bool = False,
+    ) -> dict[UUID, UUID]:
+        """Корень дерева для каждого пользователя (сам пользователь, если
+        его никто не приглашал).
+
+        by_walk — подниматься по referrals, пока замыкание сервиса не
+        заполнено backfill.
+        """
+        user_ids = set(user_ids)
+        roots = {user_id: user_id for user_id in user_ids}
+
+        for chunk in _chunks(user_ids):
+            if by_walk:
+                stmt = self._roots_by_walk(service_id, chunk)
+            else:
+                has_parent = (
+                    select(Referral.id)
+                    .where(
+                        Referral.service_id == service_id,
+                        Referral.referred_id == ReferralClosure.ancestor_id,
+                    )
+                    .exists()
+                )
+                stmt = select(
+                    ReferralClosure.descendant_id,
+                    ReferralClosure.ancestor_id,
+                ).where(
+                    ReferralClosure.service_id == service_id,
+                    ReferralClosure.descendant_id.in_(chunk),
+                    ~has_parent,
+                )
+            res = await session.execute(stmt)
+            roots.update(dict(res.all()))
+        return roots
+
+    def _roots_by_walk(self, service_id: UUID, user_ids):
+        """(user_id, root_id) подъёмом по referrals.
+
+        UNION отбрасывает повторы пар, поэтому запрос завершается и на
+        циклах; у пользователя на цикле корня нет, как и в замыкании.
+        """
+        up = (
+            select(
+                Referral.referred_id.label("user_id"),
+                Referral.referrer_id.label("node_id"),
+            )
+            .where(
+                Referral.service_id == service_id,
+                Referral.referred_id.in_(user_ids),
+            )
+            .cte("up", recursive=True)
+        )
+        up = up.union(
+            select(up.c.user_id, Referral.referrer_id)
+            .join(up, Referral.referred_id == up.c.node_id)
+            .where(Referral.service_id == service_id)
+        )
+        has_parent = (
+            select(Referral.id)
+            .where(
+                Referral.service_id == service_id,
+                Referral.referred_id == up.c.node_id,
+            )
+            .exists()
+        )
+        return select(up.c.user_id, up.c.node_id).where(~has_parent)
+
+    async def get_parents_for(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids,
+    ):
+        """Входящие связи (referred_id, referrer_id, level) для набора
+        пользователей."""
+        rows = []
+        for chunk in _chunks(user_ids):
+            res = await session.execute(
+                select(
+                    Referral.referred_id,
+                    Referral.referrer_id,
+                    Referral.level,
+                ).where(
+                    Referral.service_id == service_id,
+                    Referral.referred_id.in_(chunk),
+                )
+            )
+            rows.extend(res.all())
+        return rows
+
+    async def get_ancestors_for(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids,
+    ):
+        """Строки замыкания (descendant_id, ancestor_id, depth) для
+        набора потомков."""
+        rows = []
+        for chunk in _chunks(user_ids):
+            res = await session.execute(
+                select(
+                    ReferralClosure.descendant_id,
+                    ReferralClosure.ancestor_id,
+                    ReferralClosure.depth,
+                ).where(
+                    ReferralClosure.service_id == service_id,
+                    ReferralClosure.descendant_id.in_(chunk),
+                )
+            )
+            rows.extend(res.all())
+        return rows
+
+    async def get_descendants_for(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids,
+    ):
+        """Строки замыкания (ancestor_id, descendant_id, depth) для
+        набора предков."""
+        rows = []
+        for chunk in _chunks(user_ids):
+            res = await session.execute(
+                select(
+                    ReferralClosure.ancestor_id,
+                    ReferralClosure.descendant_id,
+                    ReferralClosure.depth,
+                ).where(
+                    ReferralClosure.service_id == service_id,
+                    ReferralClosure.ancestor_id.in_(chunk),
+                )
+            )
+            rows.extend(res.all())
+        return rows
+
+    async def bulk_create(self, session: AsyncSession, referrals: list[dict]):
+        """Многострочная вставка связей пачками без ORM-объектов.
+
+        Обработчики ORM при такой вставке не срабатывают, поэтому
+        счётчики статистики, рейтинга и журнал изменений обновляются
+        здесь же. Возвращает вставленные строки.
+        """
+        levels: dict[UUID, Counter] = {}
+        referrers: dict[UUID, Counter] = {}
+        created: dict[UUID, list[UUID]] = {}
+        rows = []
+        for chunk in _chunks(referrals):
+            res = await session.execute(
+                insert(Referral)
+                .values(chunk)
+                .returning(
+                    Referral.id,
+                    Referral.referrer_id,
+                    Referral.referred_id,
+                    Referral.service_id,
+                    Referral.level,
+                    Referral.registered_at,
+                )
+            )
+            for row in res.all():
+                rows.append(row)
+                created.setdefault(row.service_id, []).append(row.id)
+                day = stats_day(row.registered_at)
+                levels.setdefault(row.service_id, Counter())[
+                    (row.level, day)
+                ] += 1
+                referrers.setdefault(row.service_id, Counter())[
+                    (row.referrer_id, day)
+                ] += 1
+
+        for service_id, counts in levels.items():
+            await self.add_daily_stats(session, service_id, counts)
+        for service_id, counts in referrers.items():
+            await self.add_referrer_counts(session, service_id, counts)
+        for service_id, ids in created.items():
+            await self.add_changes(session, service_id, ids, CHANGE_CREATED)
+        return rows
+
+    async def bulk_add_closure(self, session: AsyncSession, rows: list[dict]):
+        for chunk in _chunks(rows):
+            await session.execute(insert(ReferralClosure).values(chunk))
+
     async def get_user_referrals(
         self,
         session: AsyncSession,
@@ -25,6 +636,39 @@ class ReferralRepository:
         res = await session.execute(stmt)
         return res.scalars().all()
 
+    async def get_user_referrals_page(
+        self,
+        session: AsyncSession,
+        user_id: UUID,
+        service_id: UUID,
+        limit: int,
+        cursor: str | None = None,
+    ):
+        stmt = select(Referral).where(
+            Referral.referrer_id == user_id,
+            Referral.service_id == service_id,
+        )
+        return await paginate(
+            session,
+            stmt,
+            [Referral.registered_at, Referral.id],
+            limit,
+            cursor,
+        )
+
+    async def get_referral_parent(
+        self,
+        session: AsyncSession,
+        user_id: UUID,
+        service_id: UUID,
+    ) -> Referral | None:
+        stmt = select(Referral).where(
+            Referral.referred_id == user_id,
+            Referral.service_id == service_id,
+        )
+        res = await session.execute(stmt)
+        return res.scalar_one_or_none()
+
     async def get_referral_parents(
         self,
         session: AsyncSession,
@@ -38,6 +682,87 @@ class ReferralRepository:
         res = await session.execute(stmt)
         return res.scalars().all()
 
+    async def get_parent_chain(
+        self,
+        session: AsyncSession,
+        user_id: UUID,
+        service_id: UUID,
+        max_depth: int | None = None,
+    ):
+        """Цепочка вышестоящих связей пользователя одним рекурсивным запросом.
+
+        Первой идёт связь с прямым пригласившим, последней — с корнем.
+        """
+        limit = min(max_depth or MAX_TREE_DEPTH, MAX_TREE_DEPTH)
+
+        chain = (
+            select(
+                Referral.id.label("referral_id"),
+                Referral.referrer_id.label("referrer_id"),
+                literal_column("1").label("depth"),
+            )
+            .where(
+                Referral.service_id == service_id,
+                Referral.referred_id == user_id,
+            )
+            .cte("chain", recursive=True)
+        )
+        chain = chain.union_all(
+            select(
+                Referral.id,
+                Referral.referrer_id,
+                chain.c.depth + 1,
+            )
+            .join(Referral, Referral.referred_id == chain.c.referrer_id)
+            .where(
+                Referral.service_id == service_id,
+                chain.c.depth < limit,
+            )
+        )
+
+        stmt = (
+            select(Referral)
+            .join(chain, Referral.id == chain.c.referral_id)
+            .order_by(chain.c.depth)
+        )
+        res = await session.execute(stmt)
+        return res.scalars().all()
+
+    async def get_chains_for(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids,
+    ):
+        """Все вышестоящие связи набора пользователей.
+
+        Один рекурсивный запрос на пачку пользователей; UNION (а не
+        UNION ALL) отбрасывает общих предков, поэтому каждая связь
+        читается один раз, а запрос завершается и на циклах.
+        """
+        edges = {}
+        for chunk in _chunks(user_ids):
+            chain = (
+                select(Referral.id, Referral.referrer_id)
+                .where(
+                    Referral.service_id == service_id,
+                    Referral.referred_id.in_(chunk),
+                )
+                .cte("chains", recursive=True)
+            )
+            chain = chain.union(
+                select(Referral.id, Referral.referrer_id)
+                .join(chain, Referral.referred_id == chain.c.referrer_id)
+                .where(Referral.service_id == service_id)
+            )
+
+            res = await session.execute(
+                select(Referral).join(chain, Referral.id == chain.c.id)
+            )
+            for referral in res.scalars():
+                edges[referral.id] = referral
+        return list(edges.values())
+
     async def get_top_referrers(
         self,
         session: AsyncSession,
@@ -60,6 +785,98 @@ class ReferralRepository:
         res = await session.execute(stmt)
         return res.all()
 
+    async def get_leaderboard(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        period: str,
+        limit: int = 10,
+    ):
+        """Первые limit строк рейтинга — чтение по индексу, O(limit)."""
+        stmt = (
+            select(
+                ReferrerLeaderboard.referrer_id,
+                ReferrerLeaderboard.count,
+            )
+            .where(
+                ReferrerLeaderboard.service_id == service_id,
+                ReferrerLeaderboard.period == period,
+                ReferrerLeaderboard.count > 0,
+            )
+            .order_by(
+                ReferrerLeaderboard.count.desc(),
+                ReferrerLeaderboard.referrer_id.desc(),
+            )
+            .limit(limit)
+        )
+        res = await session.execute(stmt)
+        return res.all()
+
+    async def get_leaderboard_as_of(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        period: str,
+    ) -> date | None:
+        return await session.scalar(
+            select(ReferrerLeaderboardWindow.as_of).where(
+                ReferrerLeaderboardWindow.service_id == service_id,
+                ReferrerLeaderboardWindow.period == period,
+            )
+        )
+
+    async def refresh_leaderboard_window(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        period: str,
+        today: date,
+    ) -> bool:
+        """Пересчитывает скользящее окно по дневным счётчикам.
+
+        Окно пересчитывается раз в день: отметка as_of сдвигается
+        условным upsert, и пересчёт выполняет только тот, кто её сдвинул.
+        Возвращает True, если пересчёт был выполнен.
+        """
+        table = ReferrerLeaderboardWindow.__table__
+        stmt = upsert_insert(session.get_bind().dialect.name, table).values(
+            service_id=service_id, period=period, as_of=today
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.service_id, table.c.period],
+            set_={"as_of": today},
+            where=table.c.as_of < today,
+        ).returning(table.c.as_of)
+        res = await session.execute(stmt)
+        if res.first() is None:
+            return False
+
+        await session.execute(
+            delete(ReferrerLeaderboard).where(
+                ReferrerLeaderboard.service_id == service_id,
+                ReferrerLeaderboard.period == period,
+            )
+        )
+
+        since = today - timedelta(days=LEADERBOARD_WINDOWS[period])
+        await session.execute(
+            insert(ReferrerLeaderboard).from_select(
+                ["service_id", "period", "referrer_id", "count"],
+                select(
+                    literal(service_id, PG_UUID(as_uuid=True)),
+                    literal(period),
+                    ReferrerDailyCount.referrer_id,
+                    func.sum(ReferrerDailyCount.count),
+                )
+                .where(
+                    ReferrerDailyCount.service_id == service_id,
+                    ReferrerDailyCount.day > since,
+                )
+                .group_by(ReferrerDailyCount.referrer_id),
+            )
+        )
+        return True
+
     async def get_referral_stats(self, session, service_id: UUID):
 
         stmt = (
@@ -75,17 +892,399 @@ class ReferralRepository:
         res = await session.execute(stmt)
         return res.all()
 
+    async def add_daily_stats(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        deltas: dict[tuple[int, date], int],
+    ):
+        """Прибавляет deltas[(level, day)] к счётчикам сервиса."""
+        dialect_name = session.get_bind().dialect.name
+        items = list(deltas.items())
+        for chunk in _chunks(items):
+            stmt = daily_stats_upsert(dialect_name, service_id, dict(chunk))
+            if stmt is not None:
+                await session.execute(stmt)
+
+    async def add_referrer_counts(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        deltas: dict[tuple[UUID, date], int],
+    ):
+        """Прибавляет deltas[(referrer_id, day)] к счётчикам рейтинга."""
+        dialect_name = session.get_bind().dialect.name
+        items = list(deltas.items())
+        for chunk in _chunks(items):
+            for stmt in referrer_counts_upserts(
+                dialect_name, service_id, dict(chunk)
+            ):
+                await session.execute(stmt)
+
+    async def get_daily_stats(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        date_from: date | None = None,
+        date_to: date | None = None,
+    ):
+        """Число рефералов по уровням из счётчиков, без обхода referrals."""
+        total = func.sum(ReferralDailyStats.count)
+        stmt = select(
+            ReferralDailyStats.level,
+            total.label("count"),
+        ).where(ReferralDailyStats.service_id == service_id)
+
+        if date_from is not None:
+            stmt = stmt.where(ReferralDailyStats.day >= date_from)
+        if date_to is not None:
+            stmt = stmt.where(ReferralDailyStats.day <= date_to)
+
+        stmt = (
+            stmt.group_by(ReferralDailyStats.level)
+            .having(total > 0)
+            .order_by(ReferralDailyStats.level)
+        )
+        res = await session.execute(stmt)
+        return res.all()
+
+    async def rebuild_daily_stats(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+    ):
+        """Пересчитывает счётчики сервиса по таблице referrals.
+
+        Нужна для данных, записанных до появления referral_daily_stats;
+        при развёртывании выполняется шагом daily_stats из
+        backend.Referral.backfill.
+        """
+        await session.execute(
+            delete(ReferralDailyStats).where(
+                ReferralDailyStats.service_id == service_id
+            )
+        )
+
+        counts = Counter()
+        async for row in self.iter_edges(session, service_id):
+            counts[(row.level, stats_day(row.registered_at))] += 1
+
+        await self.add_daily_stats(session, service_id, counts)
+
+    async def rebuild_referrer_counts(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+    ):
+        """Пересчитывает дневные счётчики пригласивших и рейтинг сервиса
+        по таблице referrals.
+
+        Нужна для данных, записанных до появления referrer_daily_counts;
+        при развёртывании выполняется шагом leaderboard из
+        backend.Referral.backfill.
+        """
+        for model in (ReferrerDailyCount, ReferrerLeaderboard):
+            await session.execute(
+                delete(model).where(model.service_id == service_id)
+            )
+
+        counts = Counter()
+        async for row in self.iter_edges(session, service_id):
+            counts[(row.referrer_id, stats_day(row.registered_at))] += 1
+
+        await self.add_referrer_counts(session, service_id, counts)
+
+    async def add_changes(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        referral_ids: list[UUID],
+        kind: str,
+    ):
+        """Записывает изменения связей в журнал сервиса."""
+        if not referral_ids:
+            return
+
+        for chunk in _chunks(referral_ids):
+            await session.execute(
+                insert(ReferralChange),
+                change_rows(service_id, chunk, kind),
+            )
+
+    async def get_changes(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        since: tuple[int, int],
+        limit: int,
+    ):
+        """Изменения сервиса после позиции since = (txid, seq) вместе с
+        текущим состоянием связей, по возрастанию позиции.
+
+        Отдаются только изменения завершённых транзакций, поэтому позже
+        за позицией не появится ничего нового. Возвращает не больше
+        limit + 1 строк (txid, seq, kind, Referral): лишняя строка
+        означает, что есть следующая страница.
+        """
+        position = tuple_(ReferralChange.txid, ReferralChange.seq)
+        stmt = (
+            select(
+                ReferralChange.txid,
+                ReferralChange.seq,
+                ReferralChange.kind,
+                Referral,
+            )
+            .join(Referral, Referral.id == ReferralChange.referral_id)
+            .where(
+                ReferralChange.service_id == service_id,
+                position > tuple_(*since),
+                ReferralChange.txid < visible_txid_limit(),
+            )
+            .order_by(ReferralChange.txid, ReferralChange.seq)
+            .limit(limit + 1)
+        )
+        res = await session.execute(stmt)
+        return res.all()
+
+    async def count_referrals(self, session: AsyncSession, service_id: UUID):
+        """Число связей сервиса по счётчикам статистики."""
+        res = await session.execute(
+            select(func.coalesce(func.sum(ReferralDailyStats.count), 0))
+            .where(ReferralDailyStats.service_id == service_id)
+        )
+        return res.scalar_one()
+
+    async def create_export_job(
+        self,
+        session: AsyncSession,
+        job: ReferralExportJob,
+    ):
+        session.add(job)
+        await session.flush()
+        return job
+
+    async def get_export_job(self, session: AsyncSession, job_id: UUID):
+        return await session.get(ReferralExportJob, job_id)
+
+    async def get_expired_export_jobs(
+        self,
+        session: AsyncSession,
+        now: datetime,
+    ):
+        """Завершённые задачи, срок хранения которых истёк."""
+        res = await session.execute(
+            select(ReferralExportJob).where(
+                ReferralExportJob.expires_at <= now
+            )
+        )
+        return res.scalars().all()
+
+    async def fail_unfinished_export_jobs(
+        self,
+        session: AsyncSession,
+        now: datetime,
+        error: str,
+        expires_at: datetime,
+    ) -> int:
+        """Переводит в failed задачи pending и running, созданные раньше
+        now."""
+        res = await session.execute(
+            update(ReferralExportJob)
+            .where(
+                ReferralExportJob.status.in_(("pending", "running")),
+                ReferralExportJob.created_at < now,
+            )
+            .values(
+                status="failed",
+                error=error,
+                finished_at=now,
+                expires_at=expires_at,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return res.rowcount
+
+    async def delete_export_job(
+        self,
+        session: AsyncSession,
+        job: ReferralExportJob,
+    ):
+        await session.delete(job)
+        await session.flush()
+
     async def get_all_referrals_for_export(self, session, service_id: UUID):
         """Получение всех рефералов сервиса для выгрузки."""
         stmt = select(Referral).where(Referral.service_id == service_id)
         res = await session.execute(stmt)
         return res.scalars().all()
 
+    async def iter_edges(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        batch_size: int = 1000,
+    ):
+        """Потоково отдаёт рёбра дерева сервиса без загрузки ORM-объектов."""
+        stmt = (
+            select(
+                Referral.id,
+                Referral.referrer_id,
+                Referral.referred_id,
+                Referral.level,
+                Referral.registered_at,
+                Referral.referral_code_id,
+            )
+            .where(Referral.service_id == service_id)
+            .execution_options(yield_per=batch_size)
+        )
+        result = await session.stream(stmt)
+        async for partition in result.partitions():
+            for row in partition:
+                yield row
+
     async def get_by_id(self, session: AsyncSession, referral_id: UUID):
         stmt = select(Referral).where(Referral.id == referral_id)
         res = await session.execute(stmt)
         return res.scalar_one_or_none()
 
+    async def relevel_subtree(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_id: UUID,
+        level: int,
+        by_walk: bool = False,
+    ) -> int:
+        """Выставляет нижестоящим user_id уровень level + глубина.
+
+        Одним UPDATE ... FROM по таблице замыкания, без загрузки
+        ORM-объектов; меняются только строки с неверным уровнем.
+        by_walk — брать поддерево спуском по referrals, пока замыкание
+        сервиса не заполнено backfill.
+        Возвращает число изменённых строк.
+        """
+        if by_walk:
+            down = self._downline_walk(service_id, user_id)
+            below = []
+        else:
+            down = ReferralClosure.__table__
+            below = [
+                down.c.service_id == service_id,
+                down.c.ancestor_id == user_id,
+            ]
+        new_level = level + down.c.depth
+        changed = [
+            *below,
+            Referral.service_id == service_id,
+            Referral.referred_id == down.c.descendant_id,
+            Referral.level != new_level,
+        ]
+        # UPDATE в обход ORM не вызывает обработчики, поэтому сдвиг
+        # счётчиков по уровням считается заранее
+        stmt = (
+            select(
+                Referral.id,
+                Referral.level,
+                new_level,
+                Referral.registered_at,
+            )
+            .where(*changed)
+            .execution_options(yield_per=BATCH_SIZE)
+        )
+        deltas = Counter()
+        ids = []
+        result = await session.stream(stmt)
+        async for partition in result.partitions():
+            for referral_id, old, new, registered_at in partition:
+                day = stats_day(registered_at)
+                deltas[(old, day)] -= 1
+                deltas[(new, day)] += 1
+                ids.append(referral_id)
+
+        await session.execute(
+            update(Referral)
+            .where(*changed)
+            .values(level=new_level)
+            .execution_options(synchronize_session=False)
+        )
+        await self.add_daily_stats(session, service_id, deltas)
+        await self.add_changes(session, service_id, ids, CHANGE_LEVEL)
+        await self.refresh_loaded(session)
+        # rowcount у UPDATE с WITH в sqlite3 равен -1, а изменённые строки
+        # уже посчитаны выборкой выше
+        return len(ids)
+
+    async def bulk_update_levels(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        levels: list[tuple[UUID, int]],
+    ):
+        """Выставляет уровни связям по (referral_id, level) пачкой
+        UPDATE по первичному ключу через executemany."""
+        table = Referral.__table__
+        stmt = (
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(level=bindparam("b_level"))
+        )
+        await session.execute(
+            stmt,
+            [
+                {"b_id": referral_id, "b_level": level}
+                for referral_id, level in levels
+            ],
+        )
+        await self.add_changes(
+            session,
+            service_id,
+            [referral_id for referral_id, _ in levels],
+            CHANGE_LEVEL,
+        )
+
+    async def refresh_loaded(self, session: AsyncSession):
+        """Перечитывает связи, уже загруженные в сессию.
+
+        Нужна после UPDATE в обход ORM, иначе последующие расчёты уровня
+        возьмут из сессии старые значения.
+        """
+        loaded = [
+            key[1][0]
+            for key in session.identity_map.keys()
+            if key[0] is Referral
+        ]
+        for chunk in _chunks(loaded):
+            await session.execute(
+                select(Referral)
+                .where(Referral.id.in_(chunk))
+                .execution_options(populate_existing=True)
+            )
+
+    async def iter_orphan_edges(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        batch_size: int = 1000,
+    ):
+        """ID связей, ссылающихся на несуществующих пользователей."""
+        from backend.User.models import User
+
+        referrer = aliased(User)
+        referred = aliased(User)
+        stmt = (
+            select(Referral.id)
+            .outerjoin(referrer, referrer.id == Referral.referrer_id)
+            .outerjoin(referred, referred.id == Referral.referred_id)
+            .where(
+                Referral.service_id == service_id,
+                or_(referrer.id.is_(None), referred.id.is_(None)),
+            )
+            .execution_options(yield_per=batch_size)
+        )
+        result = await session.stream_scalars(stmt)
+        async for referral_id in result:
+            yield referral_id
+
     async def update_level(
         self, session: AsyncSession, referral_id: UUID, new_level: int
     ):
@@ -1,21 +1,80 @@
-import json
+import os
+from datetime import date
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
 
 import backend.database.db as db_module
+from backend.compression import compressed_response
+from backend.config import referral_settings
+from backend.Referral.events import ReferralEventBroker
+from backend.Referral.export_jobs import (
+    JOB_DONE,
+    ExportJobManager,
+    parse_range,
+    read_file_range,
+)
+from backend.Referral.forest import ReferralForestCache
+from backend.Referral.lca import AncestorTableCache
+from backend.Referral.models import LEADERBOARD_WINDOWS
 from backend.Referral.schemas import (
+    ExportJobCreate,
+    ExportJobRead,
+    ReferralBulkResult,
+    ReferralChains,
+    ReferralChanges,
+    ReferralChainsQuery,
     ReferralCreate,
+    ReferralDownline,
     ReferralLevelUpdate,
+    ReferralLevelUpdateRead,
+    ReferralPage,
+    ReferralPath,
+    ReferralPathQuery,
     ReferralRead,
+    ReferralRelevelReport,
     ReferralStats,
+    ReferrerCount,
 )
-from backend.Referral.service import ReferralService
+from backend.Referral.service import EXPORT_FORMATS, ReferralService
 
 router = APIRouter(prefix="/referrals", tags=["Referrals"])
-referral_service = ReferralService()
+referral_events = ReferralEventBroker(
+    queue_size=referral_settings.stream_queue_size,
+)
+referral_service = ReferralService(
+    forest=ReferralForestCache() if referral_settings.forest_cache else None,
+    ancestors=AncestorTableCache(ttl=referral_settings.ancestor_cache_ttl),
+    events=referral_events,
+)
+export_jobs = ExportJobManager(
+    referral_service,
+    directory=referral_settings.export_dir,
+    ttl=referral_settings.export_ttl,
+    max_running=referral_settings.export_max_running,
+    interval=referral_settings.export_cleanup_interval,
+)
+router.add_event_handler("startup", export_jobs.startup)
+router.add_event_handler("shutdown", export_jobs.shutdown)
+
+EXPORT_MEDIA_TYPES = {
+    "json": "application/json",
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "columnar": "application/octet-stream",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
 
 
 async def get_session():
@@ -23,6 +82,17 @@ async def get_session():
         yield session
 
 
+def _parse_bulk_body(body: bytes, content_type: str) -> list[ReferralCreate]:
+    """Разбирает JSON-массив или NDJSON (по строке на связь)."""
+    if "ndjson" in content_type:
+        return [
+            ReferralCreate.model_validate_json(line)
+            for line in body.splitlines()
+            if line.strip()
+        ]
+    return TypeAdapter(list[ReferralCreate]).validate_json(body)
+
+
 @router.post("/", response_model=ReferralRead)
 async def register_referral(
     data: ReferralCreate,
@@ -35,73 +105,313 @@ async def register_referral(
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@router.get("/{user_id}/{service_id}", response_model=list[ReferralRead])
-async def get_user_referrals(
-    user_id: UUID,
-    service_id: UUID,
+@router.post("/bulk", response_model=list[ReferralBulkResult])
+async def register_referrals_bulk(
+    request: Request,
     session: AsyncSession = Depends(get_session),
 ):
-    return await referral_service.get_user_referrals(
-        session, user_id, service_id
-    )
+    try:
+        rows = _parse_bulk_body(
+            await request.body(),
+            request.headers.get("content-type", ""),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    try:
+        return await referral_service.register_referrals_bulk(session, rows)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
-@router.get("/chain/{user_id}/{service_id}")
+@router.get(
+    "/chain/{user_id}/{service_id}",
+    response_model=list[ReferralRead],
+)
 async def get_parent_chain(
     user_id: UUID,
     service_id: UUID,
+    max_depth: int | None = Query(None, ge=1),
     session: AsyncSession = Depends(get_session),
 ):
     return await referral_service.get_parent_chain(
-        session, user_id, service_id
+        session, user_id, service_id, max_depth
+    )
+
+
+@router.post("/chains", response_model=ReferralChains)
+async def get_parent_chains(
+    data: ReferralChainsQuery,
+    session: AsyncSession = Depends(get_session),
+):
+    return await referral_service.get_chains(
+        session, data.service_id, data.user_ids
     )
 
 
-@router.get("/top/{service_id}")
+@router.get(
+    "/path/{user_a}/{user_b}/{service_id}",
+    response_model=ReferralPath,
+)
+async def get_path(
+    user_a: UUID,
+    user_b: UUID,
+    service_id: UUID,
+    session: AsyncSession = Depends(get_session),
+):
+    return await referral_service.get_path(
+        session, user_a, user_b, service_id
+    )
+
+
+@router.post("/path/{service_id}", response_model=list[ReferralPath])
+async def get_paths(
+    service_id: UUID,
+    pairs: list[ReferralPathQuery],
+    session: AsyncSession = Depends(get_session),
+):
+    return await referral_service.get_paths(
+        session,
+        service_id,
+        [(pair.user_a, pair.user_b) for pair in pairs],
+    )
+
+
+@router.get(
+    "/downline/{user_id}/{service_id}",
+    response_model=ReferralDownline,
+)
+async def get_downline(
+    user_id: UUID,
+    service_id: UUID,
+    max_depth: int | None = Query(None, ge=1),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = None,
+    session: AsyncSession = Depends(get_session),
+):
+    try:
+        return await referral_service.get_downline(
+            session, user_id, service_id, max_depth, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/top/{service_id}", response_model=list[ReferrerCount])
 async def get_top_referrers(
     service_id: UUID,
-    limit: int = 10,
+    limit: int = Query(10, ge=1, le=1000),
+    window: str = Query("all", enum=list(LEADERBOARD_WINDOWS)),
     session: AsyncSession = Depends(get_session),
 ):
-    return await referral_service.get_top_referrers(session, service_id, limit)
+    try:
+        return await referral_service.get_top_referrers(
+            session, service_id, limit, window
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/stats/{service_id}", response_model=list[ReferralStats])
 async def get_referral_stats(
     service_id: UUID,
+    date_from: date | None = Query(None, alias="from"),
+    date_to: date | None = Query(None, alias="to"),
     session: AsyncSession = Depends(get_session),
 ):
-    return await referral_service.get_stats(session, service_id)
+    try:
+        return await referral_service.get_stats(
+            session, service_id, date_from, date_to
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/export/{service_id}")
 async def export_referrals(
+    request: Request,
     service_id: UUID,
-    format: str = Query("json", enum=["json", "csv"]),
-    session: AsyncSession = Depends(get_session),
+    format: str = Query("json", enum=list(EXPORT_FORMATS)),
 ):
-    raw_data = await referral_service.export_referrals(
-        session, service_id, format
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid export format")
+
+    # Сессия открывается внутри генератора: зависимость get_session
+    # закрывается до того, как ответ начнёт отправляться.
+    async def body():
+        async with db_module.db.get_session() as session:
+            async for chunk in referral_service.stream_export(
+                session, service_id, format
+            ):
+                yield chunk
+
+    return compressed_response(
+        request, body(), media_type=EXPORT_MEDIA_TYPES[format]
+    )
+
+
+def _export_job_read(job) -> ExportJobRead:
+    return ExportJobRead.model_validate(job).model_copy(
+        update={"rows": export_jobs.progress(job)}
     )
 
-    if format == "json":
-        return JSONResponse(content=json.loads(raw_data))
 
-    return PlainTextResponse(raw_data, media_type="text/csv")
+@router.post("/export-jobs", response_model=ExportJobRead, status_code=202)
+async def create_export_job(data: ExportJobCreate):
+    try:
+        job = await export_jobs.start(data.service_id, data.format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _export_job_read(job)
+
+
+@router.get("/export-jobs/{job_id}", response_model=ExportJobRead)
+async def get_export_job(job_id: UUID):
+    job = await export_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    return _export_job_read(job)
+
+
+@router.get("/export-jobs/{job_id}/download")
+async def download_export_job(
+    job_id: UUID,
+    range_header: str | None = Header(None, alias="Range"),
+    if_range: str | None = Header(None),
+):
+    job = await export_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export job not found")
+    if job.status != JOB_DONE:
+        raise HTTPException(status_code=409, detail="Export is not ready")
+    path = export_jobs.path_for(job)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=410, detail="Export file is gone")
+
+    etag = f'"{job.id}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": (
+            f'attachment; filename="{export_jobs.filename_for(job)}"'
+        ),
+    }
 
+    # If-Range с чужим ETag — файл сменился, отдаём целиком
+    if if_range is not None and if_range != etag:
+        range_header = None
 
-@router.patch("/{referral_id}/level", response_model=ReferralRead)
+    try:
+        byte_range = parse_range(range_header, job.size)
+    except ValueError:
+        return Response(
+            status_code=416,
+            headers={**headers, "Content-Range": f"bytes */{job.size}"},
+        )
+
+    status_code = 200
+    start, end = 0, job.size - 1
+    if byte_range is not None:
+        status_code = 206
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{job.size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        read_file_range(path, start, end),
+        status_code=status_code,
+        media_type="application/gzip",
+        headers=headers,
+    )
+
+
+@router.get("/stream/{service_id}")
+async def stream_referral_events(service_id: UUID):
+    """Новые связи и смены уровней сервиса в формате Server-Sent Events.
+
+    События: created, level, relevel; overflow — клиент отстал и
+    отключён, пропущенное дочитывается через /referrals/changes.
+    """
+
+    async def body():
+        subscription = referral_events.subscribe(service_id)
+        try:
+            async for message in subscription.messages():
+                yield message
+        finally:
+            referral_events.unsubscribe(subscription)
+
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/changes/{service_id}", response_model=ReferralChanges)
+async def get_referral_changes(
+    service_id: UUID,
+    since: str | None = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    session: AsyncSession = Depends(get_session),
+):
+    try:
+        return await referral_service.get_changes(
+            session, service_id, since, limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.patch(
+    "/{referral_id}/level",
+    response_model=ReferralLevelUpdateRead,
+)
 async def update_referral_level(
     referral_id: UUID,
     data: ReferralLevelUpdate,
     session: AsyncSession = Depends(get_session),
 ):
     try:
-        updated = await referral_service.force_update_level(
+        updated, descendants = await referral_service.force_update_level(
             session,
             referral_id,
             data.level,
         )
-        return updated
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return ReferralLevelUpdateRead(
+        **ReferralRead.model_validate(updated).model_dump(),
+        descendants_updated=descendants,
+    )
+
+
+@router.post(
+    "/admin/relevel/{service_id}",
+    response_model=ReferralRelevelReport,
+)
+async def relevel_service(
+    service_id: UUID,
+    dry_run: bool = False,
+    session: AsyncSession = Depends(get_session),
+):
+    return await referral_service.relevel_all(session, service_id, dry_run)
+
+
+# Маршрут с двумя параметрами перехватывает любые GET /referrals/<a>/<b>,
+# поэтому объявлен последним.
+@router.get("/{user_id}/{service_id}", response_model=ReferralPage)
+async def get_user_referrals(
+    user_id: UUID,
+    service_id: UUID,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = None,
+    session: AsyncSession = Depends(get_session),
+):
+    try:
+        return await referral_service.get_user_referrals_page(
+            session, user_id, service_id, limit, cursor
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -23,10 +23,120 @@ class ReferralRead(BaseModel):
         from_attributes = True
 
 
+class ReferralLevelUpdateRead(ReferralRead):
+    descendants_updated: int
+
+
+class ReferralChangeRead(ReferralRead):
+    seq: int
+    change: str
+
+
+class ReferralChanges(BaseModel):
+    items: list[ReferralChangeRead]
+    next_token: str
+    has_more: bool
+
+
+class ReferralPage(BaseModel):
+    items: list[ReferralRead]
+    next_cursor: str | None = None
+
+
+class DownlineDepth(BaseModel):
+    depth: int
+    count: int
+
+
+class DownlineMember(BaseModel):
+    user_id: UUID
+    depth: int
+
+
+class ReferralDownline(BaseModel):
+    total: int
+    depths: list[DownlineDepth]
+    items: list[DownlineMember]
+    next_cursor: str | None = None
+
+
+class ReferralChainsQuery(BaseModel):
+    service_id: UUID
+    user_ids: list[UUID]
+
+
+class ReferralChains(BaseModel):
+    edges: list[ReferralRead]
+    chains: dict[UUID, list[UUID]]
+
+
+class ReferralPathQuery(BaseModel):
+    user_a: UUID
+    user_b: UUID
+
+
+class ReferralPath(BaseModel):
+    user_a: UUID
+    user_b: UUID
+    connected: bool
+    common_ancestor: UUID | None = None
+    distance: int | None = None
+    path: list[UUID]
+
+
 class ReferralStats(BaseModel):
     level: int
     count: int
 
 
+class ReferrerCount(BaseModel):
+    referrer_id: UUID
+    count: int
+
+
 class ReferralLevelUpdate(BaseModel):
     level: int
+
+
+class ReferralBulkResult(BaseModel):
+    index: int
+    status: str
+    id: UUID | None = None
+    level: int | None = None
+    detail: str | None = None
+
+
+class ReferralRelevelReport(BaseModel):
+    service_id: UUID
+    edges: int
+    updated: int
+    cycles: int
+    below_cycles: int
+    duplicates: int
+    orphans: int
+    cycle_users: list[UUID]
+    below_cycle_users: list[UUID]
+    orphan_referrals: list[UUID]
+    dry_run: bool
+
+
+class ExportJobCreate(BaseModel):
+    service_id: UUID
+    format: str = "csv"
+
+
+class ExportJobRead(BaseModel):
+    id: UUID
+    service_id: UUID
+    format: str
+    status: str
+    rows: int | None = None
+    total: int | None = None
+    size: int | None = None
+    error: str | None = None
+    created_at: datetime | None = None
+    finished_at: datetime | None = None
+    expires_at: datetime | None = None
+
+    class Config:
+        from_attributes = True
@@ -1,19 +1,77 @@
 import csv
 import json
 import uuid
+from datetime import date
 from io import StringIO
 from uuid import UUID
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from backend.Referral.models import Referral
+from backend.database.pagination import decode_cursor, encode_cursor
+from backend.Referral.columnar import (
+    CHUNK_ROWS,
+    ArrowStreamEncoder,
+    columnar_header,
+    columnar_trailer,
+    encode_columnar_chunk,
+    has_arrow,
+)
+from backend.Referral.events import ReferralEventBroker
+from backend.Referral.forest import ReferralForestCache
+from backend.Referral.lca import AncestorTableCache
+from backend.Referral.locks import TreeLocks, deadlock_as_busy
+from backend.Referral.models import (
+    BACKFILL_CLOSURE,
+    LEADERBOARD_WINDOWS,
+    ReferralChange,
+    stats_day,
+)
+from backend.Referral.relevel import relevel_service
 from backend.Referral.repository import ReferralRepository
-from backend.Referral.schemas import ReferralCreate
+from backend.Referral.schemas import (
+    ReferralCreate,
+    ReferralRead,
+    ReferrerCount,
+)
+
+# Двоичные форматы (см. columnar): arrow — только при установленном
+# pyarrow
+BINARY_EXPORT_FORMATS = ("columnar",) + (("arrow",) if has_arrow() else ())
+EXPORT_FORMATS = ("json", "csv", "ndjson") + BINARY_EXPORT_FORMATS
+
+EXPORT_FIELDS = [
+    "id",
+    "referrer_id",
+    "referred_id",
+    "service_id",
+    "level",
+    "registered_at",
+    "referral_code_id",
+]
+
+EXPORT_CHUNK_ROWS = 500
 
 
 class ReferralService:
-    def __init__(self):
+    def __init__(
+        self,
+        forest: ReferralForestCache | None = None,
+        ancestors: AncestorTableCache | None = None,
+        locks: TreeLocks | None = None,
+        events: ReferralEventBroker | None = None,
+    ):
         self.repo = ReferralRepository()
+        self.forest = forest
+        self.events = events
+        self.ancestors = ancestors or AncestorTableCache(repo=self.repo)
+        self.locks = locks or TreeLocks(self.repo)
+        # Сервисы, у которых таблица замыкания заполнена целиком
+        self._closure_ready: set[UUID] = set()
+
+    async def _get_forest(self, session: AsyncSession, service_id: UUID):
+        if self.forest is None:
+            return None
+        return await self.forest.get(session, service_id)
 
     async def _get_parent(
         self,
@@ -21,12 +79,44 @@ class ReferralService:
         user_id: UUID,
         service_id: UUID,
     ):
-        parents = await self.repo.get_referral_parents(
+        return await self.repo.get_referral_parent(
             session,
             user_id,
             service_id,
         )
-        return parents[0] if parents else None
+
+    async def _closure_complete(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        mark: bool = True,
+    ) -> bool:
+        """Заполнено ли замыкание сервиса для всех его связей.
+
+        Связи, записанные до появления замыкания, попадают в него только
+        после backfill; у сервиса без связей замыкание полно сразу.
+        mark=False — только чтение: до взятия блокировок деревьев запись
+        отметки о backfill упёрлась бы в блокировку записи SQLite.
+        """
+        if service_id in self._closure_ready:
+            return True
+
+        ready = await self.repo.is_backfilled(
+            session, service_id, BACKFILL_CLOSURE
+        )
+        if not ready and not await self.repo.has_referrals(
+            session, service_id
+        ):
+            if not mark:
+                return True
+            await self.repo.mark_backfilled(
+                session, service_id, BACKFILL_CLOSURE
+            )
+            ready = True
+
+        if ready:
+            self._closure_ready.add(service_id)
+        return ready
 
     async def _detect_cycle(
             self,
@@ -35,20 +125,29 @@ class ReferralService:
             referred_id,
             service_id,
     ):
-        current = referred_id
+        # Цикл возникает, если приглашённый уже является предком
+        # пригласившего — это одна проверка по таблице замыкания.
+        if referrer_id == referred_id:
+            return True
 
-        while True:
-            parent = await self._get_parent(session, current, service_id)
-            if not parent:
-                return False
+        forest = await self._get_forest(session, service_id)
+        if forest is not None:
+            return forest.is_ancestor(referred_id, referrer_id)
 
-            if parent.referrer_id == referrer_id:
-                return True
-
-            if parent.referrer_id == referred_id:
-                return True
+        if not await self._closure_complete(session, service_id):
+            return await self.repo.is_ancestor_by_walk(
+                session,
+                service_id,
+                ancestor_id=referred_id,
+                descendant_id=referrer_id,
+            )
 
-            current = parent.referrer_id
+        return await self.repo.is_ancestor(
+            session,
+            service_id,
+            ancestor_id=referred_id,
+            descendant_id=referrer_id,
+        )
 
     async def _calculate_level(
         self,
@@ -56,12 +155,36 @@ class ReferralService:
         referrer_id: UUID,
         service_id: UUID,
     ):
-        parent = await self._get_parent(session, referrer_id, service_id)
+        forest = await self._get_forest(session, service_id)
+        if forest is not None:
+            parent = forest.parent(referrer_id)
+        else:
+            parent = await self._get_parent(session, referrer_id, service_id)
+
         if not parent:
             return 1
         return parent.level + 1
 
     async def register_referral(self, session: AsyncSession, data: ReferralCreate):
+        with deadlock_as_busy():
+            return await self._register_referral(session, data)
+
+    async def _register_referral(
+        self,
+        session: AsyncSession,
+        data: ReferralCreate,
+    ):
+        # Проверка цикла и вставка должны идти под блокировкой обоих
+        # деревьев, иначе две встречные регистрации замкнут цикл
+        await self.locks.lock_trees(
+            session,
+            data.service_id,
+            [data.referrer_id, data.referred_id],
+            by_walk=not await self._closure_complete(
+                session, data.service_id, mark=False
+            ),
+        )
+
         cycle = await self._detect_cycle(
             session,
             referrer_id=data.referrer_id,
@@ -77,17 +200,283 @@ class ReferralService:
             data.service_id,
         )
 
-        new_ref = Referral(
-            id=uuid.uuid4(),
-            referrer_id=data.referrer_id,
-            referred_id=data.referred_id,
-            service_id=data.service_id,
-            referral_code_id=data.referral_code_id,
-            level=level,
+        created = await self.repo.create_if_absent(
+            session,
+            {
+                "id": uuid.uuid4(),
+                "referrer_id": data.referrer_id,
+                "referred_id": data.referred_id,
+                "service_id": data.service_id,
+                "referral_code_id": data.referral_code_id,
+                "level": level,
+            },
         )
+        if created is None:
+            raise ValueError("User already referred")
+
+        await self.repo.add_closure(
+            session,
+            data.service_id,
+            data.referrer_id,
+            data.referred_id,
+        )
+        if self.forest is not None:
+            self.forest.on_register(session, created)
+        self.ancestors.add_after_commit(
+            session,
+            data.service_id,
+            [(created.referrer_id, created.referred_id)],
+        )
+        self._publish(session, data.service_id, "created", created)
+        return created
+
+    async def register_referrals_bulk(
+        self,
+        session: AsyncSession,
+        rows: list[ReferralCreate],
+    ):
+        """Регистрирует пачку связей.
+
+        Циклы и уровни считаются в памяти для всей пачки сразу, с учётом
+        уже существующего дерева; вставка идёт многострочными INSERT.
+        Возвращает результат для каждой строки в исходном порядке.
+        """
+        results: list[dict | None] = [None] * len(rows)
+
+        by_service: dict[UUID, list[tuple[int, ReferralCreate]]] = {}
+        for index, row in enumerate(rows):
+            by_service.setdefault(row.service_id, []).append((index, row))
 
-        await session.flush()
-        return await self.repo.create(session, new_ref)
+        for service_id, batch in by_service.items():
+            with deadlock_as_busy():
+                await self._register_bulk_for_service(
+                    session, service_id, batch, results
+                )
+
+        return results
+
+    async def _register_bulk_for_service(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        batch: list[tuple[int, ReferralCreate]],
+        results: list,
+    ):
+        referrers = {row.referrer_id for _, row in batch}
+        referred = {row.referred_id for _, row in batch}
+
+        await self.locks.lock_trees(
+            session,
+            service_id,
+            referrers | referred,
+            by_walk=not await self._closure_complete(
+                session, service_id, mark=False
+            ),
+        )
+
+        existing_parents = {
+            referred_id: level
+            for referred_id, _, level in await self.repo.get_parents_for(
+                session, service_id, referrers | referred
+            )
+        }
+
+        if await self._closure_complete(session, service_id):
+            get_ancestors = self.repo.get_ancestors_for
+        else:
+            get_ancestors = self.repo.get_ancestors_by_walk
+
+        existing_ancestors: dict[UUID, list[tuple[UUID, int]]] = {}
+        for descendant_id, ancestor_id, depth in (
+            await get_ancestors(session, service_id, referrers)
+        ):
+            existing_ancestors.setdefault(descendant_id, []).append(
+                (ancestor_id, depth)
+            )
+
+        def existing_root(node):
+            ancestors = existing_ancestors.get(node)
+            if not ancestors:
+                return node, 0
+            return max(ancestors, key=lambda item: item[1])
+
+        # Система непересекающихся множеств: корень дерева для каждого узла
+        roots: dict[UUID, UUID] = {}
+
+        def find(node):
+            path = []
+            while True:
+                parent = roots.get(node)
+                if parent is None:
+                    parent = roots[node] = existing_root(node)[0]
+                if parent == node:
+                    break
+                path.append(node)
+                node = parent
+            for item in path:
+                roots[item] = node
+            return node
+
+        batch_parent: dict[UUID, UUID] = {}
+        accepted = []
+        for index, row in batch:
+            referrer_id, referred_id = row.referrer_id, row.referred_id
+
+            if referred_id in existing_parents or referred_id in batch_parent:
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "detail": "User already referred",
+                }
+                continue
+
+            # Приглашённый пока корень, поэтому цикл возможен, только если
+            # он и есть корень дерева пригласившего.
+            if referrer_id == referred_id or find(referrer_id) == referred_id:
+                results[index] = {
+                    "index": index,
+                    "status": "error",
+                    "detail": "Cycle detected",
+                }
+                continue
+
+            roots[referred_id] = referrer_id
+            batch_parent[referred_id] = referrer_id
+            accepted.append((index, row))
+
+        if not accepted:
+            return
+
+        levels: dict[UUID, int] = {}
+
+        def level_of(node):
+            pending = []
+            while node in batch_parent and node not in levels:
+                pending.append(node)
+                node = batch_parent[node]
+
+            base = levels.get(node, existing_parents.get(node, 0))
+            for item in reversed(pending):
+                base += 1
+                levels[item] = base
+            return base
+
+        def dependency(node):
+            if node in batch_parent:
+                return batch_parent[node]
+            root = existing_root(node)[0]
+            return root if root in batch_parent else None
+
+        ancestors_cache: dict[UUID, list[tuple[UUID, int]]] = {}
+
+        def ancestors_of(node):
+            pending = []
+            current = node
+            while current is not None and current not in ancestors_cache:
+                pending.append(current)
+                current = dependency(current)
+
+            for item in reversed(pending):
+                if item in batch_parent:
+                    parent = batch_parent[item]
+                    ancestors_cache[item] = [(parent, 1)] + [
+                        (ancestor, depth + 1)
+                        for ancestor, depth in ancestors_cache[parent]
+                    ]
+                    continue
+
+                chain = list(existing_ancestors.get(item, []))
+                root, root_depth = existing_root(item)
+                if root in batch_parent:
+                    chain += [
+                        (ancestor, depth + root_depth)
+                        for ancestor, depth in ancestors_cache[root]
+                    ]
+                ancestors_cache[item] = chain
+
+            return ancestors_cache[node]
+
+        existing_descendants: dict[UUID, list[tuple[UUID, int]]] = {}
+        for ancestor_id, descendant_id, depth in (
+            await self.repo.get_descendants_for(
+                session, service_id, batch_parent.keys()
+            )
+        ):
+            existing_descendants.setdefault(ancestor_id, []).append(
+                (descendant_id, depth)
+            )
+
+        new_referrals = []
+        closure_rows = []
+        for index, row in accepted:
+            referral_id = uuid.uuid4()
+            level = level_of(row.referred_id)
+            new_referrals.append(
+                {
+                    "id": referral_id,
+                    "referrer_id": row.referrer_id,
+                    "referred_id": row.referred_id,
+                    "service_id": service_id,
+                    "referral_code_id": row.referral_code_id,
+                    "level": level,
+                }
+            )
+
+            upline = [(row.referrer_id, 0)] + ancestors_of(row.referrer_id)
+            subtree = [(row.referred_id, 0)] + existing_descendants.get(
+                row.referred_id, []
+            )
+            closure_rows.extend(
+                {
+                    "service_id": service_id,
+                    "ancestor_id": ancestor_id,
+                    "descendant_id": descendant_id,
+                    "depth": up_depth + down_depth + 1,
+                }
+                for ancestor_id, up_depth in upline
+                for descendant_id, down_depth in subtree
+            )
+
+            results[index] = {
+                "index": index,
+                "status": "created",
+                "id": referral_id,
+                "level": level,
+            }
+
+        created = await self.repo.bulk_create(session, new_referrals)
+        await self.repo.bulk_add_closure(session, closure_rows)
+
+        if self.forest is not None:
+            self.forest.on_bulk_change(session, service_id)
+        self.ancestors.add_after_commit(
+            session,
+            service_id,
+            [
+                (row["referrer_id"], row["referred_id"])
+                for row in new_referrals
+            ],
+        )
+
+        for row in created:
+            self._publish(session, service_id, "created", row)
+
+    def _publish(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        name: str,
+        referral,
+        **extra,
+    ):
+        """Событие для подписчиков /referrals/stream после коммита."""
+        # Без подписчиков не тратимся на сериализацию
+        if self.events is None or not self.events.subscribers(service_id):
+            return
+        data = ReferralRead.model_validate(referral).model_dump(mode="json")
+        self.events.publish_after_commit(
+            session, service_id, name, {**data, **extra}
+        )
 
     async def get_user_referrals(
         self,
@@ -97,53 +486,352 @@ class ReferralService:
     ):
         return await self.repo.get_user_referrals(session, user_id, service_id)
 
-    async def get_parent_chain(self, session, user_id, service_id):
-        parent = await self._get_parent(session, user_id, service_id)
-        return [parent] if parent else []
+    async def get_user_referrals_page(
+        self,
+        session: AsyncSession,
+        user_id: UUID,
+        service_id: UUID,
+        limit: int,
+        cursor: str | None = None,
+    ):
+        items, next_cursor = await self.repo.get_user_referrals_page(
+            session, user_id, service_id, limit, cursor
+        )
+        return {"items": items, "next_cursor": next_cursor}
+
+    async def get_downline(
+        self,
+        session: AsyncSession,
+        user_id: UUID,
+        service_id: UUID,
+        max_depth: int | None = None,
+        limit: int = 100,
+        cursor: str | None = None,
+    ):
+        """Нижестоящие пользователя: счётчики по глубине и страница
+        участников. Всё считается в БД по таблице замыкания, а до
+        backfill — спуском по referrals."""
+        by_walk = not await self._closure_complete(
+            session, service_id, mark=False
+        )
+        depths = await self.repo.get_downline_counts(
+            session, service_id, user_id, max_depth, by_walk=by_walk
+        )
+        items, next_cursor = await self.repo.get_downline_page(
+            session,
+            service_id,
+            user_id,
+            limit,
+            cursor,
+            max_depth,
+            by_walk=by_walk,
+        )
+        return {
+            "total": sum(count for _, count in depths),
+            "depths": [
+                {"depth": depth, "count": count} for depth, count in depths
+            ],
+            "items": [
+                {"user_id": row.descendant_id, "depth": row.depth}
+                for row in items
+            ],
+            "next_cursor": next_cursor,
+        }
+
+    async def get_parent_chain(
+        self,
+        session,
+        user_id,
+        service_id,
+        max_depth: int | None = None,
+    ):
+        forest = await self._get_forest(session, service_id)
+        if forest is not None:
+            return forest.chain(user_id, max_depth)
+
+        return await self.repo.get_parent_chain(
+            session, user_id, service_id, max_depth
+        )
+
+    async def get_chains(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        user_ids: list[UUID],
+    ):
+        """Цепочки вышестоящих для набора пользователей.
+
+        Каждая связь возвращается один раз в edges, а chains[user_id] —
+        ID предков пользователя от прямого пригласившего к корню.
+        """
+        forest = await self._get_forest(session, service_id)
+        if forest is not None:
+            edges = {}
+            for user_id in user_ids:
+                for edge in forest.chain(user_id):
+                    edges[edge.referred_id] = edge
+        else:
+            edges = {
+                edge.referred_id: edge
+                for edge in await self.repo.get_chains_for(
+                    session, service_id, set(user_ids)
+                )
+            }
+
+        chains = {}
+        for user_id in user_ids:
+            chain, seen = [], {user_id}
+            edge = edges.get(user_id)
+            while edge is not None and edge.referrer_id not in seen:
+                chain.append(edge.referrer_id)
+                seen.add(edge.referrer_id)
+                edge = edges.get(edge.referrer_id)
+            chains[user_id] = chain
+
+        return {"edges": list(edges.values()), "chains": chains}
+
+    async def get_path(
+        self,
+        session: AsyncSession,
+        user_a: UUID,
+        user_b: UUID,
+        service_id: UUID,
+    ):
+        """Путь между пользователями через наименьшего общего предка."""
+        table = await self.ancestors.get(session, service_id)
+        return table.path(user_a, user_b)
+
+    async def get_paths(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        pairs: list[tuple[UUID, UUID]],
+    ):
+        table = await self.ancestors.get(session, service_id)
+        return [table.path(user_a, user_b) for user_a, user_b in pairs]
 
     async def get_top_referrers(
         self,
         session: AsyncSession,
         service_id: UUID,
         limit=10,
+        window: str = "all",
+    ):
+        """Рейтинг пригласивших за окно window из LEADERBOARD_WINDOWS.
+
+        Скользящие окна пересчитываются первым запросом нового дня.
+        """
+        if window not in LEADERBOARD_WINDOWS:
+            raise ValueError("Invalid window")
+
+        if LEADERBOARD_WINDOWS[window] is not None:
+            today = stats_day(None)
+            as_of = await self.repo.get_leaderboard_as_of(
+                session, service_id, window
+            )
+            if as_of is None or as_of < today:
+                await self.repo.refresh_leaderboard_window(
+                    session, service_id, window, today
+                )
+
+        rows = await self.repo.get_leaderboard(
+            session, service_id, window, limit
+        )
+        return [
+            ReferrerCount(referrer_id=referrer_id, count=count)
+            for referrer_id, count in rows
+        ]
+
+    async def get_stats(
+        self,
+        session,
+        service_id: UUID,
+        date_from: date | None = None,
+        date_to: date | None = None,
     ):
-        return await self.repo.get_top_referrers(session, service_id, limit)
+        """Число рефералов по уровням; границы периода включительно."""
+        if date_from and date_to and date_from > date_to:
+            raise ValueError("Invalid date range")
 
-    async def get_stats(self, session, service_id: UUID):
-        data = await self.repo.get_referral_stats(session, service_id)
+        data = await self.repo.get_daily_stats(
+            session, service_id, date_from, date_to
+        )
         return [{"level": lvl, "count": cnt} for lvl, cnt in data]
 
-    async def export_referrals(self, session, service_id: UUID, format: str):
-        refs = await self.repo.get_all_referrals_for_export(
-            session, service_id
+    async def get_changes(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        since: str | None = None,
+        limit: int = 1000,
+    ):
+        """Связи, изменённые после токена since, в текущем состоянии.
+
+        Без since журнал читается с начала. Связь, изменённая несколько
+        раз в пределах страницы, отдаётся один раз — на месте последнего
+        изменения. next_token передаётся в следующий запрос; он
+        возвращается и на пустой странице.
+        """
+        position = (-1, 0)
+        if since:
+            position = tuple(
+                decode_cursor(since, [ReferralChange.txid, ReferralChange.seq])
+            )
+
+        rows = await self.repo.get_changes(
+            session, service_id, position, limit
         )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            position = (rows[-1].txid, rows[-1].seq)
 
-        rows = [
-            {
-                "id": str(r.id),
-                "referrer_id": str(r.referrer_id),
-                "referred_id": str(r.referred_id),
-                "service_id": str(r.service_id),
-                "level": r.level,
-                "registered_at": r.registered_at.isoformat(),
-                "referral_code_id": (
-                    str(r.referral_code_id) if r.referral_code_id else None
-                ),
-            }
-            for r in refs
-        ]
+        latest = {}
+        for row in rows:
+            latest.pop(row.Referral.id, None)
+            latest[row.Referral.id] = row
 
-        if format == "json":
-            return json.dumps(rows, ensure_ascii=False, indent=4)
+        return {
+            "items": [
+                {
+                    **ReferralRead.model_validate(row.Referral).model_dump(),
+                    "seq": row.seq,
+                    "change": row.kind,
+                }
+                for row in latest.values()
+            ],
+            "next_token": encode_cursor(position),
+            "has_more": has_more,
+        }
 
+    def _export_row(self, row, service_id: UUID) -> dict:
+        return {
+            "id": str(row.id),
+            "referrer_id": str(row.referrer_id),
+            "referred_id": str(row.referred_id),
+            "service_id": str(service_id),
+            "level": row.level,
+            "registered_at": (
+                row.registered_at.isoformat() if row.registered_at else None
+            ),
+            "referral_code_id": (
+                str(row.referral_code_id) if row.referral_code_id else None
+            ),
+        }
+
+    def _encode_export_chunk(self, rows: list[dict], format: str) -> str:
         if format == "csv":
             output = StringIO()
-            writer = csv.DictWriter(output, fieldnames=rows[0].keys())
-            writer.writeheader()
+            writer = csv.DictWriter(output, fieldnames=EXPORT_FIELDS)
             writer.writerows(rows)
             return output.getvalue()
 
-        raise ValueError("Invalid export format")
+        if format == "ndjson":
+            return "".join(
+                json.dumps(r, ensure_ascii=False) + "\n" for r in rows
+            )
+
+        return ",".join(json.dumps(r, ensure_ascii=False) for r in rows)
+
+    async def stream_export(
+        self,
+        session,
+        service_id: UUID,
+        format: str,
+        progress=None,
+    ):
+        """Выгрузка рефералов сервиса кусками по EXPORT_CHUNK_ROWS строк.
+
+        Строки читаются курсором, поэтому память не зависит от размера
+        сервиса. progress(n), если передан, вызывается с числом строк
+        перед отдачей каждого куска.
+        """
+        if format not in EXPORT_FORMATS:
+            raise ValueError("Invalid export format")
+
+        if format in BINARY_EXPORT_FORMATS:
+            async for chunk in self._stream_binary_export(
+                session, service_id, format, progress
+            ):
+                yield chunk
+            return
+
+        if format == "csv":
+            yield ",".join(EXPORT_FIELDS) + "\r\n"
+        elif format == "json":
+            yield "["
+
+        first = True
+        rows = []
+        async for row in self.repo.iter_edges(session, service_id):
+            rows.append(self._export_row(row, service_id))
+            if len(rows) < EXPORT_CHUNK_ROWS:
+                continue
+
+            chunk = self._encode_export_chunk(rows, format)
+            if progress is not None:
+                progress(len(rows))
+            yield chunk if first or format != "json" else "," + chunk
+            first = False
+            rows = []
+
+        if rows:
+            chunk = self._encode_export_chunk(rows, format)
+            if progress is not None:
+                progress(len(rows))
+            yield chunk if first or format != "json" else "," + chunk
+
+        if format == "json":
+            yield "]"
+
+    async def _stream_binary_export(
+        self,
+        session,
+        service_id: UUID,
+        format: str,
+        progress=None,
+    ):
+        """Колоночная выгрузка кусками по CHUNK_ROWS строк (bytes)."""
+        if format == "arrow":
+            encoder = ArrowStreamEncoder(service_id)
+            header, encode, trailer = (
+                encoder.header(),
+                encoder.chunk,
+                encoder.trailer,
+            )
+        else:
+            header, encode, trailer = (
+                columnar_header(service_id),
+                encode_columnar_chunk,
+                columnar_trailer,
+            )
+
+        yield header
+        rows = []
+        async for row in self.repo.iter_edges(
+            session, service_id, batch_size=CHUNK_ROWS
+        ):
+            rows.append(row)
+            if len(rows) >= CHUNK_ROWS:
+                if progress is not None:
+                    progress(len(rows))
+                yield encode(rows)
+                rows = []
+
+        if rows:
+            if progress is not None:
+                progress(len(rows))
+            yield encode(rows)
+        yield trailer()
+
+    async def export_referrals(self, session, service_id: UUID, format: str):
+        chunks = [
+            chunk
+            async for chunk in self.stream_export(session, service_id, format)
+        ]
+        if format in BINARY_EXPORT_FORMATS:
+            return b"".join(chunks)
+        return "".join(chunks)
 
     async def force_update_level(
         self,
@@ -151,6 +839,8 @@ class ReferralService:
         referral_id: UUID,
         new_level: int,
     ):
+        """Меняет уровень связи и пересчитывает всё поддерево
+        приглашённого. Возвращает (referral, число изменённых потомков)."""
 
         if new_level < 1:
             raise ValueError("Level must be >= 1")
@@ -161,4 +851,49 @@ class ReferralService:
         if not referral:
             raise ValueError("Referral not found")
 
-        return referral
+        descendants_updated = await self.repo.relevel_subtree(
+            session,
+            referral.service_id,
+            referral.referred_id,
+            new_level,
+            by_walk=not await self._closure_complete(
+                session, referral.service_id
+            ),
+        )
+
+        if self.forest is not None:
+            if descendants_updated:
+                self.forest.on_bulk_change(session, referral.service_id)
+            else:
+                self.forest.on_level_update(session, referral)
+
+        self._publish(
+            session,
+            referral.service_id,
+            "level",
+            referral,
+            descendants_updated=descendants_updated,
+        )
+        return referral, descendants_updated
+
+    async def relevel_all(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        dry_run: bool = False,
+    ):
+        """Пересчитывает уровни всех связей сервиса (см. relevel)."""
+        report = await relevel_service(
+            session, service_id, self.repo, dry_run
+        )
+        if report["updated"] and not dry_run:
+            if self.forest is not None:
+                self.forest.on_bulk_change(session, service_id)
+            if self.events is not None:
+                self.events.publish_after_commit(
+                    session,
+                    service_id,
+                    "relevel",
+                    {"service_id": service_id, "updated": report["updated"]},
+                )
+        return report
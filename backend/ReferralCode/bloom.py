@@ -0,0 +1,207 @@
+"""Фильтр Блума существующих реферальных кодов.
+
+Перебор случайных кодов почти всегда даёт промах, и каждый промах —
+запрос к базе. Фильтр отвечает «кода точно нет» без обращения к базе;
+«может быть» проверяется как обычно, через кэш и базу. Доля ложных
+«может быть» задаётся error_rate.
+
+Ложных «точно нет» быть не должно, поэтому в фильтр попадают все коды:
+при построении — из referral_codes, затем — созданные этим процессом и,
+через канал инвалидации, другими процессами. Другим процессам новый код
+рассылается ещё до коммита (announce), иначе запрос, пришедший сразу
+после создания, мог бы получить «кода нет» раньше уведомления. Раз в
+refresh секунд фильтр строится заново в фоне, запросы тем временем
+обслуживает старый: так подхватываются коды, вставленные в обход
+сервиса, и размер подстраивается под число кодов. Без канала
+инвалидации фильтр стоит включать, только если процесс один.
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import backend.database.db as db_module
+from backend.ReferralCode.cache import PostgresCodeCacheChannel
+from backend.ReferralCode.repository import ReferralCodeRepository
+
+logger = logging.getLogger(__name__)
+
+# Ёмкость фильтра — число кодов с запасом на рост до перестройки
+HEADROOM = 2.0
+MIN_CAPACITY = 1024
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        # Оптимальные m и k для n элементов и вероятности p
+        self.bits = max(
+            8,
+            math.ceil(
+                -self.capacity * math.log(error_rate) / math.log(2) ** 2
+            ),
+        )
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, item: str):
+        # Двойное хеширование: k позиций из одного 128-битного хеша
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self._array[position >> 3] >> (position & 7) & 1
+            for position in self._positions(item)
+        )
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._array)
+
+    def estimated_error_rate(self) -> float:
+        """Ожидаемая доля ложных срабатываний при текущем заполнении."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** (
+            self.hashes
+        )
+
+
+class ReferralCodeFilter:
+    def __init__(
+        self,
+        error_rate: float = 0.001,
+        refresh: float = 600.0,
+        channel: PostgresCodeCacheChannel | None = None,
+        repo: ReferralCodeRepository | None = None,
+    ):
+        self.error_rate = error_rate
+        self.refresh = refresh
+        self.channel = channel
+        self.repo = repo or ReferralCodeRepository()
+        self.rejected = 0
+
+        self._filter: BloomFilter | None = None
+        self._expires = 0.0
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        # Коды, добавленные с начала прошлой перестройки: часть из них
+        # могла быть ещё не закоммичена, когда читалась таблица
+        self._recent: set[str] = set()
+
+    def _stale(self) -> bool:
+        return (
+            self._filter is None
+            or self._expires <= time.monotonic()
+            or self._filter.count > self._filter.capacity
+        )
+
+    async def might_exist(self, session: AsyncSession, code: str) -> bool:
+        """False — кода точно нет; True — нужно проверить в базе."""
+        # Обычно фильтр строится при запуске (start)
+        if self._filter is None:
+            await self.rebuild(session)
+        elif self._stale():
+            self._rebuild_soon()
+
+        if code in self._filter:
+            return True
+        self.rejected += 1
+        return False
+
+    async def rebuild(self, session: AsyncSession):
+        async with self._lock:
+            if not self._stale():
+                return
+
+            carried, self._recent = self._recent, set()
+            total = await self.repo.count_codes(session)
+            bloom = BloomFilter(
+                max(int(total * HEADROOM), MIN_CAPACITY),
+                self.error_rate,
+            )
+            async for code in self.repo.iter_codes(session):
+                bloom.add(code)
+            for code in carried | self._recent:
+                bloom.add(code)
+
+            self._filter = bloom
+            self._expires = time.monotonic() + self.refresh
+
+    def _rebuild_soon(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._rebuild_in_background())
+
+    async def _rebuild_in_background(self):
+        try:
+            async with db_module.db.get_session() as session:
+                await self.rebuild(session)
+        except Exception:
+            # Старый фильтр остаётся верным, перестройку повторит
+            # следующий запрос
+            logger.exception("Referral code filter rebuild failed")
+
+    def add(self, codes):
+        for code in codes:
+            self._recent.add(code)
+            if self._filter is not None:
+                self._filter.add(code)
+
+    async def announce(self, codes: list[str]):
+        """Добавляет новые коды здесь и в других процессах до коммита.
+
+        Если транзакция откатится, коды останутся в фильтрах ложными
+        «может быть» — это безопасно.
+        """
+        self.add(codes)
+        if self.channel is None or not codes:
+            return
+        try:
+            await self.channel.announce(codes)
+        except Exception:
+            # Другие процессы узнают о кодах из уведомления при коммите
+            logger.exception("Referral code announce failed")
+
+    async def start(self):
+        """Строит фильтр при запуске и подписывается на канал."""
+        if self.channel is not None:
+            await self.channel.listen(self.add)
+        if db_module.db.engine is not None:
+            async with db_module.db.get_session() as session:
+                await self.rebuild(session)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        bloom = self._filter
+        return {
+            "ready": bloom is not None,
+            "codes": bloom.count if bloom else 0,
+            "capacity": bloom.capacity if bloom else 0,
+            "bits": bloom.bits if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "memory_bytes": bloom.memory_bytes if bloom else 0,
+            "error_rate": self.error_rate,
+            "estimated_error_rate": (
+                bloom.estimated_error_rate() if bloom else 0.0
+            ),
+            "rejected": self.rejected,
+        }
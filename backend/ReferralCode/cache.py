@@ -0,0 +1,265 @@
+"""Кэш реферальных кодов для validate_code в памяти процесса.
+
+LRU на size записей, каждая живёт ttl секунд. Несуществующие коды тоже
+кэшируются (на negative_ttl, обычно короче), чтобы повторные запросы с
+неверным кодом не доходили до базы.
+
+Изменения кодов через сервис сбрасывают записи сразу и ещё раз после
+коммита: запрос, прочитавший старую строку до коммита, не оставит её в
+кэше. Другие процессы узнают об изменениях через канал инвалидации
+(PostgresCodeCacheChannel — LISTEN/NOTIFY); без канала их изменения
+видны не позже чем через ttl.
+"""
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable
+from uuid import UUID
+
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.ReferralCode.models import ReferralCode
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover - зависит от окружения
+    asyncpg = None
+
+CHANNEL = "referral_code_cache"
+
+# Payload NOTIFY ограничен 8000 байтами
+NOTIFY_PAYLOAD_LIMIT = 7000
+
+
+@dataclass(frozen=True, slots=True)
+class CodeRecord:
+    """Снимок строки referral_codes (поля ReferralCodeRead)."""
+
+    id: UUID
+    code: str
+    user_id: UUID
+    service_id: UUID
+    expires_at: datetime | None
+    usage_limit: int | None
+    is_active: bool
+    created_at: datetime
+
+    @classmethod
+    def from_model(cls, code: ReferralCode) -> "CodeRecord":
+        return cls(
+            id=code.id,
+            code=code.code,
+            user_id=code.user_id,
+            service_id=code.service_id,
+            expires_at=code.expires_at,
+            usage_limit=code.usage_limit,
+            is_active=code.is_active,
+            created_at=code.created_at,
+        )
+
+
+def _payloads(codes: list[str]):
+    """Делит коды на JSON-списки, каждый меньше лимита NOTIFY."""
+    batch, size = [], 2
+    for code in codes:
+        item = len(json.dumps(code)) + 1
+        if batch and size + item > NOTIFY_PAYLOAD_LIMIT:
+            yield json.dumps(batch, separators=(",", ":"))
+            batch, size = [], 2
+        batch.append(code)
+        size += item
+    if batch:
+        yield json.dumps(batch, separators=(",", ":"))
+
+
+class PostgresCodeCacheChannel:
+    """Инвалидация между процессами через LISTEN/NOTIFY PostgreSQL.
+
+    Уведомление отправляется в транзакции изменения, поэтому другие
+    процессы получают его только после коммита, а откаченные изменения
+    не рассылаются вовсе. announce рассылает сразу — для фильтра новых
+    кодов, которым лишнее «может быть» не вредит.
+    """
+
+    def __init__(self, dsn: str, channel: str = CHANNEL):
+        # asyncpg не понимает префикс драйвера SQLAlchemy
+        self.dsn = dsn.replace("postgresql+asyncpg://", "postgresql://", 1)
+        self.channel = channel
+        self._connection = None
+        self._callbacks: list[Callable[[list[str]], None]] = []
+        # Запросы в одном соединении asyncpg выполняются по одному
+        self._lock = asyncio.Lock()
+
+    async def publish(self, session: AsyncSession, codes: list[str]):
+        for payload in _payloads(codes):
+            await session.execute(
+                select(func.pg_notify(self.channel, payload))
+            )
+
+    async def announce(self, codes: list[str]):
+        """Рассылает коды сразу, вне транзакции, через соединение
+        подписки; без подписки ничего не делает."""
+        if self._connection is None:
+            return
+        async with self._lock:
+            for payload in _payloads(codes):
+                await self._connection.execute(
+                    "SELECT pg_notify($1, $2)", self.channel, payload
+                )
+
+    async def listen(self, callback: Callable[[list[str]], None]):
+        """Вызывает callback со списком кодов на каждое уведомление.
+
+        Подписчиков может быть несколько, соединение у них общее.
+        """
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is required for cache invalidation")
+
+        self._callbacks.append(callback)
+        if self._connection is not None:
+            return
+
+        def _notified(connection, pid, channel, payload):
+            codes = json.loads(payload)
+            for notify in self._callbacks:
+                notify(codes)
+
+        self._connection = await asyncpg.connect(self.dsn)
+        await self._connection.add_listener(self.channel, _notified)
+
+    async def close(self):
+        self._callbacks.clear()
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+
+class ReferralCodeCache:
+    def __init__(
+        self,
+        size: int = 10000,
+        ttl: float = 30.0,
+        negative_ttl: float = 5.0,
+        channel: PostgresCodeCacheChannel | None = None,
+    ):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.channel = channel
+        self._entries: OrderedDict[str, tuple[float, CodeRecord | None]] = (
+            OrderedDict()
+        )
+        self._generation = 0
+        self._info_key = f"referral_code_cache_{id(self)}"
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    async def get(
+        self,
+        session: AsyncSession,
+        code: str,
+        load: Callable[[AsyncSession, str], Awaitable[ReferralCode | None]],
+    ) -> CodeRecord | None:
+        """Запись кода из кэша или из load; None — кода нет."""
+        entry = self._entries.get(code)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(code)
+                self.hits += 1
+                if entry[1] is None:
+                    self.negative_hits += 1
+                return entry[1]
+            del self._entries[code]
+
+        self.misses += 1
+        generation = self._generation
+        found = await load(session, code)
+        record = CodeRecord.from_model(found) if found is not None else None
+
+        # Пока шла загрузка, коды могли измениться; транзакция, которая
+        # сама меняла коды, видит незакоммиченное — такое не кэшируем
+        if generation == self._generation and not self._touched(session):
+            self._store(code, record)
+        return record
+
+    def _store(self, code: str, record: CodeRecord | None):
+        ttl = self.ttl if record is not None else self.negative_ttl
+        self._entries[code] = (time.monotonic() + ttl, record)
+        self._entries.move_to_end(code)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, codes):
+        self._generation += 1
+        for code in codes:
+            if self._entries.pop(code, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    async def invalidate_after_commit(
+        self,
+        session: AsyncSession,
+        codes: list[str],
+    ):
+        """Сбрасывает коды сейчас, после коммита и в других процессах."""
+        self.invalidate(codes)
+        self._pending(session).update(codes)
+        if self.channel is not None:
+            await self.channel.publish(session, codes)
+
+    def _touched(self, session: AsyncSession) -> bool:
+        return bool(session.sync_session.info.get(self._info_key))
+
+    def _pending(self, session: AsyncSession) -> set[str]:
+        sync_session = session.sync_session
+        pending = sync_session.info.get(self._info_key)
+        if pending is not None:
+            return pending
+
+        pending = sync_session.info[self._info_key] = set()
+
+        @event.listens_for(sync_session, "after_commit")
+        def _committed(_session):
+            self.invalidate(pending)
+
+        @event.listens_for(sync_session, "after_transaction_end")
+        def _ended(_session, transaction):
+            if transaction.parent is None:
+                pending.clear()
+
+        return pending
+
+    async def start(self):
+        """Подписывается на канал инвалидации, если он задан."""
+        if self.channel is not None:
+            await self.channel.listen(self.invalidate)
+
+    async def stop(self):
+        if self.channel is not None:
+            await self.channel.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "capacity": self.size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,196 @@
+"""Шардированные счётчики погашений для популярных кодов.
+
+Погашение через ReferralCodeService.redeem обновляет строку кода, и
+погашения одного кода выстраиваются в очередь на её блокировку. В
+шардированном режиме у кода есть slots строк-слотов: погашение
+увеличивает used случайного слота, число использований — uses_count
+кода плюс used всех слотов.
+
+Лимит не превышается: остаток лимита при уплотнении делится между
+слотами квотами (quota), и слот гасит код условным UPDATE, только пока
+used < quota. Если выбранный слот исчерпан, пробуются остальные; все
+исчерпаны — лимит достигнут.
+
+Обычный код гасится строкой, как без слотов. В слоты раскладываются
+только горячие коды: те, что этот процесс погасил строкой не меньше hot
+раз с прошлого прохода уплотнения. Пока у кода есть слоты, у него
+стоит is_sharded, и гашение строкой его не трогает.
+
+Уплотнение (compact) под блокировкой строки кода переносит used слотов
+в uses_count и заново делит остаток. Код, у которого до лимита осталось
+не больше slack погашений, в слоты не раскладывается: мелкие квоты
+быстро исчерпываются, а при таком остатке строка кода уже не узкое
+место. Слоты кода, который не гасили с прошлого уплотнения, удаляются.
+"""
+
+import asyncio
+import logging
+import random
+from collections import Counter
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+import backend.database.db as db_module
+from backend.ReferralCode.repository import ReferralCodeRepository
+
+logger = logging.getLogger(__name__)
+
+
+def split_quota(remaining: int | None, slots: int) -> list[int | None]:
+    """Делит остаток лимита между слотами; сумма квот равна остатку."""
+    if remaining is None:
+        return [None] * slots
+    base, extra = divmod(remaining, slots)
+    return [base + 1] * extra + [base] * (slots - extra)
+
+
+class ShardedCounters:
+    def __init__(
+        self,
+        slots: int = 16,
+        slack: int = 100,
+        interval: float = 60.0,
+        hot: int = 50,
+        repo: ReferralCodeRepository | None = None,
+    ):
+        if slots < 1:
+            raise ValueError("slots must be positive")
+        self.slots = slots
+        self.slack = slack
+        self.interval = interval
+        self.hot = hot
+        self.repo = repo or ReferralCodeRepository()
+        self._task: asyncio.Task | None = None
+        # Погашения строкой с прошлого прохода — кандидаты в слоты
+        self._row_redeems: Counter[UUID] = Counter()
+        # Коды, у которых по последним данным процесса есть слоты
+        self._sharded: set[UUID] = set()
+
+    def is_sharded(self, code_id: UUID) -> bool:
+        """Подсказка: стоит ли сначала пробовать слоты."""
+        return code_id in self._sharded
+
+    def note_row_redeem(self, code_id: UUID):
+        self._row_redeems[code_id] += 1
+
+    async def redeem(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+    ) -> bool | None:
+        """Гасит код через слот.
+
+        True — погашено; False — слоты исчерпаны или код нельзя погасить;
+        None — у кода нет слотов, гасить нужно строкой кода.
+        """
+        now = datetime.utcnow()
+        slot = random.randrange(self.slots)
+        if await self.repo.increment_shard(session, code_id, slot, now):
+            self._sharded.add(code_id)
+            return True
+
+        open_slots = await self.repo.get_open_shards(session, code_id, now)
+        random.shuffle(open_slots)
+        for slot in open_slots:
+            if await self.repo.increment_shard(session, code_id, slot, now):
+                self._sharded.add(code_id)
+                return True
+
+        if open_slots or await self.repo.has_shards(session, code_id):
+            self._sharded.add(code_id)
+            return False
+        self._sharded.discard(code_id)
+        return None
+
+    async def total(self, session: AsyncSession, code_id: UUID) -> int | None:
+        return await self.repo.get_uses_count(session, code_id)
+
+    async def compact(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        keep: bool | None = None,
+    ) -> int:
+        """Переносит used слотов в uses_count и заново делит остаток.
+
+        keep — оставить ли код в слотах; None — если через слоты гасили
+        с прошлого уплотнения. Возвращает число перенесённых погашений.
+        """
+        code = await self.repo.lock_code(session, code_id)
+        if code is None:
+            self._sharded.discard(code_id)
+            return 0
+
+        folded = await self.repo.take_shards(session, code_id)
+        if keep is None:
+            keep = folded > 0
+        uses_count = code.uses_count + folded
+        remaining = (
+            code.usage_limit - uses_count
+            if code.usage_limit is not None
+            else None
+        )
+        sharded = keep and code.is_active and (
+            remaining is None or remaining > self.slack
+        )
+
+        if folded or sharded != code.is_sharded:
+            await self.repo.fold_shards(session, code_id, folded, sharded)
+            # Строка уже обновлена, объект в сессии приводим к ней без
+            # повторной записи
+            set_committed_value(code, "uses_count", uses_count)
+            set_committed_value(code, "is_sharded", sharded)
+        if sharded:
+            await self.repo.create_shards(
+                session, code_id, split_quota(remaining, self.slots)
+            )
+            self._sharded.add(code_id)
+        else:
+            self._sharded.discard(code_id)
+        return folded
+
+    async def compact_all(self, session: AsyncSession) -> int:
+        """Уплотняет все коды со слотами; слоты простаивавших удаляет,
+        горячие коды раскладывает в слоты."""
+        hot = {
+            code_id
+            for code_id, n in self._row_redeems.items()
+            if n >= self.hot
+        }
+        self._row_redeems.clear()
+
+        folded = 0
+        sharded = await self.repo.get_sharded_code_ids(session)
+        for code_id in sharded:
+            folded += await self.compact(
+                session, code_id, keep=True if code_id in hot else None
+            )
+            await session.commit()
+        for code_id in hot.difference(sharded):
+            await self.compact(session, code_id, keep=True)
+            await session.commit()
+        return folded
+
+    async def start(self):
+        """Запускает периодическое уплотнение."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                async with db_module.db.get_session() as session:
+                    await self.compact_all(session)
+            except Exception:
+                # Неуплотнённые слоты остаются верными, следующий проход
+                # повторит уплотнение
+                logger.exception("Referral code counters compaction failed")
@@ -5,6 +5,7 @@ from sqlalchemy import (
     Boolean,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
@@ -67,6 +68,22 @@ class ReferralCode(AsyncAttrs, Base):
         doc="Максимальное количество использований (None = без ограничений).",
     )
 
+    uses_count: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+        doc="Сколько раз код погашен (см. ReferralCodeService.redeem).",
+    )
+
+    is_sharded: Mapped[bool] = mapped_column(
+        Boolean,
+        nullable=False,
+        default=False,
+        server_default="0",
+        doc="Код гасится через слоты (см. ShardedCounters).",
+    )
+
     is_active: Mapped[bool] = mapped_column(
         Boolean,
         nullable=False,
@@ -86,6 +103,13 @@ class ReferralCode(AsyncAttrs, Base):
             "service_id",
             name="uq_referral_code_service",
         ),
+        # Keyset-пагинация кодов сервиса
+        Index(
+            "ix_referral_codes_service_keyset",
+            "service_id",
+            "created_at",
+            "id",
+        ),
     )
 
     # ORM-связи
@@ -144,3 +168,34 @@ class ReferralCodeUsage(Base):
     referral_code = relationship(
         "ReferralCode", back_populates="usage_records"
     )
+
+
+class ReferralCodeCounterShard(Base):
+    """Слот шардированного счётчика погашений кода.
+
+    Погашение увеличивает used случайного слота, пока он не дошёл до
+    quota; итог — uses_count кода плюс used всех его слотов.
+    """
+
+    __tablename__ = "referral_code_counter_shards"
+
+    referral_code_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True),
+        ForeignKey("referral_codes.id"),
+        primary_key=True,
+    )
+
+    slot: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+    used: Mapped[int] = mapped_column(
+        Integer,
+        nullable=False,
+        default=0,
+        doc="Погашения через этот слот с последнего уплотнения.",
+    )
+
+    quota: Mapped[int | None] = mapped_column(
+        Integer,
+        nullable=True,
+        doc="Доля остатка лимита на слот (None = без ограничений).",
+    )
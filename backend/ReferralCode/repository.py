@@ -1,10 +1,26 @@
 from datetime import datetime
 from uuid import UUID
 
-from sqlalchemy import delete, select, update
+from sqlalchemy import and_, delete, func, insert, or_, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from backend.ReferralCode.models import ReferralCode, ReferralCodeUsage
+from backend.database.pagination import paginate
+from backend.ReferralCode.models import (
+    ReferralCode,
+    ReferralCodeCounterShard,
+    ReferralCodeUsage,
+)
+
+
+def _usable(now: datetime):
+    """Код активен и не истёк на момент now."""
+    return and_(
+        ReferralCode.is_active.is_(True),
+        or_(
+            ReferralCode.expires_at.is_(None),
+            ReferralCode.expires_at > now,
+        ),
+    )
 
 
 class ReferralCodeRepository:
@@ -21,6 +37,23 @@ class ReferralCodeRepository:
         result = await session.execute(stmt)
         return result.scalar_one_or_none()
 
+    async def count_codes(self, session: AsyncSession) -> int:
+        stmt = select(func.count()).select_from(ReferralCode)
+        return (await session.execute(stmt)).scalar_one()
+
+    async def iter_codes(
+        self,
+        session: AsyncSession,
+        batch_size: int = 10000,
+    ):
+        """Все коды таблицы потоком, без загрузки в память целиком."""
+        stmt = select(ReferralCode.code).execution_options(
+            yield_per=batch_size
+        )
+        result = await session.stream_scalars(stmt)
+        async for code in result:
+            yield code
+
     async def get_by_user_external(
         self,
         session: AsyncSession,
@@ -48,6 +81,24 @@ class ReferralCodeRepository:
         result = await session.execute(stmt)
         return result.scalars().all()
 
+    async def get_page_by_service(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        limit: int,
+        cursor: str | None = None,
+    ):
+        stmt = select(ReferralCode).where(
+            ReferralCode.service_id == service_id,
+        )
+        return await paginate(
+            session,
+            stmt,
+            [ReferralCode.created_at, ReferralCode.id],
+            limit,
+            cursor,
+        )
+
     async def deactivate(self, session: AsyncSession, code_id: UUID):
         stmt = (
             update(ReferralCode)
@@ -79,6 +130,41 @@ class ReferralCodeRepository:
         await session.flush()
         return result.scalar_one_or_none()
 
+    async def redeem(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        now: datetime,
+        unsharded: bool = False,
+    ):
+        """Гасит код одним UPDATE: проверка и увеличение счётчика атомарны.
+
+        None — код не найден, неактивен, истёк или исчерпал лимит; с
+        unsharded — ещё и если код гасится через слоты. Условие стоит на
+        самой строке кода, поэтому перепроверяется и после ожидания её
+        блокировки.
+        """
+        conditions = [
+            ReferralCode.id == code_id,
+            _usable(now),
+            or_(
+                ReferralCode.usage_limit.is_(None),
+                ReferralCode.uses_count < ReferralCode.usage_limit,
+            ),
+        ]
+        if unsharded:
+            conditions.append(ReferralCode.is_sharded.is_(False))
+
+        stmt = (
+            update(ReferralCode)
+            .where(*conditions)
+            .values(uses_count=ReferralCode.uses_count + 1)
+            .returning(ReferralCode)
+            .execution_options(populate_existing=True)
+        )
+        result = await session.execute(stmt)
+        return result.scalar_one_or_none()
+
     async def get_inactive(self, session: AsyncSession, service_id: UUID):
         stmt = select(ReferralCode).where(
             ReferralCode.service_id == service_id,
@@ -107,8 +193,168 @@ class ReferralCodeRepository:
         res = await session.execute(stmt)
         return res.scalars().all()
 
+    async def iter_usage_history(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        batch_size: int = 1000,
+    ):
+        """Потоково отдаёт историю использований кода без загрузки
+        ORM-объектов."""
+        stmt = (
+            select(
+                ReferralCodeUsage.id,
+                ReferralCodeUsage.referral_code_id,
+                ReferralCodeUsage.used_by_user_id,
+                ReferralCodeUsage.used_at,
+            )
+            .where(ReferralCodeUsage.referral_code_id == code_id)
+            .order_by(ReferralCodeUsage.used_at)
+            .execution_options(yield_per=batch_size)
+        )
+        result = await session.stream(stmt)
+        async for partition in result.partitions():
+            for row in partition:
+                yield row
+
     async def clear_usage_history(self, session, code_id: UUID):
         stmt = delete(ReferralCodeUsage).where(
             ReferralCodeUsage.referral_code_id == code_id,
         )
         await session.execute(stmt)
+
+    async def increment_shard(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        slot: int,
+        now: datetime,
+    ) -> int | None:
+        """Гасит код через слот одним UPDATE; None — слот исчерпан,
+        его нет или код нельзя погасить."""
+        shard = ReferralCodeCounterShard
+        usable = (
+            select(ReferralCode.id)
+            .where(ReferralCode.id == code_id, _usable(now))
+            .exists()
+        )
+        stmt = (
+            update(shard)
+            .where(
+                shard.referral_code_id == code_id,
+                shard.slot == slot,
+                or_(shard.quota.is_(None), shard.used < shard.quota),
+                usable,
+            )
+            .values(used=shard.used + 1)
+            .returning(shard.used)
+            .execution_options(synchronize_session=False)
+        )
+        return (await session.execute(stmt)).scalar_one_or_none()
+
+    async def get_open_shards(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        now: datetime,
+    ) -> list[int]:
+        """Слоты с остатком квоты, если код можно погасить."""
+        shard = ReferralCodeCounterShard
+        stmt = (
+            select(shard.slot)
+            .join(ReferralCode, ReferralCode.id == shard.referral_code_id)
+            .where(
+                shard.referral_code_id == code_id,
+                or_(shard.quota.is_(None), shard.used < shard.quota),
+                _usable(now),
+            )
+        )
+        return list((await session.execute(stmt)).scalars())
+
+    async def has_shards(self, session: AsyncSession, code_id: UUID) -> bool:
+        stmt = select(
+            select(ReferralCodeCounterShard.slot)
+            .where(ReferralCodeCounterShard.referral_code_id == code_id)
+            .exists()
+        )
+        return (await session.execute(stmt)).scalar_one()
+
+    async def get_uses_count(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+    ) -> int | None:
+        """uses_count кода вместе с ещё не уплотнёнными слотами."""
+        shard = ReferralCodeCounterShard
+        sharded = (
+            select(func.coalesce(func.sum(shard.used), 0))
+            .where(shard.referral_code_id == code_id)
+            .scalar_subquery()
+        )
+        stmt = select(ReferralCode.uses_count + sharded).where(
+            ReferralCode.id == code_id
+        )
+        return (await session.execute(stmt)).scalar_one_or_none()
+
+    async def lock_code(self, session: AsyncSession, code_id: UUID):
+        """Читает код с блокировкой строки до конца транзакции."""
+        stmt = (
+            select(ReferralCode)
+            .where(ReferralCode.id == code_id)
+            .with_for_update()
+            .execution_options(populate_existing=True)
+        )
+        return (await session.execute(stmt)).scalar_one_or_none()
+
+    async def take_shards(self, session: AsyncSession, code_id: UUID) -> int:
+        """Удаляет слоты кода и возвращает сумму их used."""
+        shard = ReferralCodeCounterShard
+        stmt = (
+            delete(shard)
+            .where(shard.referral_code_id == code_id)
+            .returning(shard.used)
+            .execution_options(synchronize_session=False)
+        )
+        return sum((await session.execute(stmt)).scalars())
+
+    async def fold_shards(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        n: int,
+        sharded: bool,
+    ):
+        """Прибавляет n погашений из слотов и отмечает, есть ли слоты."""
+        stmt = (
+            update(ReferralCode)
+            .where(ReferralCode.id == code_id)
+            .values(
+                uses_count=ReferralCode.uses_count + n,
+                is_sharded=sharded,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        await session.execute(stmt)
+
+    async def create_shards(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        quotas: list[int | None],
+    ):
+        await session.execute(
+            insert(ReferralCodeCounterShard),
+            [
+                {
+                    "referral_code_id": code_id,
+                    "slot": slot,
+                    "used": 0,
+                    "quota": quota,
+                }
+                for slot, quota in enumerate(quotas)
+            ],
+        )
+
+    async def get_sharded_code_ids(self, session: AsyncSession) -> list[UUID]:
+        stmt = select(ReferralCodeCounterShard.referral_code_id).distinct()
+        return list((await session.execute(stmt)).scalars())
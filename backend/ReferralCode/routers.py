@@ -1,21 +1,77 @@
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
 import backend.database.db as db_module
+from backend.compression import compressed_response
+from backend.config import db_settings, referral_settings
 
+from backend.ReferralCode.bloom import ReferralCodeFilter
+from backend.ReferralCode.cache import (
+    PostgresCodeCacheChannel,
+    ReferralCodeCache,
+)
+from backend.ReferralCode.counters import ShardedCounters
 from backend.ReferralCode.schemas import (
+    ReferralCodeCacheStats,
     ReferralCodeCreate,
+    ReferralCodeFilterStats,
+    ReferralCodePage,
     ReferralCodeRead,
+    ReferralCodeRedeem,
+    ReferralCodeRedeemRead,
     ReferralCodeUpdate,
-    ReferralCodeUsageRead,
 )
 from backend.ReferralCode.service import ReferralCodeService
 
 router = APIRouter(prefix="/referral-codes", tags=["Referral Codes"])
 
-service = ReferralCodeService()
+code_channel = (
+    PostgresCodeCacheChannel(db_settings.url)
+    if referral_settings.code_cache_channel == "postgres"
+    else None
+)
+code_cache = ReferralCodeCache(
+    size=referral_settings.code_cache_size,
+    ttl=referral_settings.code_cache_ttl,
+    negative_ttl=referral_settings.code_cache_negative_ttl,
+    channel=code_channel,
+)
+code_filter = (
+    ReferralCodeFilter(
+        error_rate=referral_settings.code_filter_error_rate,
+        refresh=referral_settings.code_filter_refresh,
+        channel=code_channel,
+    )
+    if referral_settings.code_filter
+    else None
+)
+code_counters = (
+    ShardedCounters(
+        slots=referral_settings.code_counter_slots,
+        slack=referral_settings.code_counter_slack,
+        interval=referral_settings.code_counter_compact_interval,
+        hot=referral_settings.code_counter_hot,
+    )
+    if referral_settings.code_counter_slots > 0
+    else None
+)
+service = ReferralCodeService(
+    cache=code_cache,
+    code_filter=code_filter,
+    counters=code_counters,
+)
+
+router.add_event_handler("startup", code_cache.start)
+router.add_event_handler("shutdown", code_cache.stop)
+if code_filter is not None:
+    router.add_event_handler("startup", code_filter.start)
+    router.add_event_handler("shutdown", code_filter.stop)
+if code_counters is not None:
+    router.add_event_handler("startup", code_counters.start)
+    router.add_event_handler("shutdown", code_counters.stop)
 
 
 async def get_session():
@@ -31,6 +87,18 @@ async def create_code(
     return await service.create_code(session, data)
 
 
+@router.get("/cache/stats", response_model=ReferralCodeCacheStats)
+async def get_cache_stats():
+    return code_cache.stats()
+
+
+@router.get("/filter/stats", response_model=ReferralCodeFilterStats)
+async def get_filter_stats():
+    if code_filter is None:
+        raise HTTPException(status_code=404, detail="Code filter is disabled")
+    return code_filter.stats()
+
+
 @router.get("/{code}", response_model=ReferralCodeRead)
 async def validate_code(
     code: str,
@@ -59,12 +127,31 @@ async def deactivate_code(
     return await service.deactivate_code(session, code_id)
 
 
-@router.get("/service/{service_id}", response_model=list[ReferralCodeRead])
+@router.post("/{code_id}/redeem", response_model=ReferralCodeRedeemRead)
+async def redeem_code(
+    code_id: UUID,
+    data: ReferralCodeRedeem,
+    session: AsyncSession = Depends(get_session),
+):
+    try:
+        return await service.redeem(session, code_id, data.user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/service/{service_id}", response_model=ReferralCodePage)
 async def get_codes_by_service(
     service_id: UUID,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = None,
     session: AsyncSession = Depends(get_session),
 ):
-    return await service.get_codes_by_service(session, service_id)
+    try:
+        return await service.get_codes_page_by_service(
+            session, service_id, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/inactive/{service_id}", response_model=list[ReferralCodeRead])
@@ -75,12 +162,24 @@ async def get_inactive_codes(
     return await service.get_inactive_codes(session, service_id)
 
 
-@router.get("/history/{code_id}", response_model=list[ReferralCodeUsageRead])
+@router.get("/history/{code_id}", response_class=StreamingResponse)
 async def get_referral_code_history(
+    request: Request,
     code_id: UUID,
-    session: AsyncSession = Depends(get_session),
 ):
-    return await service.get_usage_history(session, code_id)
+    """История использований кода (список ReferralCodeUsageRead),
+    отдаётся потоком."""
+
+    # Сессия открывается внутри генератора: зависимость get_session
+    # закрывается до того, как ответ начнёт отправляться.
+    async def body():
+        async with db_module.db.get_session() as session:
+            async for chunk in service.stream_usage_history(
+                session, code_id
+            ):
+                yield chunk
+
+    return compressed_response(request, body(), "application/json")
 
 
 @router.delete("/history/{code_id}")
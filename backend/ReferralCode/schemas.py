@@ -25,11 +25,24 @@ class ReferralCodeRead(BaseModel):
         from_attributes = True
 
 
+class ReferralCodePage(BaseModel):
+    items: list[ReferralCodeRead]
+    next_cursor: str | None = None
+
+
 class ReferralCodeUpdate(BaseModel):
     expires_at: datetime | None = None
     usage_limit: int | None = None
 
 
+class ReferralCodeRedeem(BaseModel):
+    user_id: UUID
+
+
+class ReferralCodeRedeemRead(ReferralCodeRead):
+    uses_count: int
+
+
 class ReferralCodeUsageRead(BaseModel):
     id: UUID
     referral_code_id: UUID
@@ -38,3 +51,26 @@ class ReferralCodeUsageRead(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class ReferralCodeCacheStats(BaseModel):
+    size: int
+    capacity: int
+    hits: int
+    negative_hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+    hit_ratio: float
+
+
+class ReferralCodeFilterStats(BaseModel):
+    ready: bool
+    codes: int
+    capacity: int
+    bits: int
+    hashes: int
+    memory_bytes: int
+    error_rate: float
+    estimated_error_rate: float
+    rejected: int
@@ -4,16 +4,48 @@ import uuid
 from datetime import datetime
 from uuid import UUID
 
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from backend.ReferralCode.bloom import ReferralCodeFilter
+from backend.ReferralCode.cache import ReferralCodeCache
+from backend.ReferralCode.counters import ShardedCounters
 from backend.ReferralCode.models import ReferralCode
 from backend.ReferralCode.repository import ReferralCodeRepository
-from backend.ReferralCode.schemas import ReferralCodeCreate, ReferralCodeUpdate
+from backend.ReferralCode.schemas import (
+    ReferralCodeCreate,
+    ReferralCodeRead,
+    ReferralCodeRedeemRead,
+    ReferralCodeUpdate,
+    ReferralCodeUsageRead,
+)
+
+# Строк истории использований в одном куске потокового ответа
+HISTORY_CHUNK_ROWS = 500
+
+usage_history_adapter = TypeAdapter(list[ReferralCodeUsageRead])
 
 
 class ReferralCodeService:
-    def __init__(self):
+    def __init__(
+        self,
+        cache: ReferralCodeCache | None = None,
+        code_filter: ReferralCodeFilter | None = None,
+        counters: ShardedCounters | None = None,
+    ):
         self.repo = ReferralCodeRepository()
+        self.cache = cache
+        self.code_filter = code_filter
+        self.counters = counters
+
+    async def _invalidate(self, session: AsyncSession, codes: list[str]):
+        if self.cache is not None and codes:
+            await self.cache.invalidate_after_commit(session, codes)
+
+    async def _created(self, session: AsyncSession, codes: list[str]):
+        if self.code_filter is not None:
+            await self.code_filter.announce(codes)
+        await self._invalidate(session, codes)
 
     def _generate_code(self) -> str:
         """Генерирует код вида ABC123-XYZ."""
@@ -40,10 +72,23 @@ class ReferralCodeService:
             expires_at=data.expires_at,
             usage_limit=data.usage_limit,
         )
-        return await self.repo.create(session, new_code)
+        created = await self.repo.create(session, new_code)
+        await self._created(session, [created.code])
+        return created
 
     async def validate_code(self, session: AsyncSession, code: str):
-        code_obj = await self.repo.get_by_code(session, code)
+        # Кода нет в фильтре — его точно нет и в базе
+        if self.code_filter is not None and not (
+            await self.code_filter.might_exist(session, code)
+        ):
+            raise ValueError("Invalid code")
+
+        if self.cache is not None:
+            code_obj = await self.cache.get(
+                session, code, self.repo.get_by_code
+            )
+        else:
+            code_obj = await self.repo.get_by_code(session, code)
 
         if not code_obj:
             raise ValueError("Invalid code")
@@ -57,7 +102,10 @@ class ReferralCodeService:
         return code_obj
 
     async def deactivate_code(self, session: AsyncSession, code_id: UUID):
-        return await self.repo.deactivate(session, code_id)
+        code = await self.repo.deactivate(session, code_id)
+        if code is not None:
+            await self._invalidate(session, [code.code])
+        return code
 
     async def update_limits(
         self,
@@ -65,12 +113,18 @@ class ReferralCodeService:
         code_id: UUID,
         data: ReferralCodeUpdate,
     ):
-        return await self.repo.update_limits(
+        code = await self.repo.update_limits(
             session,
             code_id=code_id,
             expires_at=data.expires_at,
             usage_limit=data.usage_limit,
         )
+        if code is not None:
+            await self._invalidate(session, [code.code])
+            if self.counters is not None:
+                # Квоты слотов посчитаны от старого лимита
+                await self.counters.compact(session, code_id)
+        return code
 
     async def mass_generate(
         self,
@@ -92,6 +146,7 @@ class ReferralCodeService:
             codes.append(code)
 
         await session.flush()
+        await self._created(session, [code.code for code in codes])
         return codes
 
     async def get_codes_by_service(
@@ -101,6 +156,18 @@ class ReferralCodeService:
     ):
         return await self.repo.get_all_by_service(session, service_id)
 
+    async def get_codes_page_by_service(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        limit: int,
+        cursor: str | None = None,
+    ):
+        items, next_cursor = await self.repo.get_page_by_service(
+            session, service_id, limit, cursor
+        )
+        return {"items": items, "next_cursor": next_cursor}
+
     async def get_by_user_external(
         self,
         session: AsyncSession,
@@ -115,11 +182,103 @@ class ReferralCodeService:
     ):
         return await self.repo.get_inactive(session, service_id)
 
-    async def log_usage(self, session, code_id: UUID, user_id: UUID):
-        return await self.repo.add_usage(session, code_id, user_id)
+    async def redeem(
+        self,
+        session: AsyncSession,
+        code_id: UUID,
+        user_id: UUID,
+    ):
+        """Гасит код и записывает использование.
+
+        Активность, срок, лимит и увеличение uses_count проверяются одним
+        условным UPDATE, поэтому параллельные погашения не превышают лимит.
+        С шардированными счётчиками у кода, разложенного по слотам, тот
+        же UPDATE идёт по слоту; остальные коды гасятся строкой.
+        """
+        if self.counters is not None:
+            code = await self._redeem_sharded(session, code_id)
+        else:
+            code = await self.repo.redeem(session, code_id, datetime.utcnow())
+        if code is None:
+            raise ValueError(await self._redeem_error(session, code_id))
+
+        await self.repo.add_usage(session, code_id, user_id)
+        return code
+
+    async def _redeem_sharded(self, session: AsyncSession, code_id: UUID):
+        now = datetime.utcnow()
+        if not self.counters.is_sharded(code_id):
+            code = await self.repo.redeem(
+                session, code_id, now, unsharded=True
+            )
+            if code is not None:
+                self.counters.note_row_redeem(code_id)
+                return code
+
+            # Строкой не погасить: код разложен по слотам или его нельзя
+            # погасить вовсе
+            code = await self.repo.get_by_id(session, code_id)
+            if code is None:
+                return None
+            await session.refresh(code)
+            if not code.is_sharded:
+                return None
+
+        redeemed = await self.counters.redeem(session, code_id)
+        if redeemed is None:
+            # Слоты успели уплотнить в строку
+            return await self.repo.redeem(
+                session, code_id, now, unsharded=True
+            )
+        if not redeemed:
+            return None
+
+        code = await self.repo.get_by_id(session, code_id)
+        return ReferralCodeRedeemRead(
+            **ReferralCodeRead.model_validate(code).model_dump(),
+            uses_count=await self.counters.total(session, code_id),
+        )
+
+    async def _redeem_error(self, session: AsyncSession, code_id: UUID):
+        code = await self.repo.get_by_id(session, code_id)
+        if code is None:
+            return "Invalid code"
+        await session.refresh(code)
+
+        if not code.is_active:
+            return "Code is not active"
+        if code.expires_at and code.expires_at < datetime.utcnow():
+            return "Code expired"
+        return "Usage limit reached"
 
     async def get_usage_history(self, session, code_id: UUID):
         return await self.repo.get_usage_history(session, code_id)
 
+    async def stream_usage_history(self, session, code_id: UUID):
+        """История использований кода JSON-массивом по кускам из
+        HISTORY_CHUNK_ROWS строк; строки читаются курсором."""
+        yield b"["
+        first = True
+        rows = []
+        async for row in self.repo.iter_usage_history(session, code_id):
+            rows.append(row)
+            if len(rows) < HISTORY_CHUNK_ROWS:
+                continue
+            yield self._encode_history_chunk(rows, first)
+            first = False
+            rows = []
+
+        if rows:
+            yield self._encode_history_chunk(rows, first)
+        yield b"]"
+
+    def _encode_history_chunk(self, rows, first: bool) -> bytes:
+        items = usage_history_adapter.validate_python(
+            rows, from_attributes=True
+        )
+        # Скобки массива отдаёт stream_usage_history
+        chunk = usage_history_adapter.dump_json(items)[1:-1]
+        return chunk if first else b"," + chunk
+
     async def clear_usage(self, session, code_id: UUID):
         await self.repo.clear_usage_history(session, code_id)
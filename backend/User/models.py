@@ -3,7 +3,7 @@ from __future__ import annotations
 import datetime
 import uuid
 
-from sqlalchemy import DateTime, ForeignKey, String
+from sqlalchemy import DateTime, ForeignKey, Index, String
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import (
@@ -112,6 +112,16 @@ class UserService(AsyncAttrs, Base):
         doc="Дата привязки пользователя к сервису.",
     )
 
+    __table_args__ = (
+        # Keyset-пагинация пользователей сервиса
+        Index(
+            "ix_user_services_service_keyset",
+            "service_id",
+            "created_at",
+            "id",
+        ),
+    )
+
     # ORM-связи
     user = relationship("User", back_populates="services")
     service = relationship("ExternalService", back_populates="users")
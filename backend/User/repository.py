@@ -3,6 +3,7 @@ from uuid import UUID
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from backend.database.pagination import paginate
 from backend.User.models import User, UserService
 
 
@@ -57,6 +58,23 @@ class UserServiceRepository:
         res = await session.execute(stmt)
         return list(res.scalars().all())
 
+    async def get_service_links_page(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        limit: int,
+        cursor: str | None = None,
+    ):
+        """Страница привязок пользователей к сервису."""
+        stmt = select(UserService).where(UserService.service_id == service_id)
+        return await paginate(
+            session,
+            stmt,
+            [UserService.created_at, UserService.id],
+            limit,
+            cursor,
+        )
+
 
 class UserRepository:
     async def create_user(self, session: AsyncSession, user: User):
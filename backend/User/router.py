@@ -1,6 +1,6 @@
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 
 import backend.database.db as db_module
@@ -8,6 +8,7 @@ import backend.database.db as db_module
 from backend.User.schemas import (
     UserCreate,
     UserRead,
+    UserServicePage,
     UserServiceRead,
 )
 from backend.User.service import UserServiceLogic
@@ -52,10 +53,16 @@ async def get_user_services(
 # -----------------------------
 # GET /users/service/{service_id}/users — пользователи сервиса
 # -----------------------------
-@router.get("/service/{service_id}/users", response_model=list[UserServiceRead])
+@router.get("/service/{service_id}/users", response_model=UserServicePage)
 async def get_users_of_service(
     service_id: UUID,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: str | None = None,
     session: AsyncSession = Depends(get_session),
 ):
-    users = await logic.get_users_of_service(session, service_id)
-    return users
+    try:
+        return await logic.get_users_of_service_page(
+            session, service_id, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
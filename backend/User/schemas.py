@@ -45,3 +45,8 @@ class UserServiceRead(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class UserServicePage(BaseModel):
+    items: list[UserServiceRead]
+    next_cursor: str | None = None
@@ -4,10 +4,13 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from backend.User.models import User, UserService
+from backend.User.repository import UserServiceRepository
 from backend.User.schemas import UserCreate
 
 
 class UserServiceLogic:
+    def __init__(self):
+        self.service_repo = UserServiceRepository()
 
     # ------------------------------------------------------
     # 1. Создание пользователя
@@ -56,3 +59,16 @@ class UserServiceLogic:
             select(UserService).where(UserService.service_id == service_id)
         )
         return result.scalars().all()
+
+
+    async def get_users_of_service_page(
+        self,
+        session: AsyncSession,
+        service_id: UUID,
+        limit: int,
+        cursor: str | None = None,
+    ):
+        items, next_cursor = await self.service_repo.get_service_links_page(
+            session, service_id, limit, cursor
+        )
+        return {"items": items, "next_cursor": next_cursor}
@@ -0,0 +1,97 @@
+"""Сжатие потоковых ответов (gzip, zstd) по заголовку Accept-Encoding.
+
+Тело сжимается по мере отдачи, кусок за куском: ответ не собирается в
+памяти целиком, а само сжатие выполняется в пуле потоков и не
+блокирует цикл событий. zstd доступен, если установлен zstandard.
+"""
+
+import asyncio
+import zlib
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - зависит от окружения
+    zstandard = None
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Поддерживаемые кодировки в порядке предпочтения при равном q
+ENCODINGS = (("zstd",) if zstandard is not None else ()) + ("gzip",)
+
+
+def negotiate_encoding(accept_encoding: str | None) -> str | None:
+    """Выбирает кодировку по Accept-Encoding; None — без сжатия."""
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class _ZstdCompressor:
+    def __init__(self):
+        self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._obj.compress(data)
+
+    def flush(self) -> bytes:
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+def make_compressor(encoding: str):
+    if encoding == "gzip":
+        # wbits = 16 + MAX_WBITS — формат gzip с заголовком
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "zstd" and zstandard is not None:
+        return _ZstdCompressor()
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+async def compress_stream(chunks, encoding: str):
+    """Сжимает асинхронный поток кусков (str или bytes)."""
+    compressor = make_compressor(encoding)
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = await asyncio.to_thread(compressor.compress, chunk)
+        if data:
+            yield data
+    yield await asyncio.to_thread(compressor.flush)
+
+
+def compressed_response(
+    request: Request,
+    chunks,
+    media_type: str,
+    headers: dict | None = None,
+) -> StreamingResponse:
+    """Потоковый ответ, сжатый, если клиент это принимает."""
+    headers = {**(headers or {}), "Vary": "Accept-Encoding"}
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    if encoding is not None:
+        chunks = compress_stream(chunks, encoding)
+        headers["Content-Encoding"] = encoding
+
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
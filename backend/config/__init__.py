@@ -1,3 +1,5 @@
 from backend.config.config_db import DatabaseSettings
+from backend.config.config_referral import ReferralSettings
 
 db_settings = DatabaseSettings()
+referral_settings = ReferralSettings()
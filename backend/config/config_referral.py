@@ -0,0 +1,30 @@
+from pydantic_settings import BaseSettings
+
+
+class ReferralSettings(BaseSettings):
+    forest_cache: bool = False
+    ancestor_cache_ttl: float = 60.0
+    stream_queue_size: int = 256
+    export_dir: str = ""
+    export_ttl: float = 3600.0
+    export_max_running: int = 2
+    export_cleanup_interval: float = 300.0
+    code_cache_size: int = 10000
+    code_cache_ttl: float = 30.0
+    code_cache_negative_ttl: float = 5.0
+    # "postgres" — рассылать инвалидацию кэша кодов через LISTEN/NOTIFY
+    code_cache_channel: str = ""
+    # Фильтр Блума кодов: без канала включать, только если процесс один
+    code_filter: bool = False
+    code_filter_error_rate: float = 0.001
+    code_filter_refresh: float = 600.0
+    # Слотов счётчика погашений на код; 0 — считать в строке кода
+    code_counter_slots: int = 0
+    code_counter_slack: int = 100
+    code_counter_compact_interval: float = 60.0
+    code_counter_hot: int = 50
+
+    class Config:
+        env_prefix = "REFERRAL_"
+        env_file = ".env"
+        extra = "ignore"
@@ -0,0 +1,52 @@
+from sqlalchemy import BigInteger
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+
+def upsert_insert(dialect_name: str, table):
+    """INSERT с поддержкой ON CONFLICT для диалекта текущего подключения."""
+    if dialect_name == "postgresql":
+        return postgresql.insert(table)
+    if dialect_name == "sqlite":
+        return sqlite.insert(table)
+    raise NotImplementedError(f"Upsert is not supported by {dialect_name}")
+
+
+class current_txid(FunctionElement):
+    """ID текущей транзакции; 0 там, где записи и так идут по очереди.
+
+    В SQLite пишущая транзакция одна, поэтому порядок записи совпадает
+    с порядком commit.
+    """
+
+    type = BigInteger()
+    inherit_cache = True
+
+
+class visible_txid_limit(FunctionElement):
+    """Граница завершённых транзакций: все транзакции с ID меньше неё
+    уже закоммичены или откатились, новые получат ID не меньше неё."""
+
+    type = BigInteger()
+    inherit_cache = True
+
+
+@compiles(current_txid)
+def _current_txid(element, compiler, **kw):
+    return "0"
+
+
+@compiles(current_txid, "postgresql")
+def _current_txid_pg(element, compiler, **kw):
+    return "txid_current()"
+
+
+@compiles(visible_txid_limit)
+def _visible_txid_limit(element, compiler, **kw):
+    return "9223372036854775807"
+
+
+@compiles(visible_txid_limit, "postgresql")
+def _visible_txid_limit_pg(element, compiler, **kw):
+    return "txid_snapshot_xmin(txid_current_snapshot())"
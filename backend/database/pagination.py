@@ -0,0 +1,78 @@
+import base64
+import binascii
+import json
+from datetime import datetime, timezone
+from uuid import UUID
+
+from sqlalchemy import tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Чем миграция 8077e29e071e заменила NULL в referrals.registered_at.
+# Курсоры, выданные до неё, содержат null и указывают на эту дату.
+NULL_DATETIME = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _dump(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    return value
+
+
+def encode_cursor(values) -> str:
+    """Упаковывает значения ключа сортировки в непрозрачную строку."""
+    raw = json.dumps([_dump(v) for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns) -> list:
+    """Распаковывает курсор, приводя значения к типам колонок."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = json.loads(base64.urlsafe_b64decode(padded))
+        if not isinstance(raw, list) or len(raw) != len(columns):
+            raise ValueError
+
+        values = []
+        for value, column in zip(raw, columns):
+            python_type = column.type.python_type
+            if value is None and python_type is datetime:
+                value = NULL_DATETIME
+            elif python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif python_type is UUID:
+                value = UUID(value)
+            values.append(value)
+        return values
+    except (ValueError, TypeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+
+async def paginate(
+    session: AsyncSession,
+    stmt,
+    columns,
+    limit: int,
+    cursor: str | None = None,
+):
+    """Keyset-пагинация: строки строго после курсора по ключу columns.
+
+    Стоимость страницы не зависит от её номера, если ключ покрыт индексом.
+    Возвращает (items, next_cursor); next_cursor = None на последней
+    странице.
+    """
+    if cursor:
+        values = decode_cursor(cursor, columns)
+        stmt = stmt.where(tuple_(*columns) > tuple_(*values))
+
+    stmt = stmt.order_by(*columns).limit(limit + 1)
+    res = await session.execute(stmt)
+    items = list(res.scalars().all())
+
+    if len(items) <= limit:
+        return items, None
+
+    items = items[:limit]
+    last = items[-1]
+    return items, encode_cursor([getattr(last, c.key) for c in columns])
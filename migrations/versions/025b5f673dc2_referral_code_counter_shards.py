@@ -0,0 +1,70 @@
+"""referral code counter shards
+
+Добавляет referral_codes.is_sharded и таблицу слотов
+referral_code_counter_shards для ShardedCounters. Существующие коды
+остаются обычными: слоты появляются при уплотнении горячих кодов.
+
+Revision ID: 025b5f673dc2
+Revises: 9d5f8f2c9a8e
+Create Date: 2026-10-18 19:30:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '025b5f673dc2'
+down_revision: Union[str, Sequence[str], None] = '9d5f8f2c9a8e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SHARDS = "referral_code_counter_shards"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Пустая база: схему создаст create_all (см. 3b1f0c9d2e47)
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("referral_codes"):
+        return
+
+    columns = {c["name"] for c in inspector.get_columns("referral_codes")}
+    if "is_sharded" not in columns:
+        op.add_column(
+            "referral_codes",
+            sa.Column(
+                "is_sharded",
+                sa.Boolean(),
+                nullable=False,
+                server_default=sa.false(),
+            ),
+        )
+
+    if not inspector.has_table(SHARDS):
+        op.create_table(
+            SHARDS,
+            sa.Column(
+                "referral_code_id",
+                postgresql.UUID(as_uuid=True),
+                sa.ForeignKey("referral_codes.id"),
+                nullable=False,
+            ),
+            sa.Column("slot", sa.Integer(), nullable=False),
+            sa.Column("used", sa.Integer(), nullable=False),
+            sa.Column("quota", sa.Integer(), nullable=True),
+            sa.PrimaryKeyConstraint("referral_code_id", "slot"),
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table(SHARDS):
+        op.drop_table(SHARDS)
+    if inspector.has_table("referral_codes"):
+        with op.batch_alter_table("referral_codes") as batch:
+            batch.drop_column("is_sharded")
@@ -0,0 +1,81 @@
+"""unique referred user per service
+
+Убирает повторные связи одного приглашённого в сервисе, оставляя самую
+раннюю (NULL в registered_at считается самым ранним, id — при равенстве),
+и создаёт уникальный индекс ux_referrals_service_referred.
+
+Счётчики и замыкание удалённых связей после миграции пересобираются:
+python -m backend.Referral.backfill
+
+На пустой базе (таблицы referrals ещё нет) миграции этой цепочки ничего
+не делают: схему целиком создаёт Database.create_all по моделям, в
+которых все изменения цепочки уже есть.
+
+Revision ID: 3b1f0c9d2e47
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b1f0c9d2e47'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEX = "ux_referrals_service_referred"
+
+# Все связи, у которых есть более ранняя связь того же приглашённого
+DUPLICATES = """
+    SELECT r.id FROM referrals r
+    WHERE EXISTS (
+        SELECT 1 FROM referrals e
+        WHERE e.service_id = r.service_id
+          AND e.referred_id = r.referred_id
+          AND (
+            COALESCE(e.registered_at, '1970-01-01')
+                < COALESCE(r.registered_at, '1970-01-01')
+            OR (
+                COALESCE(e.registered_at, '1970-01-01')
+                    = COALESCE(r.registered_at, '1970-01-01')
+                AND e.id < r.id
+            )
+          )
+    )
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("referrals"):
+        return
+    if INDEX in {i["name"] for i in inspector.get_indexes("referrals")}:
+        return
+
+    # Журнал изменений ссылается на связи внешним ключом
+    if inspector.has_table("referral_changes"):
+        op.execute(
+            f"DELETE FROM referral_changes WHERE referral_id IN ({DUPLICATES})"
+        )
+    op.execute(f"DELETE FROM referrals WHERE id IN ({DUPLICATES})")
+
+    op.create_index(
+        INDEX,
+        "referrals",
+        ["service_id", "referred_id"],
+        unique=True,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("referrals"):
+        return
+    op.drop_index(INDEX, table_name="referrals")
@@ -0,0 +1,66 @@
+"""referrals.registered_at not null
+
+Заменяет NULL в referrals.registered_at началом эпохи — раньше
+keyset-пагинация сортировала такие связи именно так — и запрещает NULL.
+Сортировка страниц рефералов идёт по самой колонке, и индекс
+ix_referrals_referrer_keyset (service_id, referrer_id, registered_at, id)
+покрывает её целиком.
+
+Revision ID: 8077e29e071e
+Revises: 3b1f0c9d2e47
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+from datetime import datetime, timezone
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8077e29e071e'
+down_revision: Union[str, Sequence[str], None] = '3b1f0c9d2e47'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+referrals = sa.table(
+    "referrals",
+    sa.column("registered_at", sa.DateTime(timezone=True)),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Пустая база: схему создаст create_all (см. 3b1f0c9d2e47)
+    if not sa.inspect(op.get_bind()).has_table("referrals"):
+        return
+
+    op.execute(
+        referrals.update()
+        .where(referrals.c.registered_at.is_(None))
+        .values(registered_at=EPOCH)
+    )
+    with op.batch_alter_table("referrals") as batch:
+        batch.alter_column(
+            "registered_at",
+            existing_type=sa.DateTime(timezone=True),
+            existing_server_default=sa.func.now(),
+            nullable=False,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if not sa.inspect(op.get_bind()).has_table("referrals"):
+        return
+
+    with op.batch_alter_table("referrals") as batch:
+        batch.alter_column(
+            "registered_at",
+            existing_type=sa.DateTime(timezone=True),
+            existing_server_default=sa.func.now(),
+            nullable=True,
+        )
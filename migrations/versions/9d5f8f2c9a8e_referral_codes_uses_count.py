@@ -0,0 +1,63 @@
+"""referral_codes.uses_count
+
+Добавляет счётчик погашений кода, по которому ReferralCodeService.redeem
+проверяет usage_limit, и заполняет его числом строк в
+referral_code_usage — иначе коды, погашенные до миграции, получили бы
+лимит заново.
+
+Revision ID: 9d5f8f2c9a8e
+Revises: 8077e29e071e
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d5f8f2c9a8e'
+down_revision: Union[str, Sequence[str], None] = '8077e29e071e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BACKFILL = """
+    UPDATE referral_codes SET uses_count = (
+        SELECT COUNT(*) FROM referral_code_usage u
+        WHERE u.referral_code_id = referral_codes.id
+    )
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Пустая база: схему создаст create_all (см. 3b1f0c9d2e47)
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("referral_codes"):
+        return
+    columns = {c["name"] for c in inspector.get_columns("referral_codes")}
+    if "uses_count" in columns:
+        return
+
+    op.add_column(
+        "referral_codes",
+        sa.Column(
+            "uses_count",
+            sa.Integer(),
+            nullable=False,
+            server_default="0",
+        ),
+    )
+    if inspector.has_table("referral_code_usage"):
+        op.execute(BACKFILL)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table("referral_codes"):
+        return
+
+    with op.batch_alter_table("referral_codes") as batch:
+        batch.drop_column("uses_count")
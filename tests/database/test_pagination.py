@@ -0,0 +1,37 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from backend.database.pagination import (
+    NULL_DATETIME,
+    decode_cursor,
+    encode_cursor,
+)
+from backend.Referral.models import Referral
+
+
+def test_cursor_roundtrip():
+    ts = datetime(2024, 5, 1, 12, 30, 15, 123456)
+    ref_id = uuid.uuid4()
+
+    cursor = encode_cursor([ts, ref_id])
+    values = decode_cursor(cursor, [Referral.registered_at, Referral.id])
+
+    assert values == [ts, ref_id]
+    assert "=" not in cursor
+
+
+def test_cursor_with_null_date():
+    ref_id = uuid.uuid4()
+
+    cursor = encode_cursor([None, ref_id])
+    values = decode_cursor(cursor, [Referral.registered_at, Referral.id])
+
+    assert values == [NULL_DATETIME, ref_id]
+
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", encode_cursor([1])])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor, [Referral.registered_at, Referral.id])
@@ -129,7 +129,7 @@ async def test_get_user_referrals(client, session):
     response = client.get(f"/referrals/{a.id}/{svc.id}")
 
     assert response.status_code == 200
-    arr = response.json()
+    arr = response.json()["items"]
     assert len(arr) == 1
     assert arr[0]["referred_id"] == str(b.id)
 
@@ -167,8 +167,9 @@ async def test_get_parent_chain(client, session):
 
     assert response.status_code == 200
     chain = response.json()
-    assert len(chain) == 1
+    assert len(chain) == 2
     assert chain[0]["referrer_id"] == str(b.id)
+    assert chain[1]["referrer_id"] == str(a.id)
 
 
 @pytest.mark.asyncio
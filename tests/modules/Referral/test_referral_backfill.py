@@ -0,0 +1,230 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.backfill import STEPS, backfill_service
+from backend.Referral.models import (
+    BACKFILL_CLOSURE,
+    Referral,
+    ReferralClosure,
+)
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+async def create_svc(session):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+async def legacy_chain(session, svc, users):
+    """Связи, записанные до появления производных таблиц: запрос в обход
+    ORM не трогает ни замыкание, ни счётчики."""
+    await session.execute(
+        insert(Referral),
+        [
+            {
+                "id": uuid.uuid4(),
+                "referrer_id": referrer.id,
+                "referred_id": referred.id,
+                "service_id": svc.id,
+                "level": level,
+            }
+            for level, (referrer, referred) in enumerate(
+                zip(users, users[1:]), 1
+            )
+        ],
+    )
+
+
+def edge(referrer, referred, svc):
+    return ReferralCreate(
+        referrer_id=referrer.id,
+        referred_id=referred.id,
+        service_id=svc.id,
+    )
+
+
+@pytest.mark.asyncio
+async def test_cycle_detected_before_backfill(session):
+    service = ReferralService()
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+    await legacy_chain(session, svc, [a, b, c])
+
+    with pytest.raises(ValueError, match="Cycle detected"):
+        await service.register_referral(session, edge(c, a, svc))
+
+    results = await service.register_referrals_bulk(
+        session, [edge(c, a, svc)]
+    )
+    assert results[0]["detail"] == "Cycle detected"
+
+
+@pytest.mark.asyncio
+async def test_backfill_populates_closure(session):
+    service = ReferralService()
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+    await legacy_chain(session, svc, [a, b, c])
+
+    assert await backfill_service(session, svc.id) == list(STEPS)
+    assert await service.repo.is_backfilled(
+        session, svc.id, BACKFILL_CLOSURE
+    )
+
+    pairs = await session.scalar(
+        select(func.count()).where(ReferralClosure.service_id == svc.id)
+    )
+    assert pairs == 3
+    assert await service.repo.is_ancestor(session, svc.id, a.id, c.id)
+
+    # Повторный запуск ничего не ломает
+    await backfill_service(session, svc.id)
+    with pytest.raises(ValueError, match="Cycle detected"):
+        await service.register_referral(session, edge(c, a, svc))
+
+
+@pytest.mark.asyncio
+async def test_new_service_uses_closure_without_backfill(session):
+    service = ReferralService()
+    svc = await create_svc(session)
+    a, b = [await create_user(session, svc.id) for _ in range(2)]
+
+    await service.register_referral(session, edge(a, b, svc))
+
+    assert await service.repo.is_backfilled(
+        session, svc.id, BACKFILL_CLOSURE
+    )
+
+
+@pytest.mark.asyncio
+async def test_downline_before_backfill(session):
+    service = ReferralService()
+    svc = await create_svc(session)
+    a, b, c, d = [await create_user(session, svc.id) for _ in range(4)]
+    await legacy_chain(session, svc, [a, b, c, d])
+
+    before = await service.get_downline(session, a.id, svc.id, limit=2)
+    assert before["total"] == 3
+    assert before["depths"] == [
+        {"depth": 1, "count": 1},
+        {"depth": 2, "count": 1},
+        {"depth": 3, "count": 1},
+    ]
+    page = await service.get_downline(
+        session, a.id, svc.id, limit=2, cursor=before["next_cursor"]
+    )
+    items = before["items"] + page["items"]
+    assert [item["user_id"] for item in items] == [b.id, c.id, d.id]
+    assert page["next_cursor"] is None
+
+    roots = await service.repo.get_roots_for(
+        session, svc.id, [a.id, c.id, d.id], by_walk=True
+    )
+    assert roots == {a.id: a.id, c.id: a.id, d.id: a.id}
+
+    # После backfill ответ по замыканию тот же
+    await backfill_service(session, svc.id)
+    after = await service.get_downline(session, a.id, svc.id, limit=2)
+    assert after == before
+    assert await service.repo.get_roots_for(
+        session, svc.id, [a.id, c.id, d.id]
+    ) == roots
+
+
+@pytest.mark.asyncio
+async def test_relevel_before_backfill(session):
+    service = ReferralService()
+    svc = await create_svc(session)
+    a, b, c, d = [await create_user(session, svc.id) for _ in range(4)]
+    await legacy_chain(session, svc, [a, b, c, d])
+
+    first = await session.scalar(
+        select(Referral).where(Referral.referred_id == b.id)
+    )
+    _, updated = await service.force_update_level(session, first.id, 5)
+    assert updated == 2
+
+    levels = dict(
+        (await session.execute(
+            select(Referral.referred_id, Referral.level)
+        )).all()
+    )
+    assert levels == {b.id: 5, c.id: 6, d.id: 7}
+
+
+@pytest.mark.asyncio
+async def test_backfill_daily_stats(session):
+    service = ReferralService()
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+    await legacy_chain(session, svc, [a, b, c])
+
+    assert await service.repo.get_daily_stats(session, svc.id) == []
+
+    await backfill_service(session, svc.id)
+
+    stats = await service.repo.get_daily_stats(session, svc.id)
+    assert [tuple(row) for row in stats] == [(1, 1), (2, 1)]
+    assert await service.repo.count_referrals(session, svc.id) == 2
+
+
+@pytest.mark.asyncio
+async def test_backfill_leaderboard(session):
+    service = ReferralService()
+    svc = await create_svc(session)
+    a, b, c, d = [await create_user(session, svc.id) for _ in range(4)]
+    await legacy_chain(session, svc, [a, b, c])
+    await legacy_chain(session, svc, [a, d])
+
+    assert await service.repo.get_leaderboard(session, svc.id, "all") == []
+
+    await backfill_service(session, svc.id)
+    # Повторный запуск не удваивает счётчики
+    await backfill_service(session, svc.id)
+
+    for period in ("all", "7d"):
+        rows = await service.repo.get_leaderboard(session, svc.id, period)
+        assert [tuple(row) for row in rows] == [(a.id, 2), (b.id, 1)]
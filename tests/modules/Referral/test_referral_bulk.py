@@ -0,0 +1,168 @@
+import json
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.repository import ReferralRepository
+from backend.Referral.routers import _parse_bulk_body
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+@pytest.fixture
+def service():
+    return ReferralService()
+
+
+async def create_svc(session):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+def edge(referrer, referred, svc):
+    return ReferralCreate(
+        referrer_id=referrer.id,
+        referred_id=referred.id,
+        service_id=svc.id,
+        referral_code_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_bulk_resolves_levels_out_of_order(session, service):
+    svc = await create_svc(session)
+    a, b, c, d = [await create_user(session, svc.id) for _ in range(4)]
+
+    results = await service.register_referrals_bulk(
+        session,
+        [edge(c, d, svc), edge(a, b, svc), edge(b, c, svc)],
+    )
+
+    assert [r["status"] for r in results] == ["created"] * 3
+    assert [r["level"] for r in results] == [3, 1, 2]
+
+    repo = ReferralRepository()
+    assert await repo.is_ancestor(session, svc.id, a.id, d.id)
+    chain = await service.get_parent_chain(session, d.id, svc.id)
+    assert [r.referrer_id for r in chain] == [c.id, b.id, a.id]
+
+
+@pytest.mark.asyncio
+async def test_bulk_checks_existing_tree(session, service):
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+
+    await service.register_referral(session, edge(a, b, svc))
+
+    results = await service.register_referrals_bulk(
+        session,
+        [edge(b, c, svc), edge(c, a, svc), edge(a, b, svc)],
+    )
+
+    assert results[0]["status"] == "created"
+    assert results[0]["level"] == 2
+    assert results[1]["detail"] == "Cycle detected"
+    assert results[2]["detail"] == "User already referred"
+
+
+@pytest.mark.asyncio
+async def test_bulk_attaches_existing_subtree(session, service):
+    svc = await create_svc(session)
+    a, b, c, d = [await create_user(session, svc.id) for _ in range(4)]
+
+    await service.register_referral(session, edge(b, c, svc))
+
+    results = await service.register_referrals_bulk(
+        session,
+        [edge(a, b, svc), edge(c, d, svc)],
+    )
+
+    assert [r["status"] for r in results] == ["created", "created"]
+
+    repo = ReferralRepository()
+    assert await repo.is_ancestor(session, svc.id, a.id, c.id)
+    assert await repo.is_ancestor(session, svc.id, a.id, d.id)
+
+    with pytest.raises(ValueError, match="Cycle"):
+        await service.register_referral(session, edge(d, a, svc))
+
+
+@pytest.mark.asyncio
+async def test_bulk_cycle_inside_batch(session, service):
+    svc = await create_svc(session)
+    x, y, z = [await create_user(session, svc.id) for _ in range(3)]
+
+    results = await service.register_referrals_bulk(
+        session,
+        [edge(x, y, svc), edge(y, z, svc), edge(z, x, svc), edge(x, x, svc)],
+    )
+
+    assert [r["status"] for r in results] == [
+        "created",
+        "created",
+        "error",
+        "error",
+    ]
+
+
+def test_parse_bulk_body_ndjson_and_array():
+    rows = [
+        {
+            "referrer_id": str(uuid.uuid4()),
+            "referred_id": str(uuid.uuid4()),
+            "service_id": str(uuid.uuid4()),
+        }
+        for _ in range(2)
+    ]
+
+    ndjson = "\n".join(json.dumps(r) for r in rows).encode() + b"\n"
+    parsed = _parse_bulk_body(ndjson, "application/x-ndjson")
+    assert [str(r.referred_id) for r in parsed] == [
+        r["referred_id"] for r in rows
+    ]
+
+    parsed = _parse_bulk_body(json.dumps(rows).encode(), "application/json")
+    assert len(parsed) == 2
+
+    with pytest.raises(ValueError):
+        _parse_bulk_body(b'[{"referrer_id": "nope"}]', "application/json")
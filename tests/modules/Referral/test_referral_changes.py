@@ -0,0 +1,143 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.database.dialect import visible_txid_limit
+from backend.ExternalService.models import ExternalService
+from backend.Referral.models import ReferralChange
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+@pytest.fixture
+def service():
+    return ReferralService()
+
+
+async def create_svc(session, name="svc"):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name=name,
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+def edge(referrer, referred, svc):
+    return ReferralCreate(
+        referrer_id=referrer.id,
+        referred_id=referred.id,
+        service_id=svc.id,
+        referral_code_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_changes_since_token(session, service):
+    svc = await create_svc(session)
+    other = await create_svc(session, "other")
+    a, b, c, d = [await create_user(session, svc.id) for _ in range(4)]
+
+    ab = await service.register_referral(session, edge(a, b, svc))
+    bc = await service.register_referral(session, edge(b, c, svc))
+    await service.register_referral(session, edge(c, d, other))
+
+    feed = await service.get_changes(session, svc.id)
+    assert [item["id"] for item in feed["items"]] == [ab.id, bc.id]
+    assert [item["change"] for item in feed["items"]] == [
+        "created",
+        "created",
+    ]
+    assert feed["has_more"] is False
+
+    # Пустая страница возвращает тот же токен
+    token = feed["next_token"]
+    empty = await service.get_changes(session, svc.id, token)
+    assert empty["items"] == []
+    assert empty["next_token"] == token
+
+    # Смена уровня с пересчётом поддерева попадает в журнал
+    await service.force_update_level(session, ab.id, 5)
+    delta = await service.get_changes(session, svc.id, token)
+    assert {item["id"]: item["level"] for item in delta["items"]} == {
+        ab.id: 5,
+        bc.id: 6,
+    }
+    assert all(item["change"] == "level" for item in delta["items"])
+
+
+@pytest.mark.asyncio
+async def test_changes_pages_and_bulk(session, service):
+    svc = await create_svc(session)
+    users = [await create_user(session, svc.id) for _ in range(5)]
+
+    await service.register_referrals_bulk(
+        session,
+        [edge(users[i], users[i + 1], svc) for i in range(4)],
+    )
+
+    seen, token = [], None
+    while True:
+        page = await service.get_changes(session, svc.id, token, limit=3)
+        seen += [item["referred_id"] for item in page["items"]]
+        token = page["next_token"]
+        if not page["has_more"]:
+            break
+
+    assert sorted(seen) == sorted(user.id for user in users[1:])
+
+    with pytest.raises(ValueError):
+        await service.get_changes(session, svc.id, "not-a-token")
+
+
+def test_feed_reads_only_finished_transactions():
+    dialect = postgresql.dialect()
+
+    stmt = insert(ReferralChange).values(
+        service_id=uuid.uuid4(), referral_id=uuid.uuid4(), kind="created"
+    )
+    assert "txid_current()" in str(stmt.compile(dialect=dialect))
+
+    stmt = select(ReferralChange.seq).where(
+        ReferralChange.txid < visible_txid_limit()
+    )
+    assert "txid_snapshot_xmin(txid_current_snapshot())" in str(
+        stmt.compile(dialect=dialect)
+    )
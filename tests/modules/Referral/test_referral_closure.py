@@ -0,0 +1,227 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.models import Referral, ReferralClosure
+from backend.Referral.repository import ReferralRepository
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+@pytest.fixture
+def service():
+    return ReferralService()
+
+
+async def create_svc(session):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+async def register(service, session, referrer, referred, svc):
+    return await service.register_referral(
+        session,
+        ReferralCreate(
+            referrer_id=referrer.id,
+            referred_id=referred.id,
+            service_id=svc.id,
+            referral_code_id=None,
+        ),
+    )
+
+
+async def closure_depth(session, svc, ancestor, descendant):
+    return await session.scalar(
+        select(ReferralClosure.depth).where(
+            ReferralClosure.service_id == svc.id,
+            ReferralClosure.ancestor_id == ancestor.id,
+            ReferralClosure.descendant_id == descendant.id,
+        )
+    )
+
+
+@pytest.mark.asyncio
+async def test_closure_filled_on_register(session, service):
+    svc = await create_svc(session)
+    users = [await create_user(session, svc.id) for _ in range(4)]
+
+    for referrer, referred in zip(users, users[1:]):
+        await register(service, session, referrer, referred, svc)
+
+    assert await closure_depth(session, svc, users[0], users[3]) == 3
+    assert await closure_depth(session, svc, users[1], users[3]) == 2
+    assert await closure_depth(session, svc, users[2], users[3]) == 1
+    assert await closure_depth(session, svc, users[3], users[0]) is None
+
+
+@pytest.mark.asyncio
+async def test_deep_cycle_detected(session, service):
+    svc = await create_svc(session)
+    users = [await create_user(session, svc.id) for _ in range(6)]
+
+    for referrer, referred in zip(users, users[1:]):
+        await register(service, session, referrer, referred, svc)
+
+    with pytest.raises(ValueError, match="Cycle"):
+        await register(service, session, users[-1], users[0], svc)
+
+    with pytest.raises(ValueError, match="Cycle"):
+        await register(service, session, users[2], users[2], svc)
+
+
+@pytest.mark.asyncio
+async def test_attach_existing_subtree(session, service):
+    svc = await create_svc(session)
+    a = await create_user(session, svc.id)
+    b = await create_user(session, svc.id)
+    c = await create_user(session, svc.id)
+
+    # B → C, затем A → B: C должен стать потомком A второго уровня
+    await register(service, session, b, c, svc)
+    await register(service, session, a, b, svc)
+
+    assert await closure_depth(session, svc, a, c) == 2
+
+    with pytest.raises(ValueError):
+        await register(service, session, c, a, svc)
+
+
+@pytest.mark.asyncio
+async def test_rebuild_closure(session):
+    repo = ReferralRepository()
+    svc = await create_svc(session)
+    a = await create_user(session, svc.id)
+    b = await create_user(session, svc.id)
+    c = await create_user(session, svc.id)
+
+    for referrer, referred, level in ((a, b, 1), (b, c, 2)):
+        session.add(
+            Referral(
+                id=uuid.uuid4(),
+                referrer_id=referrer.id,
+                referred_id=referred.id,
+                service_id=svc.id,
+                level=level,
+            )
+        )
+    await session.flush()
+
+    assert not await repo.is_ancestor(session, svc.id, a.id, c.id)
+
+    await repo.rebuild_closure(session, svc.id)
+
+    assert await repo.is_ancestor(session, svc.id, a.id, c.id)
+    assert await closure_depth(session, svc, a, c) == 2
+
+
+@pytest.mark.asyncio
+async def test_downline(session, service):
+    svc = await create_svc(session)
+    a, b, c, d, e = [await create_user(session, svc.id) for _ in range(5)]
+
+    for referrer, referred in ((a, b), (a, c), (b, d), (d, e)):
+        await register(service, session, referrer, referred, svc)
+
+    downline = await service.get_downline(session, a.id, svc.id)
+    assert downline["total"] == 4
+    assert downline["depths"] == [
+        {"depth": 1, "count": 2},
+        {"depth": 2, "count": 1},
+        {"depth": 3, "count": 1},
+    ]
+
+    downline = await service.get_downline(session, a.id, svc.id, max_depth=2)
+    assert downline["total"] == 3
+    assert {m["user_id"] for m in downline["items"]} == {b.id, c.id, d.id}
+
+    members, cursor = [], None
+    while True:
+        page = await service.get_downline(
+            session, a.id, svc.id, limit=2, cursor=cursor
+        )
+        members.extend(page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert [m["depth"] for m in members] == [1, 1, 2, 3]
+    assert [m["user_id"] for m in members][2:] == [d.id, e.id]
+
+
+@pytest.mark.asyncio
+async def test_force_update_level_cascades(session, service):
+    svc = await create_svc(session)
+    a, b, c, d, e = [await create_user(session, svc.id) for _ in range(5)]
+
+    top = await register(service, session, a, b, svc)
+    child = await register(service, session, b, c, svc)
+    await register(service, session, c, d, svc)
+    await register(service, session, b, e, svc)
+
+    referral, updated = await service.force_update_level(session, top.id, 5)
+
+    assert referral.level == 5
+    assert updated == 3
+    assert child.level == 6
+
+    levels = dict(
+        (
+            await session.execute(
+                select(Referral.referred_id, Referral.level).where(
+                    Referral.service_id == svc.id
+                )
+            )
+        ).all()
+    )
+    assert levels == {b.id: 5, c.id: 6, d.id: 7, e.id: 6}
+
+    stats = await service.get_stats(session, svc.id)
+    assert stats == [
+        {"level": 5, "count": 1},
+        {"level": 6, "count": 2},
+        {"level": 7, "count": 1},
+    ]
+
+    _, updated = await service.force_update_level(session, top.id, 5)
+    assert updated == 0
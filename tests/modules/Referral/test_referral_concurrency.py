@@ -0,0 +1,186 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.locks import TreeLocks
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+PAIRS = 30
+
+
+@pytest.fixture
+async def session_factory(tmp_path):
+    # Файл, а не :memory: — у каждой сессии своё соединение
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'stress.db'}", future=True
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    yield sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    await engine.dispose()
+
+
+async def create_users(session_factory, count):
+    async with session_factory() as s:
+        svc = ExternalService(
+            id=uuid.uuid4(),
+            service_name="svc",
+            api_key="123",
+            webhook_url=None,
+            created_at=datetime.utcnow(),
+        )
+        s.add(svc)
+        users = [
+            User(
+                id=uuid.uuid4(),
+                external_user_id=str(uuid.uuid4()),
+                service_id=svc.id,
+                created_at=datetime.utcnow(),
+            )
+            for _ in range(count)
+        ]
+        s.add_all(users)
+        await s.commit()
+    return svc.id, [user.id for user in users]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_registrations_never_close_cycle(session_factory):
+    service = ReferralService()
+    service_id, users = await create_users(session_factory, 2 * PAIRS + 3)
+
+    async def register(referrer_id, referred_id):
+        async with session_factory() as s:
+            try:
+                await service.register_referral(
+                    s,
+                    ReferralCreate(
+                        referrer_id=referrer_id,
+                        referred_id=referred_id,
+                        service_id=service_id,
+                    ),
+                )
+                await s.commit()
+                return True
+            except ValueError:
+                await s.rollback()
+                return False
+
+    # Встречные пары x → y и y → x плюс треугольник a → b → c → a
+    tasks = []
+    for i in range(PAIRS):
+        x, y = users[2 * i], users[2 * i + 1]
+        tasks += [register(x, y), register(y, x)]
+    a, b, c = users[-3:]
+    tasks += [register(a, b), register(b, c), register(c, a)]
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    print(
+        f"\n{len(tasks)} concurrent registrations in {elapsed:.2f}s "
+        f"({len(tasks) / elapsed:.0f}/s)"
+    )
+
+    for i in range(PAIRS):
+        assert results[2 * i] != results[2 * i + 1]
+    assert sum(results[-3:]) == 2
+
+    async with session_factory() as s:
+        report = await service.relevel_all(s, service_id, dry_run=True)
+    assert report["edges"] == PAIRS + 2
+    assert report["cycles"] == 0
+
+
+@pytest.mark.asyncio
+async def test_unrelated_trees_lock_in_parallel(session_factory):
+    locks = TreeLocks()
+    service_id, (a, b) = await create_users(session_factory, 2)
+
+    async with session_factory() as first, session_factory() as second:
+        await locks.lock_trees(first, service_id, [a])
+
+        # Другое дерево блокируется сразу
+        await asyncio.wait_for(
+            locks.lock_trees(second, service_id, [b]), timeout=1
+        )
+
+        async with session_factory() as third:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    locks.lock_trees(third, service_id, [a]), timeout=0.2
+                )
+
+            # Блокировка снимается вместе с транзакцией
+            await first.rollback()
+            await asyncio.wait_for(
+                locks.lock_trees(third, service_id, [a]), timeout=1
+            )
+            await third.rollback()
+
+        await second.rollback()
+
+    assert locks._locks == {}
+
+
+@pytest.mark.asyncio
+async def test_lock_wait_times_out(session_factory):
+    locks = TreeLocks(timeout=0.1)
+    service_id, (a,) = await create_users(session_factory, 1)
+
+    async with session_factory() as first, session_factory() as second:
+        await locks.lock_trees(first, service_id, [a])
+
+        with pytest.raises(ValueError):
+            await locks.lock_trees(second, service_id, [a])
+
+        await second.rollback()
+        await first.rollback()
+
+    assert locks._locks == {}
+
+
+class FakePgError(Exception):
+    def __init__(self, pgcode):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+@pytest.mark.asyncio
+async def test_postgres_deadlock_reported_as_busy(session_factory):
+    service = ReferralService()
+    service_id, (a, b) = await create_users(session_factory, 2)
+    data = ReferralCreate(referrer_id=a, referred_id=b, service_id=service_id)
+
+    pgcode = "40P01"
+
+    async def lock_trees(*args, **kwargs):
+        raise DBAPIError(
+            "SELECT pg_advisory_xact_lock($1)", None, FakePgError(pgcode)
+        )
+
+    service.locks.lock_trees = lock_trees
+
+    async with session_factory() as s:
+        with pytest.raises(ValueError, match="Referral tree is busy"):
+            await service.register_referral(s, data)
+        with pytest.raises(ValueError, match="Referral tree is busy"):
+            await service.register_referrals_bulk(s, [data])
+
+        # Прочие ошибки СУБД не маскируются
+        pgcode = "40001"
+        with pytest.raises(DBAPIError):
+            await service.register_referral(s, data)
+        await s.rollback()
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.events import OVERFLOW, ReferralEventBroker
+from backend.Referral.schemas import ReferralCreate, ReferralRead
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+@pytest.fixture
+def broker():
+    return ReferralEventBroker(queue_size=4)
+
+
+@pytest.fixture
+def service(broker):
+    return ReferralService(events=broker)
+
+
+async def create_svc(session, name="svc"):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name=name,
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+def edge(referrer, referred, svc):
+    return ReferralCreate(
+        referrer_id=referrer.id,
+        referred_id=referred.id,
+        service_id=svc.id,
+        referral_code_id=None,
+    )
+
+
+def parse(message: bytes):
+    name, data = message.decode().strip().split("\n")
+    return name.removeprefix("event: "), json.loads(data[len("data: "):])
+
+
+@pytest.mark.asyncio
+async def test_events_published_after_commit(session, service, broker):
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+    ab, bc = edge(a, b, svc), edge(b, c, svc)
+    await session.commit()
+
+    subscription = broker.subscribe(svc.id)
+
+    # Откаченная регистрация не видна подписчикам
+    await service.register_referral(session, ab)
+    await session.rollback()
+    assert subscription.queue.empty()
+
+    ref = await service.register_referral(session, ab)
+    assert subscription.queue.empty()
+    await session.commit()
+
+    name, data = parse(subscription.queue.get_nowait())
+    assert name == "created"
+    assert data["id"] == str(ref.id)
+    assert data["level"] == 1
+
+    await service.register_referrals_bulk(session, [bc])
+    await service.force_update_level(session, ref.id, 3)
+    await session.commit()
+
+    events = [parse(subscription.queue.get_nowait()) for _ in range(2)]
+    assert [name for name, _ in events] == ["created", "level"]
+    assert events[0][1]["level"] == 2
+    assert events[1][1]["descendants_updated"] == 1
+
+
+@pytest.mark.asyncio
+async def test_no_serialization_without_subscribers(
+    session, service, broker, monkeypatch
+):
+    svc = await create_svc(session)
+    other = await create_svc(session, "other")
+    users = [await create_user(session, svc.id) for _ in range(4)]
+
+    validated = []
+    validate = ReferralRead.model_validate
+    monkeypatch.setattr(
+        ReferralRead,
+        "model_validate",
+        lambda obj, *a, **kw: validated.append(obj) or validate(obj, *a, **kw),
+    )
+
+    # Подписчик есть только у другого сервиса
+    broker.subscribe(other.id)
+    await service.register_referral(session, edge(users[0], users[1], svc))
+    await service.register_referrals_bulk(
+        session, [edge(users[1], users[2], svc)]
+    )
+    assert validated == []
+
+    broker.subscribe(svc.id)
+    await service.register_referral(session, edge(users[0], users[3], svc))
+    assert len(validated) == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_is_dropped(broker):
+    service_id = uuid.uuid4()
+    slow = broker.subscribe(service_id)
+    fast = broker.subscribe(service_id)
+
+    for i in range(4):
+        broker.publish(service_id, "created", {"n": i})
+        await fast.queue.get()
+
+    # Пятое событие не помещается в очередь медленного подписчика
+    broker.publish(service_id, "created", {"n": 4})
+    assert broker.subscribers(service_id) == 1
+    assert parse(await fast.queue.get())[1] == {"n": 4}
+
+    messages = [message async for message in slow.messages()]
+    assert messages == [OVERFLOW]
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_when_idle(broker):
+    subscription = broker.subscribe(uuid.uuid4())
+    stream = subscription.messages(heartbeat=0.01)
+    assert await asyncio.wait_for(anext(stream), 1) == b": ping\n\n"
+    await stream.aclose()
@@ -0,0 +1,176 @@
+import asyncio
+import gzip
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+
+from backend.ExternalService.models import ExternalService
+from backend.Referral.export_jobs import parse_range
+from backend.Referral.models import Referral, ReferralExportJob
+from backend.Referral.routers import export_jobs
+from backend.User.models import User
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(export_jobs, "directory", str(tmp_path))
+    return export_jobs
+
+
+async def create_data(session, count):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name=f"svc-{uuid.uuid4()}",
+        api_key=str(uuid.uuid4()),
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    users = [
+        User(
+            id=uuid.uuid4(),
+            external_user_id=str(uuid.uuid4()),
+            service_id=svc.id,
+            created_at=datetime.utcnow(),
+        )
+        for _ in range(count + 1)
+    ]
+    session.add_all(users)
+    await session.flush()
+    session.add_all(
+        Referral(
+            id=uuid.uuid4(),
+            referrer_id=referrer.id,
+            referred_id=referred.id,
+            service_id=svc.id,
+            level=1,
+        )
+        for referrer, referred in zip(users, users[1:])
+    )
+    await session.commit()
+    return svc
+
+
+async def wait_done(client, job_id):
+    for _ in range(100):
+        res = await client.get(f"/referrals/export-jobs/{job_id}")
+        if res.json()["status"] in ("done", "failed"):
+            return res.json()
+        await asyncio.sleep(0.02)
+    raise AssertionError("export job did not finish")
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+
+    for header in ("bytes=100-", "bytes=5-1", "bytes=x-1", "bytes=-0"):
+        with pytest.raises(ValueError):
+            parse_range(header, 100)
+
+
+@pytest.mark.asyncio
+async def test_export_job_download_with_range(client, session, jobs):
+    svc = await create_data(session, 5)
+
+    res = await client.post(
+        "/referrals/export-jobs",
+        json={"service_id": str(svc.id), "format": "csv"},
+    )
+    assert res.status_code == 202
+    job = await wait_done(client, res.json()["id"])
+    assert job["status"] == "done"
+    assert job["rows"] == job["total"] == 5
+
+    url = f"/referrals/export-jobs/{job['id']}/download"
+    full = await client.get(url)
+    assert full.status_code == 200
+    assert full.headers["accept-ranges"] == "bytes"
+    assert int(full.headers["content-length"]) == job["size"]
+    lines = gzip.decompress(full.content).decode().splitlines()
+    assert len(lines) == 6
+
+    # Докачка с середины файла
+    part = await client.get(url, headers={"Range": "bytes=10-"})
+    assert part.status_code == 206
+    assert part.headers["content-range"] == (
+        f"bytes 10-{job['size'] - 1}/{job['size']}"
+    )
+    assert full.content[:10] + part.content == full.content
+
+    bad = await client.get(url, headers={"Range": f"bytes={job['size']}-"})
+    assert bad.status_code == 416
+
+    stale = await client.get(
+        url, headers={"Range": "bytes=10-", "If-Range": '"other"'}
+    )
+    assert stale.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_export_job_expires(client, session, jobs, monkeypatch):
+    svc = await create_data(session, 1)
+    monkeypatch.setattr(jobs, "ttl", 0)
+
+    res = await client.post(
+        "/referrals/export-jobs",
+        json={"service_id": str(svc.id), "format": "ndjson"},
+    )
+    job = await wait_done(client, res.json()["id"])
+    path = jobs.path_for(await jobs.get(uuid.UUID(job["id"])))
+
+    await jobs.cleanup()
+
+    res = await client.get(f"/referrals/export-jobs/{job['id']}")
+    assert res.status_code == 404
+    assert not os.path.exists(path)
+
+    res = await client.post(
+        "/referrals/export-jobs",
+        json={"service_id": str(svc.id), "format": "xml"},
+    )
+    assert res.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_interrupted_jobs_fail_on_startup(session, jobs, monkeypatch):
+    svc = await create_data(session, 1)
+    stuck = [
+        ReferralExportJob(service_id=svc.id, format="csv", status=status)
+        for status in ("pending", "running", "done")
+    ]
+    session.add_all(stuck)
+    await session.commit()
+    path = jobs.path_for(stuck[1])
+    with open(path + ".part", "wb") as file:
+        file.write(b"partial")
+
+    monkeypatch.setattr(jobs, "ttl", 0)
+    assert await jobs.fail_interrupted() == 2
+
+    pending, running, done = [await jobs.get(job.id) for job in stuck]
+    assert pending.status == running.status == "failed"
+    assert running.error == "Interrupted by restart"
+    assert running.expires_at is not None
+    assert done.status == "done"
+
+    # Очистка идёт в фоне, без новых задач
+    monkeypatch.setattr(jobs, "interval", 0.01)
+    await jobs.startup()
+    try:
+        for _ in range(100):
+            if await jobs.get(running.id) is None:
+                break
+            await asyncio.sleep(0.02)
+        assert await jobs.get(pending.id) is None
+        assert await jobs.get(running.id) is None
+        assert await jobs.get(done.id) is not None
+        assert not os.path.exists(path + ".part")
+    finally:
+        await jobs.shutdown()
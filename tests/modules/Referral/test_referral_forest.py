@@ -0,0 +1,199 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.forest import ReferralForestCache
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session_factory():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    yield sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    await engine.dispose()
+
+
+@pytest.fixture
+async def session(session_factory):
+    async with session_factory() as s:
+        yield s
+
+
+@pytest.fixture
+def forest():
+    return ReferralForestCache()
+
+
+@pytest.fixture
+def service(forest):
+    return ReferralService(forest=forest)
+
+
+async def create_svc(session):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name=str(uuid.uuid4()),
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+async def register(service, session, referrer, referred, svc):
+    return await service.register_referral(
+        session,
+        ReferralCreate(
+            referrer_id=referrer.id,
+            referred_id=referred.id,
+            service_id=svc.id,
+            referral_code_id=None,
+        ),
+    )
+
+
+@pytest.mark.asyncio
+async def test_forest_lookups(session, service, forest):
+    svc = await create_svc(session)
+    users = [await create_user(session, svc.id) for _ in range(4)]
+
+    for referrer, referred in zip(users, users[1:]):
+        await register(service, session, referrer, referred, svc)
+    await session.commit()
+
+    warm = forest.peek(svc.id)
+    assert warm is not None
+    assert warm.level(users[3].id) == 3
+    assert warm.is_ancestor(users[0].id, users[3].id)
+
+    chain = await service.get_parent_chain(session, users[3].id, svc.id)
+    assert [e.referrer_id for e in chain] == [
+        users[2].id,
+        users[1].id,
+        users[0].id,
+    ]
+
+    with pytest.raises(ValueError, match="Cycle"):
+        await register(service, session, users[3], users[0], svc)
+
+
+@pytest.mark.asyncio
+async def test_forest_level_update(session, service, forest):
+    svc = await create_svc(session)
+    a = await create_user(session, svc.id)
+    b = await create_user(session, svc.id)
+    c = await create_user(session, svc.id)
+    await session.commit()
+
+    ref = await register(service, session, a, b, svc)
+    await service.force_update_level(session, ref.id, 5)
+
+    result = await register(service, session, b, c, svc)
+    assert result.level == 6
+
+    # Общий лес меняется только после commit
+    assert forest.peek(svc.id).level(b.id) is None
+    await session.commit()
+    assert forest.peek(svc.id).level(b.id) == 5
+
+
+@pytest.mark.asyncio
+async def test_forest_buffer_dropped_on_rollback(session, service, forest):
+    svc = await create_svc(session)
+    a = await create_user(session, svc.id)
+    b = await create_user(session, svc.id)
+    await session.commit()
+
+    service_id, b_id = svc.id, b.id
+
+    await register(service, session, a, b, svc)
+    assert forest.peek(service_id).parent(b_id) is None
+    view = await forest.get(session, service_id)
+    assert view.parent(b_id) is not None
+
+    await session.rollback()
+
+    assert forest.peek(service_id).parent(b_id) is None
+    view = await forest.get(session, service_id)
+    assert view.parent(b_id) is None
+
+
+@pytest.mark.asyncio
+async def test_forest_hides_uncommitted_edges(
+    session_factory, service, forest
+):
+    async with session_factory() as s:
+        svc = await create_svc(s)
+        a, b, c = [await create_user(s, svc.id) for _ in range(3)]
+        await register(service, s, a, b, svc)
+        await s.commit()
+
+    async with session_factory() as writer:
+        await register(service, writer, b, c, svc)
+
+        async with session_factory() as reader:
+            chain = await service.get_parent_chain(reader, c.id, svc.id)
+            assert chain == []
+
+        await writer.commit()
+
+    async with session_factory() as reader:
+        chain = await service.get_parent_chain(reader, c.id, svc.id)
+    assert [e.referrer_id for e in chain] == [b.id, a.id]
+
+
+@pytest.mark.asyncio
+async def test_forest_kept_after_read_only_session(
+    session_factory, service, forest
+):
+    async with session_factory() as s:
+        svc = await create_svc(s)
+        a = await create_user(s, svc.id)
+        b = await create_user(s, svc.id)
+        await register(service, s, a, b, svc)
+        await s.commit()
+
+    async with session_factory() as s:
+        chain = await service.get_parent_chain(s, b.id, svc.id)
+
+    assert len(chain) == 1
+    assert forest.peek(svc.id) is not None
+
+
+@pytest.mark.asyncio
+async def test_forest_chains(session, service, forest):
+    svc = await create_svc(session)
+    a, b, c, d = [await create_user(session, svc.id) for _ in range(4)]
+
+    for referrer, referred in ((a, b), (b, c), (a, d)):
+        await register(service, session, referrer, referred, svc)
+
+    result = await service.get_chains(session, svc.id, [c.id, d.id])
+
+    assert result["chains"] == {c.id: [b.id, a.id], d.id: [a.id]}
+    assert len(result["edges"]) == 3
@@ -0,0 +1,128 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.graph import ReferralGraph
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+def build(edges):
+    graph = ReferralGraph(uuid.uuid4())
+    for referrer, referred in edges:
+        graph.add_edge(referrer, referred, 0)
+    graph.build()
+    return graph
+
+
+def test_graph_levels_and_cycles():
+    a, b, c, d, x, y, z = [uuid.uuid4() for _ in range(7)]
+
+    # a → b → c, a → d, цикл x → y → x с хвостом y → z
+    graph = build([(a, b), (b, c), (a, d), (x, y), (y, x), (y, z)])
+    level = {user: graph.levels[graph.node(user)] for user in graph.users}
+
+    assert [level[u] for u in (a, b, c, d)] == [0, 1, 2, 1]
+    assert [level[u] for u in (x, y, z)] == [-1, -1, -1]
+
+    on_cycle = {user: graph.on_cycle[graph.node(user)] for user in graph.users}
+    assert [on_cycle[u] for u in (a, b, x, y, z)] == [0, 0, 1, 1, 0]
+
+
+def test_graph_cycle_with_long_tail():
+    users = [uuid.uuid4() for _ in range(6)]
+    a, b, c, d, e, f = users
+
+    # Хвост f → e → d входит в цикл a → b → c → a
+    graph = build([(a, b), (b, c), (c, a), (d, e), (e, f), (c, d)])
+
+    assert [graph.on_cycle[graph.node(u)] for u in users] == [
+        1, 1, 1, 0, 0, 0,
+    ]
+
+
+def test_graph_chain_and_downline():
+    users = [uuid.uuid4() for _ in range(6)]
+    a, b, c, d, e, f = users
+
+    graph = build([(a, b), (a, c), (b, d), (d, e), (c, f), (b, d)])
+
+    assert graph.edges == 6
+    assert graph.duplicates == 1
+    assert len(graph) == 6
+
+    chain = graph.chain(graph.node(e))
+    assert [graph.users[v] for v in chain] == [d, b, a]
+    assert len(graph.chain(graph.node(e), max_depth=2)) == 2
+
+    assert graph.downline_counts(graph.node(a)) == [2, 2, 1]
+    assert graph.downline_counts(graph.node(a), max_depth=2) == [2, 2]
+    assert graph.downline_counts(graph.node(e)) == []
+    assert {graph.users[v] for v in graph.children_of(graph.node(a))} == {
+        b,
+        c,
+    }
+
+
+@pytest.mark.asyncio
+async def test_graph_load(session):
+    service = ReferralService()
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    users = [
+        User(
+            id=uuid.uuid4(),
+            external_user_id=str(uuid.uuid4()),
+            service_id=svc.id,
+            created_at=datetime.utcnow(),
+        )
+        for _ in range(3)
+    ]
+    session.add_all(users)
+    await session.flush()
+
+    for referrer, referred in zip(users, users[1:]):
+        await service.register_referral(
+            session,
+            ReferralCreate(
+                referrer_id=referrer.id,
+                referred_id=referred.id,
+                service_id=svc.id,
+            ),
+        )
+
+    graph = await ReferralGraph.load(session, svc.id)
+
+    last = graph.node(users[2].id)
+    assert graph.levels[last] == 2
+    assert graph.stored[last] == 2
+    assert [graph.users[v] for v in graph.chain(last)] == [
+        users[1].id,
+        users[0].id,
+    ]
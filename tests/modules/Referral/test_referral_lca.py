@@ -0,0 +1,208 @@
+import random
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.graph import ReferralGraph
+from backend.Referral.lca import AncestorTable
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+def build(edges):
+    graph = ReferralGraph(uuid.uuid4())
+    for referrer, referred in edges:
+        graph.add_edge(referrer, referred, 0)
+    graph.build()
+    return AncestorTable(graph)
+
+
+def naive_lca(graph, u, v):
+    ancestors = {u, *graph.chain(u)}
+    for node in [v, *graph.chain(v)]:
+        if node in ancestors:
+            return node
+    return -1
+
+
+def test_path_between_users():
+    a, b, c, d, e, x, y = [uuid.uuid4() for _ in range(7)]
+
+    # a → b → c → d, b → e; x → y — отдельное дерево
+    table = build([(a, b), (b, c), (c, d), (b, e), (x, y)])
+
+    path = table.path(d, e)
+    assert path["connected"]
+    assert path["common_ancestor"] == b
+    assert path["path"] == [d, c, b, e]
+    assert path["distance"] == 3
+
+    path = table.path(a, d)
+    assert path["common_ancestor"] == a
+    assert path["path"] == [a, b, c, d]
+
+    assert table.path(c, c)["path"] == [c]
+
+    path = table.path(d, y)
+    assert not path["connected"]
+    assert path["path"] == []
+
+    assert not table.path(d, uuid.uuid4())["connected"]
+
+
+def test_lca_matches_naive_walk():
+    rng = random.Random(7)
+    users = [uuid.uuid4() for _ in range(500)]
+
+    # Несколько деревьев с глубокими цепочками и случайными ветками
+    edges = []
+    for i in range(1, len(users)):
+        if i % 100 == 0:
+            continue
+        parent = i - 1 if rng.random() < 0.7 else rng.randrange(i)
+        edges.append((users[parent], users[i]))
+
+    table = build(edges)
+    graph = table.graph
+
+    for _ in range(300):
+        u = rng.randrange(len(graph))
+        v = rng.randrange(len(graph))
+        assert table.lca(u, v) == naive_lca(graph, u, v)
+
+
+def test_cycle_nodes_are_not_connected():
+    a, b, x, y = [uuid.uuid4() for _ in range(4)]
+    table = build([(a, b), (x, y), (y, x), (y, a)])
+
+    assert not table.path(x, y)["connected"]
+    assert not table.path(a, b)["connected"]
+
+
+@pytest.mark.asyncio
+async def test_service_path_sees_new_referrals(session):
+    service = ReferralService()
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    a, b, c = [
+        User(
+            id=uuid.uuid4(),
+            external_user_id=str(uuid.uuid4()),
+            service_id=svc.id,
+            created_at=datetime.utcnow(),
+        )
+        for _ in range(3)
+    ]
+    session.add_all([a, b, c])
+    await session.flush()
+
+    async def register(referrer, referred):
+        await service.register_referral(
+            session,
+            ReferralCreate(
+                referrer_id=referrer.id,
+                referred_id=referred.id,
+                service_id=svc.id,
+            ),
+        )
+
+    await register(a, b)
+    path = await service.get_path(session, b.id, c.id, svc.id)
+    assert not path["connected"]
+
+    await register(a, c)
+    paths = await service.get_paths(session, svc.id, [(b.id, c.id)])
+    assert paths[0]["path"] == [b.id, a.id, c.id]
+
+
+def test_add_leaf_matches_rebuilt_table():
+    rng = random.Random(11)
+    users = [uuid.uuid4() for _ in range(300)]
+
+    edges = [
+        (users[i - 1 if rng.random() < 0.8 else rng.randrange(i)], users[i])
+        for i in range(1, len(users))
+    ]
+    table = build(edges[:10])
+    for referrer, referred in edges[10:]:
+        assert table.add_leaf(referrer, referred)
+
+    rebuilt = build(edges)
+    for _ in range(200):
+        a, b = rng.choice(users), rng.choice(users)
+        assert table.path(a, b) == rebuilt.path(a, b)
+
+    # Приглашённый с поддеревом — уже не лист
+    assert not table.add_leaf(uuid.uuid4(), users[0])
+
+
+@pytest.mark.asyncio
+async def test_cached_table_patched_after_commit(session):
+    service = ReferralService()
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    a, b, c = [
+        User(
+            id=uuid.uuid4(),
+            external_user_id=str(uuid.uuid4()),
+            service_id=svc.id,
+            created_at=datetime.utcnow(),
+        )
+        for _ in range(3)
+    ]
+    session.add_all([a, b, c])
+    await session.commit()
+
+    async def register(referrer, referred):
+        await service.register_referral(
+            session,
+            ReferralCreate(
+                referrer_id=referrer.id,
+                referred_id=referred.id,
+                service_id=svc.id,
+            ),
+        )
+
+    await register(a, b)
+    await session.commit()
+    table = await service.ancestors.get(session, svc.id)
+
+    await register(a, c)
+    # До commit общая таблица связи не видит
+    assert not table.path(b.id, c.id)["connected"]
+    await session.commit()
+
+    assert await service.ancestors.get(session, svc.id) is table
+    assert table.path(b.id, c.id)["path"] == [b.id, a.id, c.id]
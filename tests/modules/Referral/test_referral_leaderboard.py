@@ -0,0 +1,153 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.models import Referral, stats_day
+from backend.Referral.repository import ReferralRepository
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+@pytest.fixture
+def service():
+    return ReferralService()
+
+
+async def create_svc(session):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+def edge(referrer, referred, svc):
+    return ReferralCreate(
+        referrer_id=referrer.id,
+        referred_id=referred.id,
+        service_id=svc.id,
+        referral_code_id=None,
+    )
+
+
+def ranking(top):
+    return [(r.referrer_id, r.count) for r in top]
+
+
+@pytest.mark.asyncio
+async def test_leaderboard_counts_register_and_bulk(session, service):
+    svc = await create_svc(session)
+    a, b, c, d, e = [await create_user(session, svc.id) for _ in range(5)]
+
+    await service.register_referral(session, edge(a, b, svc))
+    await service.register_referrals_bulk(
+        session, [edge(b, c, svc), edge(b, d, svc), edge(a, e, svc)]
+    )
+
+    for window in ("all", "30d", "7d"):
+        top = await service.get_top_referrers(session, svc.id, 10, window)
+        assert sorted(ranking(top)) == sorted([(a.id, 2), (b.id, 2)])
+
+    top = await service.get_top_referrers(session, svc.id, limit=1)
+    assert len(top) == 1
+
+
+@pytest.mark.asyncio
+async def test_leaderboard_windows(session, service):
+    svc = await create_svc(session)
+    a, b = [await create_user(session, svc.id) for _ in range(2)]
+    invited = [await create_user(session, svc.id) for _ in range(4)]
+    now = datetime.utcnow()
+
+    # a пригласил 3 и 10 дней назад, b — дважды 40 дней назад
+    for referrer, referred, days_ago in (
+        (a, invited[0], 3),
+        (a, invited[1], 10),
+        (b, invited[2], 40),
+        (b, invited[3], 40),
+    ):
+        session.add(
+            Referral(
+                id=uuid.uuid4(),
+                referrer_id=referrer.id,
+                referred_id=referred.id,
+                service_id=svc.id,
+                level=1,
+                registered_at=now - timedelta(days=days_ago),
+            )
+        )
+    await session.flush()
+
+    top = await service.get_top_referrers(session, svc.id, window="all")
+    assert sorted(ranking(top)) == sorted([(a.id, 2), (b.id, 2)])
+
+    top = await service.get_top_referrers(session, svc.id, window="30d")
+    assert ranking(top) == [(a.id, 2)]
+
+    top = await service.get_top_referrers(session, svc.id, window="7d")
+    assert ranking(top) == [(a.id, 1)]
+
+    with pytest.raises(ValueError):
+        await service.get_top_referrers(session, svc.id, window="1y")
+
+
+@pytest.mark.asyncio
+async def test_leaderboard_window_rolls_over(session, service):
+    repo = ReferralRepository()
+    svc = await create_svc(session)
+    a, b = [await create_user(session, svc.id) for _ in range(2)]
+
+    await service.register_referral(session, edge(a, b, svc))
+    top = await service.get_top_referrers(session, svc.id, window="7d")
+    assert ranking(top) == [(a.id, 1)]
+
+    today = stats_day(None)
+    assert not await repo.refresh_leaderboard_window(
+        session, svc.id, "7d", today
+    )
+
+    # Через неделю регистрация выпадает из окна 7d, но остаётся в 30d
+    later = today + timedelta(days=7)
+    assert await repo.refresh_leaderboard_window(session, svc.id, "7d", later)
+    assert await repo.get_leaderboard(session, svc.id, "7d") == []
+
+    await repo.refresh_leaderboard_window(session, svc.id, "30d", later)
+    rows = await repo.get_leaderboard(session, svc.id, "30d")
+    assert [tuple(r) for r in rows] == [(a.id, 1)]
@@ -0,0 +1,126 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.models import Referral
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+@pytest.fixture
+def service():
+    return ReferralService()
+
+
+async def create_svc(session):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+def add_edge(session, svc, referrer_id, referred_id, level):
+    ref = Referral(
+        id=uuid.uuid4(),
+        referrer_id=referrer_id,
+        referred_id=referred_id,
+        service_id=svc.id,
+        level=level,
+    )
+    session.add(ref)
+    return ref
+
+
+async def levels_of(session, svc):
+    res = await session.execute(
+        select(Referral.referred_id, Referral.level).where(
+            Referral.service_id == svc.id
+        )
+    )
+    return dict(res.all())
+
+
+@pytest.mark.asyncio
+async def test_relevel_service(session, service):
+    svc = await create_svc(session)
+    a, b, c, d, x, y, z = [
+        await create_user(session, svc.id) for _ in range(7)
+    ]
+
+    add_edge(session, svc, a.id, b.id, 3)
+    add_edge(session, svc, b.id, c.id, 1)
+    add_edge(session, svc, c.id, d.id, 9)
+    add_edge(session, svc, x.id, y.id, 1)
+    add_edge(session, svc, y.id, x.id, 2)
+    add_edge(session, svc, y.id, z.id, 5)
+    orphan = add_edge(session, svc, a.id, uuid.uuid4(), 1)
+    await session.flush()
+
+    before = await levels_of(session, svc)
+    report = await service.relevel_all(session, svc.id, dry_run=True)
+
+    assert report["edges"] == 7
+    assert report["updated"] == 3
+    assert report["cycles"] == 2
+    assert set(report["cycle_users"]) == {x.id, y.id}
+    assert report["below_cycles"] == 1
+    assert report["below_cycle_users"] == [z.id]
+    assert report["orphans"] == 1
+    assert report["orphan_referrals"] == [orphan.id]
+    assert await levels_of(session, svc) == before
+
+    report = await service.relevel_all(session, svc.id)
+
+    assert report["updated"] == 3
+    levels = await levels_of(session, svc)
+    assert [levels[u.id] for u in (b, c, d)] == [1, 2, 3]
+    assert [levels[u.id] for u in (x, y, z)] == [2, 1, 5]
+
+    stats = await service.get_stats(session, svc.id)
+    assert stats == [
+        {"level": 1, "count": 3},
+        {"level": 2, "count": 2},
+        {"level": 3, "count": 1},
+        {"level": 5, "count": 1},
+    ]
+
+    report = await service.relevel_all(session, svc.id)
+    assert report["updated"] == 0
@@ -2,10 +2,13 @@ import uuid
 from datetime import datetime
 
 import pytest
+from sqlalchemy import Column, event
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from backend.database.base import Base
+from backend.database.pagination import encode_cursor
 from backend.ExternalService.models import ExternalService
 from backend.Referral.models import Referral
 from backend.Referral.repository import ReferralRepository
@@ -141,3 +144,100 @@ async def test_get_top_referrers(repo, session):
 
     assert top_referrer == a.id
     assert count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_parent_chain(repo, session):
+    svc = await create_service(session)
+    users = [await create_user(session, svc.id) for _ in range(4)]
+
+    for level, (referrer, referred) in enumerate(
+        zip(users, users[1:]), start=1
+    ):
+        await create_referral(session, referrer, referred, svc, level=level)
+
+    chain = await repo.get_parent_chain(session, users[3].id, svc.id)
+
+    assert [r.referrer_id for r in chain] == [
+        users[2].id,
+        users[1].id,
+        users[0].id,
+    ]
+
+    limited = await repo.get_parent_chain(
+        session, users[3].id, svc.id, max_depth=2
+    )
+    assert [r.referrer_id for r in limited] == [users[2].id, users[1].id]
+
+    assert await repo.get_parent_chain(session, users[0].id, svc.id) == []
+
+
+@pytest.mark.asyncio
+async def test_get_user_referrals_page(repo, session):
+    svc = await create_service(session)
+    a = await create_user(session, svc.id)
+    invited = [await create_user(session, svc.id) for _ in range(5)]
+
+    for user in invited:
+        await create_referral(session, a, user, svc)
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        items, cursor = await repo.get_user_referrals_page(
+            session, a.id, svc.id, limit=2, cursor=cursor
+        )
+        seen.extend(r.referred_id for r in items)
+        pages += 1
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert len(seen) == 5
+    assert set(seen) == {u.id for u in invited}
+
+
+@pytest.mark.asyncio
+async def test_user_referrals_page_sorted_by_keyset_index(repo, session):
+    """ORDER BY страницы совпадает с хвостом ix_referrals_referrer_keyset,
+    а равенства в WHERE — с его префиксом: индекс отдаёт строки уже в
+    нужном порядке."""
+    svc = await create_service(session)
+    a = await create_user(session, svc.id)
+    b = await create_user(session, svc.id)
+    await create_referral(session, a, b, svc)
+
+    statements = []
+
+    @event.listens_for(session.sync_session, "do_orm_execute")
+    def _capture(state):
+        statements.append(state.statement)
+
+    items, _ = await repo.get_user_referrals_page(
+        session, a.id, svc.id, limit=1
+    )
+    cursor = encode_cursor([items[0].registered_at, items[0].id])
+    await repo.get_user_referrals_page(
+        session, a.id, svc.id, limit=1, cursor=cursor
+    )
+
+    index = next(
+        i for i in Referral.__table__.indexes
+        if i.name == "ix_referrals_referrer_keyset"
+    )
+    assert not index.expressions or all(
+        isinstance(e, Column) for e in index.expressions
+    )
+    names = [c.name for c in index.columns]
+    assert names == ["service_id", "referrer_id", "registered_at", "id"]
+    assert not Referral.__table__.c.registered_at.nullable
+
+    dialect = postgresql.dialect()
+    order_by = ", ".join(f"referrals.{name}" for name in names[2:])
+    for stmt in statements:
+        sql = str(stmt.compile(dialect=dialect))
+        tail = sql.split("ORDER BY ")[1]
+        assert tail.split("LIMIT")[0].strip() == order_by
+        for name in names[:2]:
+            assert f"referrals.{name} = " in sql
@@ -194,8 +194,16 @@ async def test_get_parent_chain(session, service):
 
     chain = await service.get_parent_chain(session, c.id, svc.id)
 
-    assert len(chain) == 1
+    assert len(chain) == 2
     assert chain[0].referrer_id == b.id
+    assert chain[1].referrer_id == a.id
+
+    limited = await service.get_parent_chain(
+        session, c.id, svc.id, max_depth=1
+    )
+
+    assert len(limited) == 1
+    assert limited[0].referrer_id == b.id
 
 
 @pytest.mark.asyncio
@@ -230,3 +238,55 @@ async def test_get_top_referrers(session, service):
 
     assert len(top) == 1
     assert top[0].referrer_id == a.id
+
+
+@pytest.mark.asyncio
+async def test_get_chains(session, service):
+    svc = await create_service(session)
+    a, b, c, d, e = [await create_user(session, svc.id) for _ in range(5)]
+
+    for referrer, referred in ((a, b), (b, c), (b, d), (d, e)):
+        await service.register_referral(
+            session,
+            ReferralCreate(
+                referrer_id=referrer.id,
+                referred_id=referred.id,
+                service_id=svc.id,
+            ),
+        )
+
+    result = await service.get_chains(session, svc.id, [c.id, e.id, a.id])
+
+    assert result["chains"] == {
+        c.id: [b.id, a.id],
+        e.id: [d.id, b.id, a.id],
+        a.id: [],
+    }
+    assert sorted(edge.referred_id for edge in result["edges"]) == sorted(
+        [b.id, c.id, d.id, e.id]
+    )
+
+
+@pytest.mark.asyncio
+async def test_register_referral_twice(session, service):
+    svc = await create_service(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+
+    await service.register_referral(
+        session,
+        ReferralCreate(referrer_id=a.id, referred_id=b.id, service_id=svc.id),
+    )
+
+    with pytest.raises(ValueError, match="already referred"):
+        await service.register_referral(
+            session,
+            ReferralCreate(
+                referrer_id=c.id, referred_id=b.id, service_id=svc.id
+            ),
+        )
+
+    chain = await service.get_parent_chain(session, b.id, svc.id)
+    assert [r.referrer_id for r in chain] == [a.id]
+    assert await service.get_stats(session, svc.id) == [
+        {"level": 1, "count": 1}
+    ]
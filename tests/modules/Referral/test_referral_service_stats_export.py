@@ -1,3 +1,4 @@
+import json
 import uuid
 from datetime import datetime
 
@@ -7,6 +8,7 @@ from sqlalchemy.orm import sessionmaker
 
 from backend.database.base import Base
 from backend.ExternalService.models import ExternalService
+from backend.Referral.columnar import decode_columnar
 from backend.Referral.models import Referral
 from backend.Referral.service import ReferralService
 from backend.User.models import User
@@ -110,3 +112,84 @@ async def test_service_export_csv(session, service):
 
     assert "referrer_id" in content
     assert str(a.id) in content
+
+
+@pytest.mark.asyncio
+async def test_service_export_empty(session, service):
+    svc = await create_svc(session)
+
+    csv_content = await service.export_referrals(session, svc.id, "csv")
+    assert csv_content.splitlines() == [
+        "id,referrer_id,referred_id,service_id,level,"
+        "registered_at,referral_code_id"
+    ]
+
+    assert await service.export_referrals(session, svc.id, "json") == "[]"
+    assert await service.export_referrals(session, svc.id, "ndjson") == ""
+
+
+@pytest.mark.asyncio
+async def test_service_stream_export_chunks(session, service, monkeypatch):
+    monkeypatch.setattr("backend.Referral.service.EXPORT_CHUNK_ROWS", 2)
+
+    svc = await create_svc(session)
+    users = [await create_user(session, svc.id) for _ in range(6)]
+    for referrer, referred in zip(users, users[1:]):
+        await create_ref(session, referrer, referred, svc)
+
+    chunks = [
+        chunk
+        async for chunk in service.stream_export(session, svc.id, "json")
+    ]
+    assert len(chunks) > 3
+    assert len(json.loads("".join(chunks))) == 5
+
+    ndjson = await service.export_referrals(session, svc.id, "ndjson")
+    lines = [json.loads(line) for line in ndjson.splitlines()]
+    assert {r["referred_id"] for r in lines} == {
+        str(u.id) for u in users[1:]
+    }
+
+
+@pytest.mark.asyncio
+async def test_service_export_invalid_format(session, service):
+    svc = await create_svc(session)
+
+    with pytest.raises(ValueError):
+        await service.export_referrals(session, svc.id, "xml")
+
+
+@pytest.mark.asyncio
+async def test_service_export_columnar(session, service, monkeypatch):
+    monkeypatch.setattr("backend.Referral.service.CHUNK_ROWS", 2)
+
+    svc = await create_svc(session)
+    users = [await create_user(session, svc.id) for _ in range(6)]
+    refs = [
+        await create_ref(session, referrer, referred, svc)
+        for referrer, referred in zip(users, users[1:])
+    ]
+    refs[2].referral_code_id = uuid.uuid4()
+    await session.flush()
+
+    chunks = [
+        chunk
+        async for chunk in service.stream_export(session, svc.id, "columnar")
+    ]
+    # Заголовок, три куска по две строки и меньше, признак конца
+    assert len(chunks) == 5
+
+    service_id, rows = decode_columnar(b"".join(chunks))
+    assert service_id == svc.id
+    by_id = {row["id"]: row for row in rows}
+    assert set(by_id) == {ref.id for ref in refs}
+    for ref in refs:
+        row = by_id[ref.id]
+        assert row["referred_id"] == ref.referred_id
+        assert row["level"] == ref.level
+        assert row["referral_code_id"] == ref.referral_code_id
+        assert row["registered_at"].replace(tzinfo=None) == ref.registered_at
+
+    csv_size = len(await service.export_referrals(session, svc.id, "csv"))
+    columnar = await service.export_referrals(session, svc.id, "columnar")
+    assert len(columnar) * 2 < csv_size
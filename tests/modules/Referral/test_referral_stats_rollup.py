@@ -0,0 +1,183 @@
+import uuid
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ExternalService.models import ExternalService
+from backend.Referral.models import Referral, ReferralDailyStats
+from backend.Referral.repository import ReferralRepository
+from backend.Referral.schemas import ReferralCreate
+from backend.Referral.service import ReferralService
+from backend.User.models import User
+
+
+@pytest.fixture
+async def session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", future=True)
+    async_session = sessionmaker(
+        engine, expire_on_commit=False, class_=AsyncSession
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with async_session() as s:
+        yield s
+
+
+@pytest.fixture
+def service():
+    return ReferralService()
+
+
+async def create_svc(session):
+    svc = ExternalService(
+        id=uuid.uuid4(),
+        service_name="svc",
+        api_key="123",
+        webhook_url=None,
+        created_at=datetime.utcnow(),
+    )
+    session.add(svc)
+    await session.flush()
+    return svc
+
+
+async def create_user(session, service_id):
+    user = User(
+        id=uuid.uuid4(),
+        external_user_id=str(uuid.uuid4()),
+        service_id=service_id,
+        created_at=datetime.utcnow(),
+    )
+    session.add(user)
+    await session.flush()
+    return user
+
+
+def edge(referrer, referred, svc):
+    return ReferralCreate(
+        referrer_id=referrer.id,
+        referred_id=referred.id,
+        service_id=svc.id,
+        referral_code_id=None,
+    )
+
+
+@pytest.mark.asyncio
+async def test_rollup_follows_register_and_level_change(session, service):
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+
+    await service.register_referral(session, edge(a, b, svc))
+    ref = await service.register_referral(session, edge(b, c, svc))
+
+    stats = await service.get_stats(session, svc.id)
+    assert stats == [{"level": 1, "count": 1}, {"level": 2, "count": 1}]
+
+    await service.force_update_level(session, ref.id, 1)
+
+    stats = await service.get_stats(session, svc.id)
+    assert stats == [{"level": 1, "count": 2}]
+
+
+@pytest.mark.asyncio
+async def test_rollup_follows_bulk(session, service):
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+
+    await service.register_referrals_bulk(
+        session, [edge(a, b, svc), edge(b, c, svc)]
+    )
+
+    stats = await service.get_stats(session, svc.id)
+    assert stats == [{"level": 1, "count": 1}, {"level": 2, "count": 1}]
+
+
+@pytest.mark.asyncio
+async def test_rollup_date_range(session, service):
+    svc = await create_svc(session)
+    users = [await create_user(session, svc.id) for _ in range(4)]
+    days = [datetime(2024, 1, 1), datetime(2024, 1, 2), datetime(2024, 1, 3)]
+
+    for referred, registered_at in zip(users[1:], days):
+        session.add(
+            Referral(
+                id=uuid.uuid4(),
+                referrer_id=users[0].id,
+                referred_id=referred.id,
+                service_id=svc.id,
+                level=1,
+                registered_at=registered_at,
+            )
+        )
+    await session.flush()
+
+    stats = await service.get_stats(
+        session, svc.id, date(2024, 1, 2), date(2024, 1, 3)
+    )
+    assert stats == [{"level": 1, "count": 2}]
+
+    stats = await service.get_stats(session, svc.id, date_to=date(2024, 1, 1))
+    assert stats == [{"level": 1, "count": 1}]
+
+    with pytest.raises(ValueError):
+        await service.get_stats(
+            session, svc.id, date(2024, 1, 3), date(2024, 1, 1)
+        )
+
+
+@pytest.mark.asyncio
+async def test_rebuild_daily_stats(session):
+    repo = ReferralRepository()
+    svc = await create_svc(session)
+    a, b, c = [await create_user(session, svc.id) for _ in range(3)]
+    yesterday = datetime.utcnow() - timedelta(days=1)
+
+    await repo.bulk_create(
+        session,
+        [
+            {
+                "id": uuid.uuid4(),
+                "referrer_id": a.id,
+                "referred_id": b.id,
+                "service_id": svc.id,
+                "level": 1,
+                "registered_at": yesterday,
+            },
+            {
+                "id": uuid.uuid4(),
+                "referrer_id": b.id,
+                "referred_id": c.id,
+                "service_id": svc.id,
+                "level": 2,
+                "registered_at": yesterday,
+            },
+        ],
+    )
+    session.add(
+        ReferralDailyStats(
+            service_id=svc.id, level=5, day=yesterday.date(), count=7
+        )
+    )
+    await session.flush()
+
+    await repo.rebuild_daily_stats(session, svc.id)
+
+    rows = (
+        await session.execute(
+            select(
+                ReferralDailyStats.level,
+                ReferralDailyStats.day,
+                ReferralDailyStats.count,
+            ).order_by(ReferralDailyStats.level)
+        )
+    ).all()
+    assert [tuple(r) for r in rows] == [
+        (1, yesterday.date(), 1),
+        (2, yesterday.date(), 1),
+    ]
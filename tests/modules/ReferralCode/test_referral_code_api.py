@@ -129,7 +129,7 @@ async def test_get_codes_by_service(async_client: AsyncClient, async_session):
     response = await async_client.get(f"/referral-codes/service/{service_id}")
 
     assert response.status_code == 200
-    assert len(response.json()) == 3
+    assert len(response.json()["items"]) == 3
 
 
 async def test_get_inactive_codes(async_client: AsyncClient, async_session):
@@ -0,0 +1,159 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from backend.ReferralCode.bloom import BloomFilter, ReferralCodeFilter
+from backend.ReferralCode.models import ReferralCode
+from backend.ReferralCode.schemas import ReferralCodeCreate
+from backend.ReferralCode.service import ReferralCodeService
+
+
+def make_code(code: str) -> ReferralCode:
+    return ReferralCode(
+        id=uuid.uuid4(),
+        code=code,
+        user_id=uuid.uuid4(),
+        service_id=uuid.uuid4(),
+        created_at=datetime.utcnow(),
+    )
+
+
+def test_bloom_has_no_false_negatives_and_bounded_error():
+    bloom = BloomFilter(5000, 0.01)
+    items = [f"IN{i:06d}" for i in range(5000)]
+    for item in items:
+        bloom.add(item)
+
+    assert all(item in bloom for item in items)
+
+    false_positives = sum(f"OUT{i:06d}" in bloom for i in range(20000))
+    assert false_positives / 20000 < 0.02
+    # ~9.6 бита на элемент при p = 1%
+    assert bloom.memory_bytes < 5000 * 10 / 8 + 8
+
+
+def test_bloom_rejects_bad_error_rate():
+    with pytest.raises(ValueError):
+        BloomFilter(10, 1.0)
+
+
+@pytest.fixture
+def code_filter():
+    return ReferralCodeFilter(error_rate=0.001, refresh=600.0)
+
+
+@pytest.fixture
+def service(code_filter):
+    service = ReferralCodeService(code_filter=code_filter)
+    lookups = []
+    load = service.repo.get_by_code
+
+    async def counting(session, code):
+        lookups.append(code)
+        return await load(session, code)
+
+    service.repo.get_by_code = counting
+    service.lookups = lookups
+    return service
+
+
+async def test_unknown_code_rejected_without_db(session, service, code_filter):
+    session.add(make_code("BLOOM1-AAA"))
+    await session.commit()
+
+    found = await service.validate_code(session, "BLOOM1-AAA")
+    assert found.code == "BLOOM1-AAA"
+
+    for i in range(50):
+        with pytest.raises(ValueError, match="Invalid code"):
+            await service.validate_code(session, f"RANDOM-{i:03d}")
+
+    # С p = 0.1% почти все промахи отсеиваются фильтром
+    assert len(service.lookups) <= 3
+    assert code_filter.stats()["rejected"] >= 48
+
+
+async def test_created_codes_pass_filter(
+    session, service, code_filter, monkeypatch
+):
+    await code_filter.rebuild(session)
+
+    monkeypatch.setattr(service, "_generate_code", lambda: "BLOOM2-NEW")
+    await service.create_code(
+        session,
+        ReferralCodeCreate(user_id=uuid.uuid4(), service_id=uuid.uuid4()),
+    )
+    await session.commit()
+    assert (await service.validate_code(session, "BLOOM2-NEW")).code
+
+    monkeypatch.undo()
+    codes = await service.mass_generate(
+        session, uuid.uuid4(), uuid.uuid4(), 5
+    )
+    await session.commit()
+    for code in codes:
+        assert (await service.validate_code(session, code.code)).code
+
+
+async def test_rebuild_keeps_recently_added_codes(session, code_filter):
+    await code_filter.rebuild(session)
+
+    # Код добавлен, но ещё не закоммичен, когда фильтр перестраивается
+    code_filter.add(["BLOOM3-UNC"])
+    code_filter._expires = 0.0
+    await code_filter.rebuild(session)
+
+    assert await code_filter.might_exist(session, "BLOOM3-UNC")
+
+
+async def test_filter_stats(session, code_filter):
+    assert code_filter.stats()["ready"] is False
+
+    await code_filter.rebuild(session)
+    stats = code_filter.stats()
+
+    assert stats["ready"] is True
+    assert stats["memory_bytes"] == (stats["bits"] + 7) // 8
+    assert stats["estimated_error_rate"] <= stats["error_rate"]
+
+
+async def test_stale_filter_rebuilt_in_background(session, code_filter):
+    await code_filter.rebuild(session)
+    old = code_filter._filter
+
+    # Код вставлен в обход сервиса — фильтр узнает о нём при перестройке
+    session.add(make_code("BLOOM4-BGR"))
+    await session.commit()
+    code_filter._expires = 0.0
+
+    # Запрос не ждёт перестройки и получает ответ старого фильтра
+    assert not await code_filter.might_exist(session, "BLOOM4-BGR")
+    assert code_filter._filter is old
+
+    await code_filter._task
+    assert code_filter._filter is not old
+    assert await code_filter.might_exist(session, "BLOOM4-BGR")
+
+
+class RecordingChannel:
+    def __init__(self):
+        self.announced = []
+
+    async def announce(self, codes):
+        self.announced.extend(codes)
+
+
+async def test_new_codes_announced_before_commit(session, monkeypatch):
+    channel = RecordingChannel()
+    code_filter = ReferralCodeFilter(channel=channel)
+    service = ReferralCodeService(code_filter=code_filter)
+
+    monkeypatch.setattr(service, "_generate_code", lambda: "BLOOM5-ANN")
+    await service.create_code(
+        session,
+        ReferralCodeCreate(user_id=uuid.uuid4(), service_id=uuid.uuid4()),
+    )
+
+    assert channel.announced == ["BLOOM5-ANN"]
+    await session.rollback()
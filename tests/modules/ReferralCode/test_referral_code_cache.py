@@ -0,0 +1,164 @@
+import json
+import uuid
+from datetime import datetime
+
+import pytest
+
+from backend.ReferralCode.cache import (
+    NOTIFY_PAYLOAD_LIMIT,
+    ReferralCodeCache,
+    _payloads,
+)
+from backend.ReferralCode.models import ReferralCode
+from backend.ReferralCode.schemas import ReferralCodeCreate, ReferralCodeUpdate
+from backend.ReferralCode.service import ReferralCodeService
+
+
+class CountingLoad:
+    """Загрузка кода с подсчётом обращений к базе."""
+
+    def __init__(self, service):
+        self.load = service.repo.get_by_code
+        self.calls = 0
+
+    async def __call__(self, session, code):
+        self.calls += 1
+        return await self.load(session, code)
+
+
+def make_code(code: str, **values) -> ReferralCode:
+    return ReferralCode(
+        id=uuid.uuid4(),
+        code=code,
+        user_id=uuid.uuid4(),
+        service_id=uuid.uuid4(),
+        created_at=datetime.utcnow(),
+        **values,
+    )
+
+
+@pytest.fixture
+def cache():
+    return ReferralCodeCache(size=100, ttl=60.0, negative_ttl=60.0)
+
+
+@pytest.fixture
+def service(cache):
+    service = ReferralCodeService(cache=cache)
+    service.repo.get_by_code = CountingLoad(service)
+    return service
+
+
+async def test_repeat_lookup_served_from_cache(session, service, cache):
+    session.add(make_code("CACHE1-AAA"))
+    await session.commit()
+
+    first = await service.validate_code(session, "CACHE1-AAA")
+    second = await service.validate_code(session, "CACHE1-AAA")
+
+    assert first == second
+    assert first.code == "CACHE1-AAA"
+    assert service.repo.get_by_code.calls == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+async def test_missing_code_cached_negative(session, service, cache):
+    for _ in range(3):
+        with pytest.raises(ValueError, match="Invalid code"):
+            await service.validate_code(session, "NOPE00-000")
+
+    assert service.repo.get_by_code.calls == 1
+    assert cache.stats()["negative_hits"] == 2
+
+
+async def test_create_code_drops_negative_entry(
+    session, service, monkeypatch
+):
+    monkeypatch.setattr(service, "_generate_code", lambda: "FRESH1-NEW")
+
+    with pytest.raises(ValueError, match="Invalid code"):
+        await service.validate_code(session, "FRESH1-NEW")
+
+    await service.create_code(
+        session,
+        ReferralCodeCreate(user_id=uuid.uuid4(), service_id=uuid.uuid4()),
+    )
+    await session.commit()
+
+    found = await service.validate_code(session, "FRESH1-NEW")
+    assert found.code == "FRESH1-NEW"
+
+
+async def test_deactivate_and_update_invalidate(session, service):
+    code = make_code("CACHE2-BBB")
+    session.add(code)
+    await session.commit()
+
+    await service.validate_code(session, "CACHE2-BBB")
+    await service.update_limits(
+        session, code.id, ReferralCodeUpdate(usage_limit=5)
+    )
+    await session.commit()
+    updated = await service.validate_code(session, "CACHE2-BBB")
+    assert updated.usage_limit == 5
+
+    await service.deactivate_code(session, code.id)
+    await session.commit()
+    with pytest.raises(ValueError, match="Code is not active"):
+        await service.validate_code(session, "CACHE2-BBB")
+
+
+async def test_uncommitted_changes_not_cached(session, service, cache):
+    code = make_code("CACHE3-CCC")
+    session.add(code)
+    await session.commit()
+
+    await service.deactivate_code(session, code.id)
+    with pytest.raises(ValueError, match="Code is not active"):
+        await service.validate_code(session, "CACHE3-CCC")
+    await session.rollback()
+
+    # Откаченная деактивация не должна остаться в кэше
+    found = await service.validate_code(session, "CACHE3-CCC")
+    assert found.is_active
+
+
+async def test_lru_eviction_and_ttl(session, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(
+        "backend.ReferralCode.cache.time.monotonic", lambda: now[0]
+    )
+    cache = ReferralCodeCache(size=2, ttl=10.0, negative_ttl=1.0)
+
+    async def load(session, code):
+        return None
+
+    await cache.get(session, "A", load)
+    await cache.get(session, "B", load)
+    await cache.get(session, "A", load)
+    await cache.get(session, "C", load)
+
+    # B — самая давняя по обращению, она и вытеснена
+    assert set(cache._entries) == {"A", "C"}
+    assert cache.evictions == 1
+
+    now[0] += 2.0
+    await cache.get(session, "A", load)
+    assert cache.misses == 4
+
+
+def test_notify_payloads_fit_limit():
+    codes = [f"CODE{i:02d}-XYZ" for i in range(2000)]
+    payloads = list(_payloads(codes))
+
+    assert len(payloads) > 1
+    assert all(len(p) <= NOTIFY_PAYLOAD_LIMIT for p in payloads)
+    assert [c for p in payloads for c in json.loads(p)] == codes
+
+
+async def test_cache_stats_endpoint(client):
+    response = await client.get("/referral-codes/cache/stats")
+
+    assert response.status_code == 200
+    assert {"hits", "misses", "hit_ratio"} <= set(response.json())
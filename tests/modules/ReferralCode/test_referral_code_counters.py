@@ -0,0 +1,236 @@
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ReferralCode.counters import ShardedCounters, split_quota
+from backend.ReferralCode.models import (
+    ReferralCode,
+    ReferralCodeCounterShard,
+    ReferralCodeUsage,
+)
+from backend.ReferralCode.schemas import ReferralCodeUpdate
+from backend.ReferralCode.service import ReferralCodeService
+
+REDEEMERS = 40
+
+
+@pytest.fixture
+async def session_factory(tmp_path):
+    # Файл, а не :memory: — у каждой сессии своё соединение
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'counters.db'}", future=True
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    yield sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    await engine.dispose()
+
+
+async def create_code(session_factory, **values) -> uuid.UUID:
+    async with session_factory() as s:
+        code = ReferralCode(
+            id=uuid.uuid4(),
+            code="SHARD-" + uuid.uuid4().hex[:4].upper(),
+            user_id=uuid.uuid4(),
+            service_id=uuid.uuid4(),
+            **values,
+        )
+        s.add(code)
+        await s.commit()
+        return code.id
+
+
+async def count_shards(s, code_id) -> int:
+    return await s.scalar(
+        select(func.count()).where(
+            ReferralCodeCounterShard.referral_code_id == code_id
+        )
+    )
+
+
+async def shard(session_factory, counters, code_id):
+    """Раскладывает код по слотам, как проход уплотнения горячий код."""
+    async with session_factory() as s:
+        await counters.compact(s, code_id, keep=True)
+        await s.commit()
+
+
+def test_split_quota_sums_to_remaining():
+    assert split_quota(10, 4) == [3, 3, 2, 2]
+    assert split_quota(2, 4) == [1, 1, 0, 0]
+    assert split_quota(None, 3) == [None, None, None]
+
+
+@pytest.mark.asyncio
+async def test_sharded_redeems_summed_and_compacted(session_factory):
+    counters = ShardedCounters(slots=4, slack=0)
+    service = ReferralCodeService(counters=counters)
+    code_id = await create_code(session_factory)
+    await shard(session_factory, counters, code_id)
+
+    async with session_factory() as s:
+        for i in range(20):
+            result = await service.redeem(s, code_id, uuid.uuid4())
+            assert result.uses_count == i + 1
+        await s.commit()
+
+        assert await count_shards(s, code_id) == 4
+        code = await s.get(ReferralCode, code_id)
+        assert code.uses_count == 0
+        assert await counters.total(s, code_id) == 20
+
+        assert await counters.compact_all(s) == 20
+        await s.refresh(code)
+        assert code.uses_count == 20
+        assert await count_shards(s, code_id) == 4
+
+        # С прошлого уплотнения код не гасили — слоты больше не нужны
+        assert await counters.compact_all(s) == 0
+        assert await count_shards(s, code_id) == 0
+        assert await counters.total(s, code_id) == 20
+
+
+@pytest.mark.asyncio
+async def test_concurrent_sharded_redeems_never_overshoot(session_factory):
+    service = ReferralCodeService(
+        counters=ShardedCounters(slots=4, slack=2),
+    )
+    limit = 15
+    code_id = await create_code(session_factory, usage_limit=limit)
+    await shard(session_factory, service.counters, code_id)
+
+    async def redeem():
+        async with session_factory() as s:
+            try:
+                await service.redeem(s, code_id, uuid.uuid4())
+                await s.commit()
+                return True
+            except ValueError as e:
+                assert str(e) == "Usage limit reached"
+                await s.rollback()
+                return False
+
+    results = await asyncio.gather(*(redeem() for _ in range(REDEEMERS)))
+
+    assert sum(results) == limit
+    async with session_factory() as s:
+        assert await service.counters.total(s, code_id) == limit
+        usages = await s.scalar(
+            select(func.count()).where(
+                ReferralCodeUsage.referral_code_id == code_id
+            )
+        )
+    assert usages == limit
+
+
+@pytest.mark.asyncio
+async def test_update_limits_resplits_quotas(session_factory):
+    service = ReferralCodeService(
+        counters=ShardedCounters(slots=4, slack=0),
+    )
+    code_id = await create_code(session_factory, usage_limit=10)
+    await shard(session_factory, service.counters, code_id)
+
+    async with session_factory() as s:
+        for _ in range(3):
+            await service.redeem(s, code_id, uuid.uuid4())
+        await service.update_limits(
+            s, code_id, ReferralCodeUpdate(usage_limit=5)
+        )
+        await s.commit()
+
+        await service.redeem(s, code_id, uuid.uuid4())
+        await service.redeem(s, code_id, uuid.uuid4())
+        with pytest.raises(ValueError, match="Usage limit reached"):
+            await service.redeem(s, code_id, uuid.uuid4())
+        assert await service.counters.total(s, code_id) == 5
+
+
+@pytest.mark.asyncio
+async def test_code_within_slack_counted_in_row(session_factory):
+    service = ReferralCodeService(
+        counters=ShardedCounters(slots=4, slack=5),
+    )
+    code_id = await create_code(session_factory, usage_limit=3)
+
+    async with session_factory() as s:
+        for i in range(3):
+            result = await service.redeem(s, code_id, uuid.uuid4())
+            assert result.uses_count == i + 1
+        with pytest.raises(ValueError, match="Usage limit reached"):
+            await service.redeem(s, code_id, uuid.uuid4())
+
+        assert await count_shards(s, code_id) == 0
+
+
+@pytest.mark.asyncio
+async def test_sharded_redeem_rejects_inactive_code(session_factory):
+    service = ReferralCodeService(
+        counters=ShardedCounters(slots=4, slack=0),
+    )
+    code_id = await create_code(session_factory)
+    await shard(session_factory, service.counters, code_id)
+
+    async with session_factory() as s:
+        await service.redeem(s, code_id, uuid.uuid4())
+        await service.deactivate_code(s, code_id)
+        await s.commit()
+
+        with pytest.raises(ValueError, match="Code is not active"):
+            await service.redeem(s, code_id, uuid.uuid4())
+
+
+@pytest.mark.asyncio
+async def test_unsharded_code_redeemed_in_row(session_factory, monkeypatch):
+    counters = ShardedCounters(slots=4, slack=0, hot=3)
+    service = ReferralCodeService(counters=counters)
+    code_id = await create_code(session_factory)
+
+    async def no_shards(session, code_id):
+        raise AssertionError("unsharded code must not probe slots")
+
+    async with session_factory() as s:
+        with monkeypatch.context() as m:
+            m.setattr(counters, "redeem", no_shards)
+            for i in range(3):
+                result = await service.redeem(s, code_id, uuid.uuid4())
+                assert result.uses_count == i + 1
+        await s.commit()
+        assert await count_shards(s, code_id) == 0
+
+        # Погашенный hot раз код уплотнение раскладывает по слотам
+        await counters.compact_all(s)
+        assert await count_shards(s, code_id) == 4
+        code = await s.get(ReferralCode, code_id)
+        assert code.is_sharded
+
+        result = await service.redeem(s, code_id, uuid.uuid4())
+        assert result.uses_count == 4
+        await s.refresh(code)
+        assert code.uses_count == 3
+
+
+@pytest.mark.asyncio
+async def test_row_redeem_skips_code_sharded_elsewhere(session_factory):
+    code_id = await create_code(session_factory, usage_limit=10)
+    # Слоты создал другой процесс: у этого подсказки нет
+    await shard(session_factory, ShardedCounters(slots=4, slack=0), code_id)
+    service = ReferralCodeService(
+        counters=ShardedCounters(slots=4, slack=0),
+    )
+
+    async with session_factory() as s:
+        result = await service.redeem(s, code_id, uuid.uuid4())
+        assert result.uses_count == 1
+
+        code = await s.get(ReferralCode, code_id)
+        await s.refresh(code)
+        assert code.uses_count == 0
+        assert service.counters.is_sharded(code_id)
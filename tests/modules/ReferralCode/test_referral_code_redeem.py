@@ -0,0 +1,109 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend.database.base import Base
+from backend.ReferralCode.models import ReferralCode, ReferralCodeUsage
+from backend.ReferralCode.service import ReferralCodeService
+
+REDEEMERS = 40
+
+
+@pytest.fixture
+async def session_factory(tmp_path):
+    # Файл, а не :memory: — у каждой сессии своё соединение
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'redeem.db'}", future=True
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    yield sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    await engine.dispose()
+
+
+async def create_code(session_factory, **values) -> uuid.UUID:
+    async with session_factory() as s:
+        code = ReferralCode(
+            id=uuid.uuid4(),
+            code="REDEEM-" + uuid.uuid4().hex[:3].upper(),
+            user_id=uuid.uuid4(),
+            service_id=uuid.uuid4(),
+            **values,
+        )
+        s.add(code)
+        await s.commit()
+        return code.id
+
+
+@pytest.mark.asyncio
+async def test_redeem_counts_usage(session_factory):
+    service = ReferralCodeService()
+    code_id = await create_code(session_factory, usage_limit=2)
+
+    async with session_factory() as s:
+        first = await service.redeem(s, code_id, uuid.uuid4())
+        assert first.uses_count == 1
+        second = await service.redeem(s, code_id, uuid.uuid4())
+        assert second.uses_count == 2
+        await s.commit()
+
+        with pytest.raises(ValueError, match="Usage limit reached"):
+            await service.redeem(s, code_id, uuid.uuid4())
+
+        history = await service.get_usage_history(s, code_id)
+        assert len(history) == 2
+
+
+@pytest.mark.asyncio
+async def test_redeem_rejects_invalid_codes(session_factory):
+    service = ReferralCodeService()
+    inactive = await create_code(session_factory, is_active=False)
+    expired = await create_code(
+        session_factory,
+        expires_at=datetime.utcnow() - timedelta(days=1),
+    )
+
+    async with session_factory() as s:
+        with pytest.raises(ValueError, match="Invalid code"):
+            await service.redeem(s, uuid.uuid4(), uuid.uuid4())
+        with pytest.raises(ValueError, match="Code is not active"):
+            await service.redeem(s, inactive, uuid.uuid4())
+        with pytest.raises(ValueError, match="Code expired"):
+            await service.redeem(s, expired, uuid.uuid4())
+
+
+@pytest.mark.asyncio
+async def test_concurrent_redeems_never_overshoot_limit(session_factory):
+    service = ReferralCodeService()
+    limit = 7
+    code_id = await create_code(session_factory, usage_limit=limit)
+
+    async def redeem():
+        async with session_factory() as s:
+            try:
+                await service.redeem(s, code_id, uuid.uuid4())
+                await s.commit()
+                return True
+            except ValueError:
+                await s.rollback()
+                return False
+
+    results = await asyncio.gather(*(redeem() for _ in range(REDEEMERS)))
+
+    assert sum(results) == limit
+    async with session_factory() as s:
+        code = await s.get(ReferralCode, code_id)
+        usages = await s.scalar(
+            select(func.count()).where(
+                ReferralCodeUsage.referral_code_id == code_id
+            )
+        )
+    assert code.uses_count == limit
+    assert usages == limit
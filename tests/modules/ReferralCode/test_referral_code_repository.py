@@ -208,3 +208,33 @@ async def test_get_inactive(session):
 
     assert len(found) == 2
     assert {c.code for c in found} == {"A1", "A2"}
+
+
+@pytest.mark.asyncio
+async def test_get_page_by_service(session):
+    repo = ReferralCodeRepository()
+    sid = uuid.uuid4()
+
+    session.add_all(
+        [
+            ReferralCode(
+                id=uuid.uuid4(),
+                code=f"PAGE-{i}",
+                user_id=uuid.uuid4(),
+                service_id=sid,
+            )
+            for i in range(3)
+        ]
+    )
+    await session.flush()
+
+    first, cursor = await repo.get_page_by_service(session, sid, limit=2)
+    assert len(first) == 2
+    assert cursor is not None
+
+    second, cursor = await repo.get_page_by_service(
+        session, sid, limit=2, cursor=cursor
+    )
+    assert len(second) == 1
+    assert cursor is None
+    assert {c.code for c in first + second} == {"PAGE-0", "PAGE-1", "PAGE-2"}
@@ -1,8 +1,10 @@
+import json
 import uuid
 
 import pytest
 
 from backend.ReferralCode.models import ReferralCode, ReferralCodeUsage
+import backend.ReferralCode.service as service_module
 from backend.ReferralCode.service import ReferralCodeService
 
 
@@ -11,13 +13,14 @@ def service():
     return ReferralCodeService()
 
 
-async def create_code(session):
+async def create_code(session, usage_limit=None):
     rc = ReferralCode(
         id=uuid.uuid4(),
-        code="SERVICE-TEST",
+        code=f"SERVICE-{uuid.uuid4().hex[:8]}",
         user_id=uuid.uuid4(),
         service_id=uuid.uuid4(),
         is_active=True,
+        usage_limit=usage_limit,
     )
     session.add(rc)
     await session.flush()
@@ -25,14 +28,19 @@ async def create_code(session):
 
 
 @pytest.mark.asyncio
-async def test_log_usage(session, service):
-    code = await create_code(session)
+async def test_redeem_logs_usage(session, service):
+    code = await create_code(session, usage_limit=1)
     user_id = uuid.uuid4()
 
-    rec = await service.log_usage(session, code.id, user_id)
+    await service.redeem(session, code.id, user_id)
+
+    rows = await service.get_usage_history(session, code.id)
+    assert [row.used_by_user_id for row in rows] == [user_id]
 
-    assert rec.referral_code_id == code.id
-    assert rec.used_by_user_id == user_id
+    # Использование записывается только вместе с погашением
+    with pytest.raises(ValueError, match="Usage limit reached"):
+        await service.redeem(session, code.id, uuid.uuid4())
+    assert len(await service.get_usage_history(session, code.id)) == 1
 
 
 @pytest.mark.asyncio
@@ -42,8 +50,8 @@ async def test_get_usage_history(session, service):
     u1 = uuid.uuid4()
     u2 = uuid.uuid4()
 
-    await service.log_usage(session, code.id, u1)
-    await service.log_usage(session, code.id, u2)
+    await service.redeem(session, code.id, u1)
+    await service.redeem(session, code.id, u2)
 
     rows = await service.get_usage_history(session, code.id)
 
@@ -55,7 +63,7 @@ async def test_get_usage_history(session, service):
 async def test_clear_usage(session, service):
     code = await create_code(session)
 
-    await service.log_usage(session, code.id, uuid.uuid4())
+    await service.redeem(session, code.id, uuid.uuid4())
     await session.commit()
 
     await service.clear_usage(session, code.id)
@@ -63,3 +71,31 @@ async def test_clear_usage(session, service):
 
     rows = await session.execute(ReferralCodeUsage.__table__.select())
     assert len(rows.fetchall()) == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_usage_history(session, service, monkeypatch):
+    monkeypatch.setattr(service_module, "HISTORY_CHUNK_ROWS", 2)
+    code = await create_code(session)
+    users = [uuid.uuid4() for _ in range(3)]
+    for user_id in users:
+        await service.repo.add_usage(session, code.id, user_id)
+
+    chunks = [
+        chunk
+        async for chunk in service.stream_usage_history(session, code.id)
+    ]
+    data = json.loads(b"".join(chunks))
+
+    # "[", два куска строк, "]"
+    assert len(chunks) == 4
+    assert [row["used_by_user_id"] for row in data] == [
+        str(user_id) for user_id in users
+    ]
+    assert data[0]["referral_code_id"] == str(code.id)
+
+    empty = [
+        chunk
+        async for chunk in service.stream_usage_history(session, uuid.uuid4())
+    ]
+    assert json.loads(b"".join(empty)) == []
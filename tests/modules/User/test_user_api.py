@@ -95,7 +95,7 @@ async def test_get_users_of_service_api(session, client: AsyncClient):
     response = await client.get(f"/users/service/{service_id}/users")
 
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
 
     assert len(data) == 2
     assert set(data) == {str(u1.user_id), str(u2.user_id)}
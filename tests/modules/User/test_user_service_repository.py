@@ -101,3 +101,25 @@ async def test_get_users_by_service_id(session):
 
     assert len(result) == 2
     assert {r.user_id for r in result} == {u1.user_id, u2.user_id}
+
+
+@pytest.mark.asyncio
+async def test_get_service_links_page(session):
+    repo = UserServiceRepository()
+    service_id = uuid.uuid4()
+    user_ids = [uuid.uuid4() for _ in range(3)]
+
+    for user_id in user_ids:
+        await repo.add_user_to_service(session, user_id, service_id)
+
+    first, cursor = await repo.get_service_links_page(
+        session, service_id, limit=2
+    )
+    second, last_cursor = await repo.get_service_links_page(
+        session, service_id, limit=2, cursor=cursor
+    )
+
+    assert len(first) == 2
+    assert len(second) == 1
+    assert last_cursor is None
+    assert {link.user_id for link in first + second} == set(user_ids)
@@ -0,0 +1,76 @@
+import gzip
+import uuid
+
+import pytest
+
+from backend.compression import (
+    ENCODINGS,
+    compress_stream,
+    make_compressor,
+    negotiate_encoding,
+)
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip, deflate, br") == "gzip"
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("*") == ENCODINGS[0]
+    assert negotiate_encoding("*;q=0.5, gzip;q=0") == (
+        "zstd" if "zstd" in ENCODINGS else None
+    )
+
+
+async def chunks(parts):
+    for part in parts:
+        yield part
+
+
+@pytest.mark.asyncio
+async def test_gzip_stream_roundtrip():
+    parts = ["id,level\r\n"] + [f"{uuid.uuid4()},1\r\n" for _ in range(1000)]
+
+    compressed = b"".join(
+        [chunk async for chunk in compress_stream(chunks(parts), "gzip")]
+    )
+
+    assert gzip.decompress(compressed).decode() == "".join(parts)
+    assert len(compressed) < len("".join(parts))
+
+
+@pytest.mark.asyncio
+async def test_zstd_stream_roundtrip():
+    zstandard = pytest.importorskip("zstandard")
+    parts = [b"x" * 1000, b"y" * 1000]
+
+    compressed = b"".join(
+        [chunk async for chunk in compress_stream(chunks(parts), "zstd")]
+    )
+
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    assert decompressor.decompress(compressed) == b"".join(parts)
+
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError):
+        make_compressor("br")
+
+
+@pytest.mark.asyncio
+async def test_export_is_compressed(client):
+    res = await client.get(
+        f"/referrals/export/{uuid.uuid4()}?format=csv",
+        headers={"Accept-Encoding": "gzip"},
+    )
+    assert res.status_code == 200
+    assert res.headers["content-encoding"] == "gzip"
+    assert res.headers["vary"] == "Accept-Encoding"
+    assert res.text.startswith("id,referrer_id")
+
+    res = await client.get(
+        f"/referrals/export/{uuid.uuid4()}?format=csv",
+        headers={"Accept-Encoding": "identity"},
+    )
+    assert "content-encoding" not in res.headers
+    assert res.text.startswith("id,referrer_id")